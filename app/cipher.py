@@ -0,0 +1,370 @@
+'''
+Versioned ciphertext format for secrets.
+
+Layout of a version 1 envelope:
+
+    version    1 byte   always 1
+    flags      1 byte   0x01 for streamed secrets, see below; 0x02 if the
+                        payload was compressed with zlib, 0x04 with zstd
+    algorithm  1 byte   1 aesgcm, 2 chacha20, 3 fernet
+    kdf        1 byte   1 scrypt, 2 hkdf
+    params     3 bytes  scrypt log2(n), r, p; zeros for hkdf
+    salt      16 bytes  per secret random salt
+    nonce     12 bytes  AEAD nonce; absent for fernet
+    payload             AEAD ciphertext with tag, or a Fernet token
+
+For the AEAD algorithms the header up to and including the nonce is
+authenticated as associated data; for fernet any change to it changes the
+derived key.
+
+Compression happens before encryption, and only when it makes the
+payload smaller; envelopes with flags this version does not know are
+rejected.
+
+A streamed secret stores only the header (with an AEAD algorithm and the
+stream flag set). Its payload is split into chunks, each encrypted on its
+own with the nonce
+
+    nonce[:7] || chunk index, 4 bytes big endian || 1 for the last chunk
+
+and the header as associated data, so chunks can not be reordered,
+dropped or truncated without failing authentication.
+
+Tokens written before this format are plain Fernet tokens
+stored as their ASCII text, which always starts with 'gAAAAA'.
+'''
+
+import base64
+import os
+import struct
+from dataclasses import dataclass
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import (
+    AESGCM,
+    ChaCha20Poly1305
+)
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from . import compression as _compression
+from .config import (
+    CIPHER_ALGORITHM,
+    CIPHER_KDF,
+    CIPHER_SCRYPT_LOG2_N,
+    CIPHER_SCRYPT_P,
+    CIPHER_SCRYPT_R,
+    SECRET_COMPRESSION,
+    SECRET_COMPRESSION_LEVEL,
+    SECRET_COMPRESSION_MIN_SIZE,
+    SECRET_MAX_DECOMPRESSED_SIZE
+)
+
+VERSION = 1
+LEGACY_FERNET_PREFIX = b'gAAAAA'
+
+ALGORITHMS = {'aesgcm': 1, 'chacha20': 2, 'fernet': 3}
+KDFS = {'scrypt': 1, 'hkdf': 2}
+
+SALT_SIZE = 16
+NONCE_SIZE = 12
+KEY_SIZE = 32
+
+FLAG_STREAM = 0x01
+FLAG_ZLIB = 0x02
+FLAG_ZSTD = 0x04
+COMPRESSION_FLAGS = {'zlib': FLAG_ZLIB, 'zstd': FLAG_ZSTD}
+KNOWN_FLAGS = FLAG_STREAM | FLAG_ZLIB | FLAG_ZSTD
+STREAM_PREFIX_SIZE = 7
+MAX_CHUNKS = 2 ** 32
+
+_HEADER = struct.Struct('>BBBBBBB')
+_HKDF_INFO = b'secret-envelope-v1'
+
+
+class DecryptionError(Exception):
+    '''Raised when a ciphertext can not be decrypted'''
+
+
+@dataclass(frozen=True)
+class Header:
+    version: int
+    flags: int
+    algorithm: int
+    kdf: int
+    params: tuple[int, int, int]
+    salt: bytes
+    nonce: bytes
+
+    @property
+    def size(self) -> int:
+        return _HEADER.size + len(self.salt) + len(self.nonce)
+
+    def pack(self) -> bytes:
+        return _HEADER.pack(
+            self.version,
+            self.flags,
+            self.algorithm,
+            self.kdf,
+            *self.params
+        ) + self.salt + self.nonce
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'Header':
+        if len(data) < _HEADER.size + SALT_SIZE:
+            raise DecryptionError('Ciphertext is too short')
+        version, flags, algorithm, kdf, *params = _HEADER.unpack_from(data)
+        if version != VERSION:
+            raise DecryptionError(f'Unknown ciphertext version {version}')
+        if algorithm not in ALGORITHMS.values():
+            raise DecryptionError(f'Unknown cipher algorithm {algorithm}')
+        if flags & ~KNOWN_FLAGS:
+            raise DecryptionError(f'Unknown ciphertext flags {flags:#x}')
+        offset = _HEADER.size
+        salt = data[offset:offset + SALT_SIZE]
+        offset += SALT_SIZE
+        nonce = b''
+        if algorithm != ALGORITHMS['fernet']:
+            nonce = data[offset:offset + NONCE_SIZE]
+        return cls(version, flags, algorithm, kdf, tuple(params), salt, nonce)
+
+
+def default_params(kdf: str) -> tuple[int, int, int]:
+    if kdf == 'scrypt':
+        return (CIPHER_SCRYPT_LOG2_N, CIPHER_SCRYPT_R, CIPHER_SCRYPT_P)
+    return (0, 0, 0)
+
+
+def derive_key(
+        passphrase: str,
+        salt: bytes,
+        kdf: int,
+        params: tuple[int, int, int]
+) -> bytes:
+    '''
+    Derive a 32 byte key from the passphrase and the per secret salt
+    '''
+
+    if kdf == KDFS['scrypt']:
+        log2_n, r, p = params
+        return Scrypt(
+            salt=salt, length=KEY_SIZE, n=2 ** log2_n, r=r, p=p
+        ).derive(passphrase.encode())
+    if kdf == KDFS['hkdf']:
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=KEY_SIZE,
+            salt=salt,
+            info=_HKDF_INFO
+        ).derive(passphrase.encode())
+    raise DecryptionError(f'Unknown key derivation function {kdf}')
+
+
+def _cipher(algorithm: int, key: bytes):
+    if algorithm == ALGORITHMS['aesgcm']:
+        return AESGCM(key)
+    if algorithm == ALGORITHMS['chacha20']:
+        return ChaCha20Poly1305(key)
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def _chunk_nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    if index >= MAX_CHUNKS:
+        raise ValueError('Too many chunks in one stream')
+    return prefix + index.to_bytes(4, 'big') + (b'\x01' if last else b'\x00')
+
+
+class StreamEncryptor:
+    '''
+    Encrypts the chunks of one streamed secret in order
+    '''
+
+    def __init__(self, header: Header, key: bytes) -> None:
+        self.header = header.pack()
+        self._prefix = header.nonce[:STREAM_PREFIX_SIZE]
+        self._cipher = _cipher(header.algorithm, key)
+        self._index = 0
+
+    def encrypt_chunk(self, data: bytes, last: bool = False) -> bytes:
+        nonce = _chunk_nonce(self._prefix, self._index, last)
+        self._index += 1
+        return self._cipher.encrypt(nonce, data, self.header)
+
+
+class StreamDecryptor:
+    '''
+    Decrypts the chunks of one streamed secret in order. A stream is only
+    complete once finish() has confirmed its last chunk was decrypted.
+    '''
+
+    def __init__(self, header: Header, key: bytes) -> None:
+        self.header = header.pack()
+        self._prefix = header.nonce[:STREAM_PREFIX_SIZE]
+        self._cipher = _cipher(header.algorithm, key)
+        self._index = 0
+        self._finished = False
+
+    def decrypt_chunk(self, data: bytes, last: bool = False) -> bytes:
+        nonce = _chunk_nonce(self._prefix, self._index, last)
+        self._index += 1
+        try:
+            plaintext = self._cipher.decrypt(nonce, data, self.header)
+        except InvalidTag as exc:
+            raise DecryptionError('Chunk is corrupt or out of order') from exc
+        self._finished = last
+        return plaintext
+
+    def finish(self) -> None:
+        '''
+        Raise DecryptionError unless the last chunk has been decrypted
+        '''
+
+        if not self._finished:
+            raise DecryptionError('Stream ends before its last chunk')
+
+
+def is_legacy(data: bytes) -> bool:
+    '''
+    Whether data is a Fernet token from before the versioned format
+    '''
+
+    return data.startswith(LEGACY_FERNET_PREFIX)
+
+
+class Envelope:
+    '''
+    Encrypts and decrypts version 1 envelopes for one passphrase.
+    Derived keys and cipher objects are cached per salt. Payloads of at
+    least compression_min_size bytes are compressed with compression.
+    '''
+
+    def __init__(
+            self,
+            passphrase: str,
+            algorithm: str = CIPHER_ALGORITHM,
+            kdf: str = CIPHER_KDF,
+            compression: str = SECRET_COMPRESSION,
+            compression_level: int = SECRET_COMPRESSION_LEVEL,
+            compression_min_size: int = SECRET_COMPRESSION_MIN_SIZE,
+            max_decompressed_size: int = SECRET_MAX_DECOMPRESSED_SIZE
+    ) -> None:
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'Unknown cipher algorithm: {algorithm}')
+        if kdf not in KDFS:
+            raise ValueError(f'Unknown key derivation function: {kdf}')
+        self.passphrase = passphrase
+        self.algorithm = ALGORITHMS[algorithm]
+        self.kdf = KDFS[kdf]
+        self.params = default_params(kdf)
+        self.compression = _compression.resolve(compression)
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+        self.max_decompressed_size = max_decompressed_size
+        self._ciphers = {}
+
+    def __getstate__(self) -> dict:
+        # cipher objects are not picklable and cheap to rebuild
+        return {**self.__dict__, '_ciphers': {}}
+
+    def _get_cipher(self, header: Header):
+        cache_key = (header.algorithm, header.kdf, header.params, header.salt)
+        cipher = self._ciphers.get(cache_key)
+        if cipher is None:
+            key = self.derive_key(header)
+            cipher = self._ciphers[cache_key] = _cipher(header.algorithm, key)
+        return cipher
+
+    def _new_header(self, algorithm: int, flags: int = 0) -> Header:
+        nonce = b''
+        if algorithm != ALGORITHMS['fernet']:
+            nonce = os.urandom(NONCE_SIZE)
+        return Header(
+            VERSION,
+            flags,
+            algorithm,
+            self.kdf,
+            self.params,
+            os.urandom(SALT_SIZE),
+            nonce
+        )
+
+    def _compress(self, data: bytes) -> tuple[int, bytes]:
+        if self.compression is None or len(data) < self.compression_min_size:
+            return 0, data
+        packed = _compression.compress(
+            data, self.compression, self.compression_level
+        )
+        if len(packed) >= len(data):
+            return 0, data
+        return COMPRESSION_FLAGS[self.compression], packed
+
+    def _decompress(self, header: Header, data: bytes) -> bytes:
+        for codec, flag in COMPRESSION_FLAGS.items():
+            if header.flags & flag:
+                try:
+                    return _compression.decompress(
+                        data, codec, self.max_decompressed_size
+                    )
+                except _compression.DecompressionError as exc:
+                    raise DecryptionError(str(exc)) from exc
+        return data
+
+    def encrypt(self, data: bytes) -> bytes:
+        flags, data = self._compress(data)
+        header = self._new_header(self.algorithm, flags)
+        associated_data = header.pack()
+        cipher = self._get_cipher(header)
+        if header.algorithm == ALGORITHMS['fernet']:
+            return associated_data + cipher.encrypt(data)
+        return associated_data + cipher.encrypt(
+            header.nonce, data, associated_data
+        )
+
+    def decrypt(self, envelope: bytes) -> bytes:
+        header = Header.unpack(envelope)
+        if header.flags & FLAG_STREAM:
+            raise DecryptionError('Streamed secrets must be read by chunks')
+        associated_data = envelope[:header.size]
+        payload = envelope[header.size:]
+        cipher = self._get_cipher(header)
+        try:
+            if header.algorithm == ALGORITHMS['fernet']:
+                data = cipher.decrypt(payload)
+            else:
+                data = cipher.decrypt(header.nonce, payload, associated_data)
+        except (InvalidTag, InvalidToken) as exc:
+            raise DecryptionError('Ciphertext is corrupt or key is wrong') from exc
+        return self._decompress(header, data)
+
+    def derive_key(self, header: Header) -> bytes:
+        return derive_key(
+            self.passphrase, header.salt, header.kdf, header.params
+        )
+
+    def new_stream_header(self) -> Header:
+        '''
+        Header for a new streamed secret. Fernet has no nonce to count
+        chunks with, so streams fall back to aesgcm when it is configured.
+        '''
+
+        algorithm = self.algorithm
+        if algorithm == ALGORITHMS['fernet']:
+            algorithm = ALGORITHMS['aesgcm']
+        return self._new_header(algorithm, FLAG_STREAM)
+
+    @staticmethod
+    def read_stream_header(header_data: bytes) -> Header:
+        header = Header.unpack(header_data)
+        if not header.flags & FLAG_STREAM:
+            raise DecryptionError('Secret is not streamed')
+        return header
+
+    def stream_encryptor(self) -> StreamEncryptor:
+        header = self.new_stream_header()
+        return StreamEncryptor(header, self.derive_key(header))
+
+    def stream_decryptor(self, header_data: bytes) -> StreamDecryptor:
+        header = self.read_stream_header(header_data)
+        return StreamDecryptor(header, self.derive_key(header))
@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import logging
+from typing import Awaitable, Callable
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+batch_size = metrics.histogram(
+    'write_coalescer_batch_size',
+    'Items written per coalesced flush',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+flush_errors = metrics.counter(
+    'write_coalescer_flush_errors_total',
+    'Coalesced flushes that failed and were retried item by item'
+)
+
+
+class WriteCoalescer:
+    '''
+    Group commit: items submitted concurrently are collected for up to
+    max_delay seconds, or until max_batch of them are queued, and written
+    with a single call of flush.
+
+    Every submitter waits for the flush holding its item. If a batch
+    fails, its items are written one by one, so one bad item only fails
+    its own submitter.
+    '''
+
+    def __init__(
+            self,
+            flush: Callable[[list], Awaitable[None]],
+            max_delay: float,
+            max_batch: int
+    ) -> None:
+        self.flush = flush
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._pending: list[tuple[object, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def submit(self, item) -> None:
+        '''
+        Queue item and return once it is written
+        '''
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        await future
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # a fresh context, so the flush is not timed as part of whichever
+        # request happened to fill the batch
+        task = asyncio.create_task(
+            self._flush(batch),
+            context=contextvars.Context()
+        )
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list) -> None:
+        batch_size.observe(len(batch))
+        try:
+            await self.flush([item for item, _ in batch])
+        except Exception as exc:
+            if len(batch) == 1:
+                _resolve(batch[0][1], exc)
+                return
+            flush_errors.inc()
+            logger.warning('Coalesced write of %d items failed', len(batch))
+            for item, future in batch:
+                try:
+                    await self.flush([item])
+                except Exception as item_exc:
+                    _resolve(future, item_exc)
+                else:
+                    _resolve(future)
+        else:
+            for _, future in batch:
+                _resolve(future)
+
+    async def close(self) -> None:
+        '''
+        Write what is queued and wait for running flushes
+        '''
+
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+def _resolve(future: asyncio.Future, exc: Exception | None = None) -> None:
+    # the submitter may have been cancelled meanwhile
+    if future.done():
+        return
+    if exc is None:
+        future.set_result(None)
+    else:
+        future.set_exception(exc)
@@ -0,0 +1,82 @@
+'''
+Compression of secret payloads before they are encrypted.
+
+zstd needs the optional zstandard package; zlib is always available.
+Decompression never produces more than the given max_size bytes, so a
+crafted payload can not expand into unbounded memory.
+'''
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard else ())
+
+CODECS = ('zlib', 'zstd')
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3}
+
+
+class DecompressionError(Exception):
+    '''Raised when a payload is corrupt or expands beyond the limit'''
+
+
+def available(codec: str) -> bool:
+    return codec == 'zlib' or (codec == 'zstd' and zstandard is not None)
+
+
+def resolve(codec: str) -> str | None:
+    '''
+    The codec to compress with for the SECRET_COMPRESSION setting: None
+    for 'none', and zlib when zstd is asked for but not installed
+    '''
+
+    if codec == 'none':
+        return None
+    if codec not in CODECS:
+        raise ValueError(f'Unknown compression codec: {codec}')
+    return codec if available(codec) else 'zlib'
+
+
+def compress(data: bytes, codec: str, level: int = 0) -> bytes:
+    level = level or DEFAULT_LEVELS[codec]
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def _zstd_decompress(data: bytes, max_size: int) -> bytes:
+    # frames made by compress() carry their size; without it the output
+    # is capped by max_output_size
+    size = zstandard.frame_content_size(data)
+    if size > max_size:
+        raise DecompressionError(f'Payload expands beyond {max_size} bytes')
+    return zstandard.ZstdDecompressor().decompress(
+        data,
+        max_output_size=max_size
+    )
+
+
+def _zlib_decompress(data: bytes, max_size: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_size)
+    tail = decompressor.unconsumed_tail
+    # input left at the limit may still be just the end of the stream
+    if tail and decompressor.decompress(tail, 1):
+        raise DecompressionError(f'Payload expands beyond {max_size} bytes')
+    if not decompressor.eof:
+        raise DecompressionError('Compressed payload is truncated')
+    return result
+
+
+def decompress(data: bytes, codec: str, max_size: int) -> bytes:
+    if not available(codec):
+        raise DecompressionError(f'{codec} support is not installed')
+    try:
+        if codec == 'zstd':
+            return _zstd_decompress(data, max_size)
+        return _zlib_decompress(data, max_size)
+    except _ERRORS as exc:
+        raise DecompressionError('Compressed payload is corrupt') from exc
@@ -1,6 +1,294 @@
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DB_URL = os.getenv('DB_URL')
\ No newline at end of file
+
+def _get_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+DB_URL = os.getenv('DB_URL')
+
+# Production server, python -m app.server. WEB_WORKERS processes (the CPU
+# count by default) share one socket; on SIGTERM each stops accepting and
+# waits up to SERVER_GRACEFUL_TIMEOUT seconds for requests in flight.
+# DB_CONNECTION_BUDGET, when set, is the number of database connections
+# for all workers together: each gets budget // WEB_WORKERS of them with no
+# overflow, overriding DB_POOL_SIZE and DB_MAX_OVERFLOW. With read receipts
+# on Postgres one of them is the worker's LISTEN connection, outside the pool.
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', 8000))
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', os.cpu_count() or 1))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30))
+DB_CONNECTION_BUDGET = int(os.getenv('DB_CONNECTION_BUDGET', 0))
+
+# Behind a reverse proxy the client address, which wrong passphrase
+# attempts are limited by, is taken from X-Forwarded-For, but only on
+# connections from FORWARDED_ALLOW_IPS: comma separated addresses or
+# networks of the proxies, '*' for any. Plain uvicorn takes the same
+# variable, or --forwarded-allow-ips.
+FORWARDED_ALLOW_IPS = os.getenv('FORWARDED_ALLOW_IPS', '127.0.0.1')
+
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    '''
+    Engine and connection pool settings.
+
+    pgbouncer switches asyncpg to a mode that is safe behind PgBouncer in
+    transaction pooling mode: no statement cache and unique names for
+    prepared statements.
+
+    statement_timeout, in seconds (0 for none), is the Postgres
+    statement_timeout of every connection; it defaults to REQUEST_TIMEOUT
+    so requests only set a shorter one when they have less time left.
+    PgBouncer does not pass it on, so it is not set with pgbouncer.
+    '''
+
+    url: str | None
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_recycle: int = -1
+    pool_pre_ping: bool = False
+    statement_cache_size: int = 100
+    prepared_statement_cache_size: int = 100
+    pgbouncer: bool = False
+    application_name: str = 'secret'
+    statement_timeout: float = 0
+
+    @property
+    def connection_statement_timeout(self) -> float:
+        return 0 if self.pgbouncer else self.statement_timeout
+
+    @classmethod
+    def from_env(cls) -> 'DatabaseSettings':
+        pool_size = int(os.getenv('DB_POOL_SIZE', 5))
+        max_overflow = int(os.getenv('DB_MAX_OVERFLOW', 10))
+        pgbouncer = _get_bool('DB_PGBOUNCER', False)
+        if DB_CONNECTION_BUDGET:
+            per_worker = DB_CONNECTION_BUDGET // WEB_WORKERS
+            if _get_bool('READ_RECEIPTS_ENABLED', False) and not pgbouncer:
+                # the connection each worker LISTENs on for read receipts
+                per_worker -= 1
+            pool_size = max(1, per_worker)
+            max_overflow = 0
+        return cls(
+            url=DB_URL,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', -1)),
+            pool_pre_ping=_get_bool('DB_POOL_PRE_PING', False),
+            statement_cache_size=int(
+                os.getenv('DB_STATEMENT_CACHE_SIZE', 100)
+            ),
+            prepared_statement_cache_size=int(
+                os.getenv('DB_PREPARED_STATEMENT_CACHE_SIZE', 100)
+            ),
+            pgbouncer=pgbouncer,
+            application_name=os.getenv('DB_APPLICATION_NAME', 'secret'),
+            statement_timeout=float(os.getenv(
+                'DB_STATEMENT_TIMEOUT', os.getenv('REQUEST_TIMEOUT', 30)
+            ))
+        )
+
+
+DATABASE = DatabaseSettings.from_env()
+
+# Worker pool used for bcrypt and Fernet so they never block the event loop.
+# CRYPTO_EXECUTOR is either 'thread' or 'process'.
+CRYPTO_EXECUTOR = os.getenv('CRYPTO_EXECUTOR', 'thread')
+CRYPTO_MAX_WORKERS = int(os.getenv('CRYPTO_MAX_WORKERS', os.cpu_count() or 1))
+CRYPTO_MAX_QUEUE = int(os.getenv('CRYPTO_MAX_QUEUE', 64))
+
+# Background task deleting expired and consumed secrets in batches.
+# Consumed rows are kept for REAPER_CONSUMED_GRACE seconds so a claim that
+# is released after a wrong passphrase is not reaped from under the reader.
+# Read secrets are kept, without their data, for REAPER_READ_RETENTION
+# seconds after the read, so GET /secrets/{key}/status still answers 'read'.
+REAPER_ENABLED = _get_bool('REAPER_ENABLED', True)
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', 60))
+REAPER_BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', 1000))
+REAPER_MAX_BATCHES = int(os.getenv('REAPER_MAX_BATCHES', 100))
+REAPER_CONSUMED_GRACE = float(os.getenv('REAPER_CONSUMED_GRACE', 60))
+REAPER_READ_RETENTION = float(os.getenv('REAPER_READ_RETENTION', 86400))
+
+# Maximum number of secrets accepted by POST /generate/batch
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 1000))
+
+# Passphrase hashing. HASH_SCHEME is the scheme new hashes are created
+# with ('bcrypt' or 'argon2'); hashes made with any known scheme still
+# verify. Secrets with a ttl of at most HASH_FAST_TTL seconds are hashed
+# with a keyed HMAC-SHA256 instead, which needs PASSPHRASE_HMAC_KEY.
+HASH_SCHEME = os.getenv('HASH_SCHEME', 'bcrypt')
+HASH_BCRYPT_ROUNDS = int(os.getenv('HASH_BCRYPT_ROUNDS', 12))
+HASH_ARGON2_MEMORY_COST = int(os.getenv('HASH_ARGON2_MEMORY_COST', 19456))
+HASH_ARGON2_TIME_COST = int(os.getenv('HASH_ARGON2_TIME_COST', 2))
+HASH_ARGON2_PARALLELISM = int(os.getenv('HASH_ARGON2_PARALLELISM', 1))
+HASH_FAST_TTL = int(os.getenv('HASH_FAST_TTL', 0))
+PASSPHRASE_HMAC_KEY = os.getenv('PASSPHRASE_HMAC_KEY')
+
+# Secret encryption. CIPHER_ALGORITHM is 'aesgcm', 'chacha20' or 'fernet',
+# CIPHER_KDF is 'scrypt' or 'hkdf'. Parameters are stored with every
+# ciphertext, so changing them only affects new secrets.
+CIPHER_ALGORITHM = os.getenv('CIPHER_ALGORITHM', 'aesgcm')
+CIPHER_KDF = os.getenv('CIPHER_KDF', 'scrypt')
+CIPHER_SCRYPT_LOG2_N = int(os.getenv('CIPHER_SCRYPT_LOG2_N', 14))
+CIPHER_SCRYPT_R = int(os.getenv('CIPHER_SCRYPT_R', 8))
+CIPHER_SCRYPT_P = int(os.getenv('CIPHER_SCRYPT_P', 1))
+
+# Streamed secrets are stored as chunks of STREAM_CHUNK_SIZE bytes and may
+# not exceed STREAM_MAX_SIZE bytes in total
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 64 * 1024))
+STREAM_MAX_SIZE = int(os.getenv('STREAM_MAX_SIZE', 64 * 1024 * 1024))
+
+# Secrets of at least SECRET_COMPRESSION_MIN_SIZE bytes are compressed
+# before encryption when that makes them smaller. SECRET_COMPRESSION is
+# 'zlib', 'zstd' (needs zstandard, zlib is used without it) or 'none';
+# SECRET_COMPRESSION_LEVEL 0 picks the codec default. Reading a secret
+# fails if it would expand beyond SECRET_MAX_DECOMPRESSED_SIZE bytes, and
+# larger secrets are refused when they are created.
+# Streamed secrets are not compressed.
+SECRET_COMPRESSION = os.getenv('SECRET_COMPRESSION', 'zlib')
+SECRET_COMPRESSION_LEVEL = int(os.getenv('SECRET_COMPRESSION_LEVEL', 0))
+SECRET_COMPRESSION_MIN_SIZE = int(
+    os.getenv('SECRET_COMPRESSION_MIN_SIZE', 512)
+)
+SECRET_MAX_DECOMPRESSED_SIZE = int(
+    os.getenv('SECRET_MAX_DECOMPRESSED_SIZE', STREAM_MAX_SIZE)
+)
+
+# Every request gets REQUEST_TIMEOUT seconds once its body is received
+# (0 for no limit), or less if the client asks for less in the
+# REQUEST_TIMEOUT_HEADER header. Pool checkout, Postgres statements and
+# the crypto queue wait at most what is left; a request out of time is
+# answered with 504 unless its response has started.
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 30))
+REQUEST_TIMEOUT_HEADER = os.getenv('REQUEST_TIMEOUT_HEADER', 'X-Request-Timeout')
+
+# Responses of at least RESPONSE_GZIP_MIN_SIZE bytes are gzipped for
+# clients that accept it; 0 turns this off. It costs CPU on every read.
+RESPONSE_GZIP_MIN_SIZE = int(os.getenv('RESPONSE_GZIP_MIN_SIZE', 0))
+
+# Per request instrumentation: stage latency histograms and per route
+# outcome counters at /metrics, optionally echoed in a Server-Timing header
+METRICS_ENABLED = _get_bool('METRICS_ENABLED', True)
+SERVER_TIMING_ENABLED = _get_bool('SERVER_TIMING_ENABLED', False)
+
+# Read receipts. With READ_RECEIPTS_ENABLED, a secret created with a
+# callback_url (on one of RECEIPT_CALLBACK_HOSTS if that is set) gets a
+# receipt POSTed there once it has been read. Callbacks go only to public
+# addresses, checked when they are sent, unless their host is listed in
+# RECEIPT_CALLBACK_HOSTS. The read is recorded, and
+# the receipt written to the read_receipts outbox in the same transaction,
+# once the response has been delivered, so that a claim released after a
+# wrong passphrase or an undelivered response sends nothing. A dispatcher
+# in the first worker sends due receipts in batches of RECEIPT_BATCH_SIZE.
+# Failed deliveries are retried after RECEIPT_RETRY_BASE seconds,
+# doubling up to RECEIPT_RETRY_MAX, RECEIPT_MAX_ATTEMPTS times in all. On
+# Postgres the dispatcher wakes on NOTIFY; otherwise, or through
+# PgBouncer, it polls every RECEIPT_POLL_INTERVAL seconds.
+# GET /secrets/{key}/status holds a request up to RECEIPT_STATUS_MAX_WAIT
+# seconds waiting for the secret to be read.
+READ_RECEIPTS_ENABLED = _get_bool('READ_RECEIPTS_ENABLED', False)
+RECEIPT_CALLBACK_HOSTS = os.getenv('RECEIPT_CALLBACK_HOSTS', '').split()
+RECEIPT_BATCH_SIZE = int(os.getenv('RECEIPT_BATCH_SIZE', 100))
+RECEIPT_TIMEOUT = float(os.getenv('RECEIPT_TIMEOUT', 5))
+RECEIPT_MAX_ATTEMPTS = int(os.getenv('RECEIPT_MAX_ATTEMPTS', 10))
+RECEIPT_RETRY_BASE = float(os.getenv('RECEIPT_RETRY_BASE', 5))
+RECEIPT_RETRY_MAX = float(os.getenv('RECEIPT_RETRY_MAX', 3600))
+RECEIPT_POLL_INTERVAL = float(os.getenv('RECEIPT_POLL_INTERVAL', 5))
+RECEIPT_STATUS_MAX_WAIT = float(os.getenv('RECEIPT_STATUS_MAX_WAIT', 25))
+
+# Admin only profiling under /admin, off unless ADMIN_TOKEN is set; send it
+# as a bearer token. A profile samples all threads of the worker that
+# serves it every PROFILE_INTERVAL seconds, for at most
+# PROFILE_MAX_SECONDS. With metrics on, the stage breakdown and a stack
+# snapshot of the last SLOW_REQUEST_LOG_SIZE requests that took
+# SLOW_REQUEST_THRESHOLD seconds or more are kept (0 turns this off).
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 10))
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', 0))
+SLOW_REQUEST_LOG_SIZE = int(os.getenv('SLOW_REQUEST_LOG_SIZE', 100))
+
+# In-process cache of secret keys known to be unreadable. Consumed and
+# expired keys never become readable again and are kept for
+# NEGATIVE_CACHE_TTL seconds; unknown keys only for
+# NEGATIVE_CACHE_MISSING_TTL. NEGATIVE_CACHE_MAX_ENTRIES=0 disables it.
+NEGATIVE_CACHE_MAX_ENTRIES = int(
+    os.getenv('NEGATIVE_CACHE_MAX_ENTRIES', 100_000)
+)
+NEGATIVE_CACHE_TTL = float(os.getenv('NEGATIVE_CACHE_TTL', 3600))
+NEGATIVE_CACHE_MISSING_TTL = float(
+    os.getenv('NEGATIVE_CACHE_MISSING_TTL', 10)
+)
+
+# Wrong passphrase attempts are limited per secret key and per client IP
+# with token buckets: LIMIT_*_BURST failures in a row, then one more every
+# LIMIT_*_INTERVAL seconds. A secret is invalidated after
+# SECRET_MAX_FAILED_ATTEMPTS failures in total (0 never invalidates).
+# LIMIT_REDIS_URL shares the buckets between workers and needs redis.
+LIMIT_ENABLED = _get_bool('LIMIT_ENABLED', True)
+LIMIT_KEY_BURST = int(os.getenv('LIMIT_KEY_BURST', 5))
+LIMIT_KEY_INTERVAL = float(os.getenv('LIMIT_KEY_INTERVAL', 60))
+LIMIT_CLIENT_BURST = int(os.getenv('LIMIT_CLIENT_BURST', 20))
+LIMIT_CLIENT_INTERVAL = float(os.getenv('LIMIT_CLIENT_INTERVAL', 6))
+LIMIT_MAX_ENTRIES = int(os.getenv('LIMIT_MAX_ENTRIES', 100_000))
+LIMIT_REDIS_URL = os.getenv('LIMIT_REDIS_URL')
+SECRET_MAX_FAILED_ATTEMPTS = int(os.getenv('SECRET_MAX_FAILED_ATTEMPTS', 10))
+
+# Where secrets are kept. 'sql' uses DB_URL: Postgres, or SQLite through
+# sqlite+aiosqlite:// URLs for a single node (WAL mode is switched on);
+# 'sharded' several of those, see DB_SHARDS.
+# 'memory' keeps them in process memory in MEMORY_SHARDS dicts, expired
+# through timer wheels with MEMORY_WHEEL_RESOLUTION seconds per slot; it
+# needs no DB_URL but only works with a single worker.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sql')
+MEMORY_SHARDS = int(os.getenv('MEMORY_SHARDS', 16))
+MEMORY_WHEEL_RESOLUTION = float(os.getenv('MEMORY_WHEEL_RESOLUTION', 1))
+
+# STORAGE_BACKEND='sharded' spreads secrets over several databases.
+# DB_SHARDS names every shard as space separated name=url pairs, and keys
+# are placed on the names in DB_SHARD_RING (all of them by default) by
+# consistent hashing with DB_SHARD_VNODES points per shard. While shards
+# are added or drained DB_SHARD_PREVIOUS_RING holds the old ring, which
+# reads fall back to until python -m app.rebalance has moved every secret.
+DB_SHARDS = dict(
+    item.split('=', 1) for item in os.getenv('DB_SHARDS', '').split()
+)
+DB_SHARD_RING = os.getenv('DB_SHARD_RING', '').split() or list(DB_SHARDS)
+DB_SHARD_PREVIOUS_RING = os.getenv('DB_SHARD_PREVIOUS_RING', '').split()
+DB_SHARD_VNODES = int(os.getenv('DB_SHARD_VNODES', 64))
+
+# The SQL schema is migrated ahead of a rollout with
+# python -m app.migrations upgrade, and workers refuse to start on an
+# older schema. AUTO_MIGRATE lets every worker migrate at startup instead,
+# which is meant for development and single node setups.
+AUTO_MIGRATE = _get_bool('AUTO_MIGRATE', False)
+
+# Optional Postgres layout with the secrets and secret_chunks tables range
+# partitioned by created_at day, PARTITION_PREMAKE_DAYS days ahead. Keys
+# carry their creation time, so lookups hit one partition. Every secret
+# expires after at most SECRET_MAX_TTL seconds, and a day partition is
+# retired ('drop' or 'detach') once all of it is past that and the
+# consumed grace. Only for new databases.
+PARTITIONING_ENABLED = _get_bool('PARTITIONING_ENABLED', False)
+PARTITION_PREMAKE_DAYS = int(os.getenv('PARTITION_PREMAKE_DAYS', 3))
+PARTITION_RETIRE = os.getenv('PARTITION_RETIRE', 'drop')
+SECRET_MAX_TTL = int(os.getenv('SECRET_MAX_TTL', 7 * 24 * 3600))
+
+# Group commit for POST /generate: concurrent creates wait up to
+# WRITE_COALESCING_MAX_DELAY seconds, or until WRITE_COALESCING_MAX_BATCH
+# of them are queued, and are written with one multi-row INSERT
+WRITE_COALESCING_ENABLED = _get_bool('WRITE_COALESCING_ENABLED', False)
+WRITE_COALESCING_MAX_DELAY = float(
+    os.getenv('WRITE_COALESCING_MAX_DELAY', 0.002)
+)
+WRITE_COALESCING_MAX_BATCH = int(os.getenv('WRITE_COALESCING_MAX_BATCH', 100))
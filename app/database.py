@@ -1,25 +1,172 @@
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from dataclasses import replace
+import logging
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine
+)
 
 # from config import DB_URL
-from .config import DB_URL
-from .models import Base
+from . import metrics
+from .config import DATABASE, DatabaseSettings
+
+logger = logging.getLogger(__name__)
+
+
+def _asyncpg_connect_args(settings: DatabaseSettings) -> dict:
+    connect_args = {
+        'statement_cache_size': settings.statement_cache_size,
+        'prepared_statement_cache_size':
+            settings.prepared_statement_cache_size,
+        'server_settings': {'application_name': settings.application_name}
+    }
+    if settings.connection_statement_timeout:
+        connect_args['server_settings']['statement_timeout'] = str(
+            max(1, int(settings.connection_statement_timeout * 1000))
+        )
+    if settings.pgbouncer:
+        connect_args.update(
+            statement_cache_size=0,
+            prepared_statement_cache_size=0,
+            prepared_statement_name_func=(
+                lambda: f'__asyncpg_{uuid.uuid4()}__'
+            )
+        )
+    return connect_args
+
+
+def build_engine(settings: DatabaseSettings) -> AsyncEngine:
+    '''
+    Create the async engine described by settings
+    '''
+
+    url = make_url(settings.url)
+    kwargs = {
+        'pool_size': settings.pool_size,
+        'max_overflow': settings.max_overflow,
+        'pool_timeout': settings.pool_timeout,
+        'pool_recycle': settings.pool_recycle,
+        'pool_pre_ping': settings.pool_pre_ping
+    }
+    if url.get_driver_name() == 'asyncpg':
+        kwargs['connect_args'] = _asyncpg_connect_args(settings)
+    engine = create_async_engine(url, **kwargs)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', _sqlite_pragmas)
+    return engine
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the writer; chunks of streamed
+    # secrets are deleted through their foreign key
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
+
+
+def log_engine_settings(engine: AsyncEngine, settings: DatabaseSettings):
+    logger.info(
+        'Database %s: pool_size=%d max_overflow=%d pool_timeout=%ss '
+        'pool_recycle=%ss pre_ping=%s pgbouncer=%s statement_cache_size=%d',
+        engine.url.render_as_string(hide_password=True),
+        settings.pool_size,
+        settings.max_overflow,
+        settings.pool_timeout,
+        settings.pool_recycle,
+        settings.pool_pre_ping,
+        settings.pgbouncer,
+        0 if settings.pgbouncer else settings.statement_cache_size
+    )
+
 
-engine = create_async_engine(DB_URL)
+# The memory storage runs without a database
+engine = build_engine(DATABASE) if DATABASE.url else None
 
 async_session = async_sessionmaker(engine)
 
 
-def create_tables(sync_engine):
-    Base.metadata.create_all(bind=sync_engine)
+pool_size = metrics.gauge('db_pool_size', 'Configured pool size')
+pool_checked_out = metrics.gauge(
+    'db_pool_checked_out',
+    'Connections currently checked out of the pool'
+)
+pool_overflow = metrics.gauge(
+    'db_pool_overflow',
+    'Connections open beyond pool_size'
+)
+pool_checkouts = metrics.counter(
+    'db_pool_checkouts_total',
+    'Connections handed out by the pool'
+)
+pool_connects = metrics.counter(
+    'db_pool_connects_total',
+    'New database connections opened by the pool'
+)
+pool_timeouts = metrics.counter(
+    'db_pool_timeouts_total',
+    'Requests that gave up waiting for a pooled connection'
+)
+
+
+def _pool_stat(name: str):
+    def read():
+        if engine is None:
+            return 0
+        pool = engine.sync_engine.pool
+        return getattr(pool, name)() if hasattr(pool, name) else 0
+    return read
+
+
+pool_size.set_function(_pool_stat('size'))
+pool_checked_out.set_function(_pool_stat('checkedout'))
+pool_overflow.set_function(lambda: max(_pool_stat('overflow')(), 0))
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_checkouts.inc()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    pool_connects.inc()
+
+
+if engine is not None:
+    event.listen(engine.sync_engine, 'checkout', _on_checkout)
+    event.listen(engine.sync_engine, 'connect', _on_connect)
+
 
+def build_shard_engines(
+        urls: dict[str, str],
+        settings: DatabaseSettings | None = None
+) -> dict[str, AsyncEngine]:
+    '''
+    An engine for every shard in urls, with the pool settings of settings,
+    DATABASE by default
+    '''
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(create_tables)
+    settings = settings or DATABASE
+    engines = {}
+    for name, url in urls.items():
+        shard_engine = build_engine(replace(
+            settings,
+            url=url,
+            application_name=f'{settings.application_name}-{name}'
+        ))
+        event.listen(shard_engine.sync_engine, 'checkout', _on_checkout)
+        event.listen(shard_engine.sync_engine, 'connect', _on_connect)
+        engines[name] = shard_engine
+    return engines
 
 
 async def dispose_engine():
     await engine.dispose()
 
 if __name__ == '__main__':
-    print('done')
\ No newline at end of file
+    print('done')
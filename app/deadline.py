@@ -0,0 +1,210 @@
+'''
+Request deadlines and client disconnects.
+
+DeadlineMiddleware gives every request a budget of REQUEST_TIMEOUT
+seconds, or less if the client asks for less in REQUEST_TIMEOUT_HEADER.
+The budget starts once the request body has been received. Stages that
+wait, pool checkout, Postgres statements and the crypto queue, bound
+their wait by remaining() and give up with DeadlineExceeded. A handler
+still running when the budget is spent is cancelled, unless its response
+has started; a handler whose client disconnected is cancelled either way.
+'''
+
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+from fastapi.responses import JSONResponse
+
+from . import metrics
+from .config import REQUEST_TIMEOUT, REQUEST_TIMEOUT_HEADER
+
+deadlines_exceeded_total = metrics.counter(
+    'request_deadlines_exceeded_total',
+    'Requests abandoned because they ran out of their time budget'
+)
+disconnects_total = metrics.counter(
+    'request_client_disconnects_total',
+    'Requests abandoned because the client disconnected'
+)
+
+
+class DeadlineExceeded(Exception):
+    '''Raised when a request has run out of its time budget'''
+
+
+class _Budget:
+    __slots__ = ('at', 'gone')
+
+    def __init__(self) -> None:
+        self.at: float | None = None
+        self.gone = False
+
+
+_budget: ContextVar[_Budget | None] = ContextVar('budget', default=None)
+
+
+def remaining() -> float | None:
+    '''
+    Seconds left for the current request, None without a deadline
+    '''
+
+    budget = _budget.get()
+    if budget is None or budget.at is None:
+        return None
+    return budget.at - time.monotonic()
+
+
+def expires_at() -> float | None:
+    '''
+    time.monotonic() value of the current deadline, None without one
+    '''
+
+    budget = _budget.get()
+    return None if budget is None else budget.at
+
+
+def check() -> float | None:
+    '''
+    Raise DeadlineExceeded if the current request is out of time, else
+    return the seconds left
+    '''
+
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('Request deadline exceeded')
+    return left
+
+
+def client_gone() -> bool:
+    budget = _budget.get()
+    return budget is not None and budget.gone
+
+
+@contextmanager
+def scope(seconds: float | None):
+    '''
+    Run the block with a deadline seconds from now
+    '''
+
+    budget = _Budget()
+    if seconds is not None:
+        budget.at = time.monotonic() + seconds
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def _header_budget(scope: dict, name: bytes) -> float | None:
+    for key, value in scope.get('headers', ()):
+        if key.lower() == name:
+            try:
+                seconds = float(value)
+            except ValueError:
+                return None
+            return seconds if seconds > 0 else None
+    return None
+
+
+class DeadlineMiddleware:
+    '''
+    ASGI middleware enforcing the request budget and abandoning requests
+    whose client is gone. Requests out of time get a 504.
+    '''
+
+    def __init__(
+            self,
+            app,
+            timeout: float = REQUEST_TIMEOUT,
+            header: str = REQUEST_TIMEOUT_HEADER
+    ) -> None:
+        self.app = app
+        self.timeout = timeout
+        self.header = header.lower().encode()
+
+    def _seconds(self, scope: dict) -> float | None:
+        seconds = self.timeout or None
+        requested = _header_budget(scope, self.header)
+        if requested is not None:
+            seconds = min(seconds, requested) if seconds else requested
+        return seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        seconds = self._seconds(scope)
+        budget = _Budget()
+        started = finished = False
+        queue: asyncio.Queue = asyncio.Queue()
+        watcher: asyncio.Task | None = None
+
+        async def watch():
+            # only http.disconnect is left once the body is read
+            while True:
+                message = await receive()
+                queue.put_nowait(message)
+                if message['type'] == 'http.disconnect':
+                    # servers report one after every complete response
+                    if finished:
+                        return
+                    budget.gone = True
+                    disconnects_total.inc()
+                    timeout.reschedule(loop.time())
+                    return
+
+        def body_received():
+            nonlocal watcher
+            if seconds is not None and not started:
+                budget.at = time.monotonic() + seconds
+                timeout.reschedule(loop.time() + seconds)
+            watcher = asyncio.create_task(watch())
+
+        async def receive_wrapper():
+            if watcher is not None:
+                return await queue.get()
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                budget.gone = True
+            elif not message.get('more_body', False):
+                body_received()
+            return message
+
+        async def send_wrapper(message):
+            nonlocal started, finished
+            if message['type'] == 'http.response.start':
+                started = True
+                # a streamed response may take as long as it needs
+                budget.at = None
+                timeout.reschedule(None)
+            elif not message.get('more_body', False):
+                finished = True
+            await send(message)
+
+        token = _budget.set(budget)
+        try:
+            async with asyncio.timeout(None) as timeout:
+                if scope['method'] in ('GET', 'HEAD'):
+                    # nothing to read, the app never calls receive
+                    body_received()
+                await self.app(scope, receive_wrapper, send_wrapper)
+        except TimeoutError:
+            if not timeout.expired():
+                raise
+            if budget.gone or started:
+                return
+            deadlines_exceeded_total.inc()
+            response = JSONResponse(
+                status_code=504,
+                content={'detail': 'Request deadline exceeded'}
+            )
+            await response(scope, receive, send)
+        finally:
+            _budget.reset(token)
+            if watcher is not None:
+                watcher.cancel()
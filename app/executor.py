@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import deadline
+from . import metrics
+from .config import CRYPTO_EXECUTOR, CRYPTO_MAX_QUEUE, CRYPTO_MAX_WORKERS
+
+rejected_total = metrics.counter(
+    'crypto_executor_rejected_total',
+    'Crypto jobs rejected because the executor was saturated'
+)
+pending_jobs = metrics.gauge(
+    'crypto_executor_pending',
+    'Crypto jobs running or waiting for a worker'
+)
+
+
+class ExecutorSaturatedError(Exception):
+    '''Raised when the crypto executor has no room for another job'''
+
+
+def _run_before(expires_at: float, fn, *args):
+    # the monotonic clock is shared by the worker processes too
+    if time.monotonic() >= expires_at:
+        raise deadline.DeadlineExceeded('Deadline passed in the crypto queue')
+    return fn(*args)
+
+
+class CryptoExecutor:
+    '''
+    Bounded worker pool for CPU-heavy crypto calls.
+
+    At most max_workers jobs run at once and at most max_queue more may
+    wait for a free worker. Anything beyond that is rejected right away
+    with ExecutorSaturatedError instead of piling up behind the pool.
+    '''
+
+    def __init__(
+            self,
+            kind: str = 'thread',
+            max_workers: int = 1,
+            max_queue: int = 0
+    ) -> None:
+        if kind not in ('thread', 'process'):
+            raise ValueError(f'Unknown executor kind: {kind}')
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool: Executor | None = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.kind == 'process':
+                self._pool = ProcessPoolExecutor(self.max_workers)
+            else:
+                self._pool = ThreadPoolExecutor(
+                    self.max_workers,
+                    thread_name_prefix='crypto'
+                )
+        return self._pool
+
+    def _release(self, _future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args):
+        '''
+        Run fn(*args) in the pool and wait for the result. Under a request
+        deadline the job is skipped if it is still queued when it expires.
+        '''
+
+        deadline.check()
+        expires_at = deadline.expires_at()
+        if expires_at is not None:
+            fn, args = _run_before, (expires_at, fn, *args)
+        with self._lock:
+            if self._pending >= self.capacity:
+                rejected_total.inc()
+                raise ExecutorSaturatedError('Crypto executor is saturated')
+            self._pending += 1
+        try:
+            future = self._get_pool().submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+crypto_executor = CryptoExecutor(
+    kind=CRYPTO_EXECUTOR,
+    max_workers=CRYPTO_MAX_WORKERS,
+    max_queue=CRYPTO_MAX_QUEUE
+)
+
+pending_jobs.set_function(lambda: crypto_executor.pending)
@@ -0,0 +1,116 @@
+import hashlib
+import hmac
+
+from passlib.context import CryptContext
+from passlib.registry import register_crypt_handler
+from passlib.utils import handlers as uh
+
+from .config import (
+    HASH_ARGON2_MEMORY_COST,
+    HASH_ARGON2_PARALLELISM,
+    HASH_ARGON2_TIME_COST,
+    HASH_BCRYPT_ROUNDS,
+    HASH_FAST_TTL,
+    HASH_SCHEME,
+    PASSPHRASE_HMAC_KEY
+)
+
+SCHEMES = ['bcrypt', 'argon2', 'hmac_sha256']
+
+FAST_SCHEME = 'hmac_sha256'
+
+
+class hmac_sha256(uh.HasSalt, uh.GenericHandler):
+    '''
+    Salted HMAC-SHA256 keyed with a server side secret.
+
+    Much cheaper than bcrypt or argon2, so it is only meant for short lived
+    secrets: without the key a leaked hash can not be brute forced at all,
+    with the key it is as weak as a plain salted hash.
+    '''
+
+    name = 'hmac_sha256'
+    ident = '$hmac-sha256$'
+    setting_kwds = ('salt',)
+    checksum_chars = uh.LOWER_HEX_CHARS
+    checksum_size = 64
+    salt_chars = uh.LOWER_HEX_CHARS
+    min_salt_size = max_salt_size = default_salt_size = 32
+
+    key: bytes | None = None
+
+    @classmethod
+    def from_string(cls, hash):
+        salt, checksum = uh.parse_mc2(hash, cls.ident, handler=cls)
+        return cls(salt=salt, checksum=checksum)
+
+    def to_string(self) -> str:
+        return uh.render_mc2(self.ident, self.salt, self.checksum)
+
+    def _calc_checksum(self, secret) -> str:
+        if self.key is None:
+            raise RuntimeError('PASSPHRASE_HMAC_KEY is not configured')
+        if isinstance(secret, str):
+            secret = secret.encode()
+        return hmac.new(
+            self.key,
+            self.salt.encode() + secret,
+            hashlib.sha256
+        ).hexdigest()
+
+
+register_crypt_handler(hmac_sha256)
+
+
+def build_context(
+        default: str = 'bcrypt',
+        bcrypt_rounds: int = 12,
+        argon2_memory_cost: int = 19456,
+        argon2_time_cost: int = 2,
+        argon2_parallelism: int = 1
+) -> CryptContext:
+    '''
+    Build a context that hashes with default and verifies every known
+    scheme. Hashes of other schemes, or made with weaker settings, are
+    reported by needs_update.
+    '''
+
+    if default not in ('bcrypt', 'argon2'):
+        raise ValueError(f'Unknown hash scheme: {default}')
+    return CryptContext(
+        schemes=SCHEMES,
+        default=default,
+        deprecated=[
+            scheme for scheme in ('bcrypt', 'argon2') if scheme != default
+        ],
+        bcrypt__rounds=bcrypt_rounds,
+        bcrypt__min_rounds=bcrypt_rounds if default == 'bcrypt' else 4,
+        argon2__type='ID',
+        argon2__memory_cost=argon2_memory_cost,
+        argon2__time_cost=argon2_time_cost,
+        argon2__parallelism=argon2_parallelism
+    )
+
+
+def scheme_for_ttl(ttl: int | None) -> str | None:
+    '''
+    Scheme to hash a secret with the given ttl, None for the default one
+    '''
+
+    if ttl and HASH_FAST_TTL and ttl <= HASH_FAST_TTL:
+        return FAST_SCHEME
+    return None
+
+
+if PASSPHRASE_HMAC_KEY:
+    hmac_sha256.key = PASSPHRASE_HMAC_KEY.encode()
+elif HASH_FAST_TTL:
+    raise RuntimeError('HASH_FAST_TTL requires PASSPHRASE_HMAC_KEY')
+
+pwd_context = build_context(
+    default=HASH_SCHEME,
+    bcrypt_rounds=HASH_BCRYPT_ROUNDS,
+    argon2_memory_cost=HASH_ARGON2_MEMORY_COST,
+    argon2_time_cost=HASH_ARGON2_TIME_COST,
+    argon2_parallelism=HASH_ARGON2_PARALLELISM
+)
@@ -0,0 +1,124 @@
+'''
+Per request timing of the hot path stages.
+
+Code wraps a stage in ``with timed('stage'):``; the duration goes to the
+stage histogram and, when Server-Timing is on, to the current request's
+span list. With METRICS_ENABLED off, timed returns a shared no-op context
+manager and the middleware is not installed. Given a SlowRequestLog, the
+middleware also records requests slower than its threshold there.
+'''
+
+import asyncio
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from . import metrics
+from .config import METRICS_ENABLED, SERVER_TIMING_ENABLED
+
+stage_seconds = metrics.histogram(
+    'secret_stage_duration_seconds',
+    'Duration of request stages'
+)
+request_seconds = metrics.histogram(
+    'http_request_duration_seconds',
+    'Duration of HTTP requests by route'
+)
+requests_total = metrics.counter(
+    'http_requests_total',
+    'HTTP responses by route and status code'
+)
+
+spans: ContextVar[list | None] = ContextVar('spans', default=None)
+
+_NOOP = nullcontext()
+
+
+class _Timer:
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+
+    def __enter__(self) -> '_Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, stage=self.stage)
+        request_spans = spans.get()
+        if request_spans is not None:
+            request_spans.append((self.stage, elapsed))
+
+
+def timed(stage: str):
+    '''
+    Context manager timing one stage of the current request
+    '''
+
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Timer(stage)
+
+
+def server_timing(request_spans: list) -> bytes:
+    return ', '.join(
+        f'{stage};dur={elapsed * 1000:.2f}'
+        for stage, elapsed in request_spans
+    ).encode()
+
+
+class InstrumentationMiddleware:
+    '''
+    ASGI middleware counting responses and timing requests per route
+    '''
+
+    def __init__(
+            self,
+            app,
+            server_timing: bool = SERVER_TIMING_ENABLED,
+            slow_requests=None
+    ):
+        self.app = app
+        self.server_timing = server_timing
+        self.slow_requests = slow_requests
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_spans = []
+        token = spans.set(request_spans)
+        started = time.perf_counter()
+        status = 500
+        watch = None
+        if self.slow_requests is not None:
+            watch = self.slow_requests.watch(asyncio.current_task())
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self.server_timing and request_spans:
+                    message['headers'] = [
+                        *message.get('headers', []),
+                        (b'server-timing', server_timing(request_spans))
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            path = getattr(route, 'path', 'unmatched')
+            elapsed = time.perf_counter() - started
+            request_seconds.observe(elapsed, route=path)
+            requests_total.inc(route=path, status=status)
+            if watch is not None:
+                self.slow_requests.record(
+                    watch, scope['method'], path, status, elapsed,
+                    request_spans
+                )
+            spans.reset(token)
@@ -0,0 +1,197 @@
+'''
+Token bucket limits on failed passphrase attempts
+'''
+
+import math
+import time
+from collections import OrderedDict
+
+from . import metrics
+from .config import (
+    LIMIT_CLIENT_BURST,
+    LIMIT_CLIENT_INTERVAL,
+    LIMIT_ENABLED,
+    LIMIT_KEY_BURST,
+    LIMIT_KEY_INTERVAL,
+    LIMIT_MAX_ENTRIES,
+    LIMIT_REDIS_URL
+)
+
+rejected_total = metrics.counter(
+    'attempts_rejected_total',
+    'Secret reads rejected by the attempt limiter'
+)
+failures_total = metrics.counter(
+    'attempts_failed_total',
+    'Wrong passphrases recorded by the attempt limiter'
+)
+evictions_total = metrics.counter(
+    'attempts_evictions_total',
+    'Buckets evicted from the in-memory attempt limiter to stay within its size'
+)
+
+
+class TooManyAttemptsError(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__('Too many failed attempts')
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    '''
+    Buckets of this process in a bounded LRU.
+
+    Full buckets are not stored, so only keys and clients with recent
+    failures take memory. Evicting a bucket forgets its failures.
+    '''
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def take(
+            self,
+            key: str,
+            capacity: int,
+            interval: float,
+            cost: int
+    ) -> float:
+        '''
+        Take cost tokens from the bucket and return what is left
+        '''
+
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) / interval) - cost
+        if tokens >= capacity:
+            self._buckets.pop(key, None)
+            return tokens
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+            evictions_total.inc()
+        return tokens
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+class RedisBackend:
+    '''
+    Buckets shared by all workers through redis
+    '''
+
+    # Returns a string, redis truncates Lua numbers to integers
+    SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) / interval) - cost
+if tokens >= capacity then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity * interval))
+end
+return tostring(tokens)
+'''
+
+    def __init__(self, url: str, prefix: str = 'secret:attempts:') -> None:
+        import redis.asyncio
+
+        self.prefix = prefix
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    async def take(
+            self,
+            key: str,
+            capacity: int,
+            interval: float,
+            cost: int
+    ) -> float:
+        tokens = await self._script(
+            keys=[self.prefix + key],
+            args=[capacity, interval, cost, time.time()]
+        )
+        return float(tokens)
+
+
+class AttemptLimiter:
+    '''
+    Failed attempts per secret key and per client.
+
+    check() is cheap and runs before anything touches the database or the
+    KDF, so a flood of wrong passphrases is answered with 429 instead of
+    bcrypt runs.
+    '''
+
+    def __init__(
+            self,
+            backend,
+            key_burst: int,
+            key_interval: float,
+            client_burst: int,
+            client_interval: float
+    ) -> None:
+        self.backend = backend
+        self._limits = {
+            'key': (key_burst, key_interval),
+            'client': (client_burst, client_interval),
+        }
+
+    def _buckets(self, secret_key: str, client: str | None):
+        yield 'key', secret_key
+        if client:
+            yield 'client', client
+
+    async def check(self, secret_key: str, client: str | None) -> None:
+        '''
+        Raise TooManyAttemptsError if the key or the client is out of
+        attempts
+        '''
+
+        retry_after = 0.0
+        for scope, name in self._buckets(secret_key, client):
+            capacity, interval = self._limits[scope]
+            tokens = await self.backend.take(
+                f'{scope}:{name}', capacity, interval, 0
+            )
+            if tokens < 1:
+                rejected_total.inc(scope=scope)
+                retry_after = max(retry_after, (1 - tokens) * interval)
+        if retry_after:
+            raise TooManyAttemptsError(retry_after)
+
+    async def record_failure(self, secret_key: str, client: str | None) -> None:
+        failures_total.inc()
+        for scope, name in self._buckets(secret_key, client):
+            capacity, interval = self._limits[scope]
+            await self.backend.take(f'{scope}:{name}', capacity, interval, 1)
+
+
+def retry_after_header(exc: TooManyAttemptsError) -> str:
+    return str(max(1, math.ceil(exc.retry_after)))
+
+
+def _backend():
+    if LIMIT_REDIS_URL:
+        return RedisBackend(LIMIT_REDIS_URL)
+    return MemoryBackend(LIMIT_MAX_ENTRIES)
+
+
+attempt_limiter = AttemptLimiter(
+    _backend(),
+    LIMIT_KEY_BURST,
+    LIMIT_KEY_INTERVAL,
+    LIMIT_CLIENT_BURST,
+    LIMIT_CLIENT_INTERVAL
+) if LIMIT_ENABLED else None
@@ -1,26 +1,306 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, UTC
-from contextlib import asynccontextmanager
+from functools import partial
+import hmac
+import os
 
-from fastapi import FastAPI, HTTPException
+from typing import AsyncIterator, Optional
 
-import schemas as shm
-import utils
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse
+)
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from app import deadline
+from app import metrics
+from app import profiling
+from app import receipts
+from app import schemas as shm
+from app import streaming
+from app import utils
+from app.cipher import StreamDecryptor
+from app.config import (
+    ADMIN_TOKEN,
+    METRICS_ENABLED,
+    PROFILE_MAX_SECONDS,
+    READ_RECEIPTS_ENABLED,
+    REAPER_ENABLED,
+    RECEIPT_STATUS_MAX_WAIT,
+    RESPONSE_GZIP_MIN_SIZE,
+    SECRET_MAX_FAILED_ATTEMPTS,
+    SLOW_REQUEST_THRESHOLD,
+    STREAM_MAX_SIZE
+)
+from app.reaper import run_reaper
 from app.repositories import secret_repository as secret_db
-from database import init_db, dispose_engine
+from app.database import pool_timeouts
+from app.deadline import DeadlineMiddleware
+from app.executor import crypto_executor, ExecutorSaturatedError
+from app.instrumentation import InstrumentationMiddleware
+from app.limiter import (
+    TooManyAttemptsError,
+    attempt_limiter,
+    retry_after_header
+)
+from app.negative_cache import CONSUMED, EXPIRED, MISSING, negative_cache
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
-    print('Database is successfully initiated')
+    await secret_db.init_storage()
+    print('Storage is successfully initiated')
+    # app.server runs the reaper and the receipt dispatcher in its first
+    # worker only
+    background = getattr(app.state, 'background_tasks', True)
+    tasks = []
+    if REAPER_ENABLED and background:
+        tasks.append(asyncio.create_task(run_reaper()))
+    if READ_RECEIPTS_ENABLED:
+        tasks.append(asyncio.create_task(receipts.run_receipts(background)))
 
     yield
 
-    await dispose_engine()
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await secret_db.close_storage()
+    crypto_executor.shutdown()
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    '''
+    JSON response rendered by orjson when it is installed.
+
+    Hot endpoints return it directly: their payload is known to match the
+    response model, so FastAPI's validation and serialization are skipped.
+    '''
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+# background writes once a response is over: releases of claims that
+# could not be delivered and reads of the ones that were
+_after_response: set[asyncio.Task] = set()
+
+undelivered_total = metrics.counter(
+    'secrets_undelivered_total',
+    'Claimed secrets released because the response was not delivered'
+)
+
+
+def _in_background(write) -> asyncio.Task:
+    task = asyncio.ensure_future(write)
+    _after_response.add(task)
+    task.add_done_callback(_after_response.discard)
+    return task
+
+
+def _release_later(secret_key: str) -> asyncio.Task:
+    negative_cache.discard(secret_key)
+    return _in_background(secret_db.release_secret(secret_key))
+
+
+class _ClaimDelivery:
+    '''
+    Response mixin for a claimed secret: unless the whole body is handed
+    to a client that is still connected, the claim is released and the
+    secret stays readable. Otherwise the read is recorded, which makes it
+    final and is when its read receipt becomes due.
+    '''
+
+    secret_key: str
+
+    async def __call__(self, scope, receive, send):
+        delivered = False
+
+        async def send_tracked(message):
+            nonlocal delivered
+            await send(message)
+            if (
+                message['type'] == 'http.response.body'
+                and not message.get('more_body', False)
+            ):
+                delivered = not deadline.client_gone()
+
+        try:
+            await super().__call__(scope, receive, send_tracked)
+        finally:
+            if not delivered:
+                undelivered_total.inc()
+                await asyncio.shield(_release_later(self.secret_key))
+            else:
+                await asyncio.shield(_in_background(
+                    secret_db.mark_secret_read(self.secret_key)
+                ))
+
+
+class SecretResponse(_ClaimDelivery, FastJSONResponse):
+    def __init__(self, secret_key: str, content) -> None:
+        super().__init__(content)
+        self.secret_key = secret_key
+
+
+class SecretStreamResponse(_ClaimDelivery, StreamingResponse):
+    def __init__(self, secret_key: str, content) -> None:
+        super().__init__(content, media_type='application/octet-stream')
+        self.secret_key = secret_key
 
 
 app = FastAPI(lifespan=lifespan)
 
+app.add_middleware(DeadlineMiddleware)
+
+if RESPONSE_GZIP_MIN_SIZE:
+    app.add_middleware(GZipMiddleware, minimum_size=RESPONSE_GZIP_MIN_SIZE)
+
+if METRICS_ENABLED:
+    app.add_middleware(
+        InstrumentationMiddleware,
+        slow_requests=(
+            profiling.slow_requests if SLOW_REQUEST_THRESHOLD else None
+        )
+    )
+
+
+@app.exception_handler(ExecutorSaturatedError)
+async def executor_saturated_handler(
+    request: Request,
+    exc: ExecutorSaturatedError
+):
+    return JSONResponse(
+        status_code=503,
+        content={'detail': 'Server is busy, try again later'},
+        headers={'Retry-After': '1'}
+    )
+
+
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded_handler(
+    request: Request,
+    exc: deadline.DeadlineExceeded
+):
+    deadline.deadlines_exceeded_total.inc()
+    return JSONResponse(
+        status_code=504,
+        content={'detail': 'Request deadline exceeded'}
+    )
+
+
+@app.exception_handler(TooManyAttemptsError)
+async def too_many_attempts_handler(
+    request: Request,
+    exc: TooManyAttemptsError
+):
+    return JSONResponse(
+        status_code=429,
+        content={'detail': 'Too many failed attempts, try again later'},
+        headers={'Retry-After': retry_after_header(exc)}
+    )
+
+
+@app.exception_handler(streaming.SecretTooLargeError)
+async def secret_too_large_handler(
+    request: Request,
+    exc: streaming.SecretTooLargeError
+):
+    return JSONResponse(status_code=413, content={'detail': str(exc)})
+
+
+@app.exception_handler(PoolTimeoutError)
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    pool_timeouts.inc()
+    return JSONResponse(
+        status_code=503,
+        content={'detail': 'Database is busy, try again later'},
+        headers={'Retry-After': '1'}
+    )
+
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    '''
+    Export metrics in the Prometheus text format
+    '''
+
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+def _require_admin(authorization: str | None = Header(None)) -> None:
+    '''
+    Admin endpoints do not exist without ADMIN_TOKEN and need it as a
+    bearer token
+    '''
+
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail='Not Found')
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(
+        token.encode(), ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(
+            status_code=401,
+            detail='Invalid admin token',
+            headers={'WWW-Authenticate': 'Bearer'}
+        )
+
+
+@app.post(
+    '/admin/profile',
+    dependencies=[Depends(_require_admin)],
+    include_in_schema=False
+)
+async def profile(
+    seconds: float = Query(1, gt=0, le=PROFILE_MAX_SECONDS)
+):
+    '''
+    Sample the worker serving the request for seconds and return the
+    collapsed stacks. Every worker is profiled on its own.
+    '''
+
+    try:
+        stacks = await profiling.profiler.profile(seconds)
+    except profiling.ProfilerBusyError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return PlainTextResponse(
+        profiling.collapsed(stacks),
+        headers={'X-Worker-Pid': str(os.getpid())}
+    )
+
+
+@app.get(
+    '/admin/slow-requests',
+    dependencies=[Depends(_require_admin)],
+    include_in_schema=False
+)
+async def get_slow_requests():
+    '''
+    The slow requests recorded by the worker serving the request
+    '''
+
+    return JSONResponse(
+        {
+            'threshold': SLOW_REQUEST_THRESHOLD,
+            'requests': profiling.slow_requests.entries()
+        },
+        headers={'X-Worker-Pid': str(os.getpid())}
+    )
+
 
 @app.post('/generate', response_model=shm.SecretKeyResponse)
 async def generate_secret(
@@ -31,29 +311,266 @@ async def generate_secret(
     '''
 
     secret_key = await secret_db.create_secret(secret)
+    return FastJSONResponse({'secret_key': secret_key})
+
+
+@app.post('/generate/batch', response_model=shm.SecretBatchResponse)
+async def generate_secrets(batch: shm.SecretBatchCreate):
+    '''
+    Generate secret keys for many one-time secrets at once.
+    Every item gets either its secret key or an error.
+    '''
+
+    results = []
+    created = await secret_db.create_secrets(batch.secrets)
+    for index, result in enumerate(created):
+        if isinstance(result, ExecutorSaturatedError):
+            results.append({'index': index, 'error': 'Server is busy'})
+        elif isinstance(result, Exception):
+            results.append({'index': index, 'error': 'Failed to create secret'})
+        else:
+            results.append({'index': index, 'secret_key': result})
+    return {'results': results}
+
+
+@app.post('/generate/stream', response_model=shm.SecretKeyResponse)
+async def generate_secret_stream(
+    request: Request,
+    passphrase: str,
+    ttl: Optional[int] = None,
+    callback_url: Optional[str] = Query(None, max_length=2048)
+):
+    '''
+    Generate secret key for a one-time secret sent as the raw request
+    body. The body is encrypted and stored chunk by chunk.
+    '''
+
+    try:
+        callback_url = shm.check_callback_url(callback_url)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+    content_length = request.headers.get('content-length')
+    if content_length and not content_length.isdigit():
+        raise HTTPException(status_code=400, detail='Invalid Content-Length')
+    if content_length and int(content_length) > STREAM_MAX_SIZE:
+        raise streaming.SecretTooLargeError(
+            f'Secret is larger than {STREAM_MAX_SIZE} bytes'
+        )
+    secret_key = await secret_db.create_stream_secret(
+        passphrase, ttl, request.stream(), callback_url
+    )
     return {'secret_key': secret_key}
 
 
-@app.get('/secrets/{secret_key}', response_model=shm.SecretResponse)
-async def get_secret(secret_key: str, passphrase: str):
+_STATE_ERRORS = {
+    MISSING: (404, 'Secret not found'),
+    CONSUMED: (410, 'Secret has already been consumed'),
+    EXPIRED: (410, 'Secret has expired'),
+}
+
+
+def _raise_for_state(state: str) -> None:
+    status_code, detail = _STATE_ERRORS[state]
+    raise HTTPException(status_code=status_code, detail=detail)
+
+
+async def _unavailable_state(secret_key: str) -> str | None:
     '''
-    Recieve and decrypt a one-time secret usinfg secret key and passphrase
+    Explain why a secret could not be claimed; None if it looks claimable,
+    e.g. when a concurrent claim was released in between.
+    Missing and expired keys are remembered in the negative cache. A
+    consumed secret is gone only once it has been read or locked; until
+    then the claim may still be released, e.g. after a wrong passphrase.
     '''
 
-    password_mgr = utils.PasswordManager()
-    secret_mgr = utils.SecretManager(passphrase)
     secret = await secret_db.get_secret(secret_key)
     if not secret:
-        raise HTTPException(status_code=404, detail='Secret not found')
+        negative_cache.add(secret_key, MISSING)
+        return MISSING
     if secret.consumed:
+        if secret.read_at is not None or (
+            SECRET_MAX_FAILED_ATTEMPTS
+            and secret.failed_attempts >= SECRET_MAX_FAILED_ATTEMPTS
+        ):
+            return CONSUMED
+        return None
+    expires_at = secret.expires_at
+    if expires_at is not None and expires_at.tzinfo is None:
+        # SQLite gives back the stored UTC times without their zone
+        expires_at = expires_at.replace(tzinfo=UTC)
+    if expires_at is not None and expires_at <= datetime.now(UTC):
+        negative_cache.add(secret_key, EXPIRED)
+        return EXPIRED
+    return None
+
+
+async def _claim(secret_key: str):
+    claim = asyncio.ensure_future(secret_db.consume_secret(secret_key))
+    try:
+        return await asyncio.shield(claim)
+    except asyncio.CancelledError:
+        # the claim may still be made after the request is abandoned
+        claim.add_done_callback(partial(_release_claimed, secret_key))
+        raise
+
+
+class InvalidPassphraseError(HTTPException):
+    def __init__(self) -> None:
+        super().__init__(status_code=403, detail='Invalid passphrase')
+
+
+def _client(request: Request) -> str | None:
+    # the forwarded address when the proxy is trusted, see
+    # FORWARDED_ALLOW_IPS
+    return request.client.host if request.client else None
+
+
+@asynccontextmanager
+async def _claimed_secret(secret_key: str, client: str | None):
+    '''
+    Claim a secret for the duration of the block.
+
+    The secret is claimed first, so concurrent readers can not both get it.
+    If anything in the block fails, e.g. the passphrase check, the claim is
+    released and the secret stays readable with the right passphrase.
+    Keys known to be unreadable, and keys or clients out of attempts, are
+    rejected without touching the database.
+    '''
+
+    cached_state = negative_cache.get(secret_key)
+    if cached_state:
+        _raise_for_state(cached_state)
+    if attempt_limiter is not None:
+        await attempt_limiter.check(secret_key, client)
+    deadline.check()
+    # a secret that is neither gone nor expired may have been released by
+    # a concurrent reader between the claim and the lookup: claim it again,
+    # and ask to retry while someone else's claim is still in flight
+    for _ in range(2):
+        secret = await _claim(secret_key)
+        if secret:
+            break
+        state = await _unavailable_state(secret_key)
+        if state:
+            _raise_for_state(state)
+    else:
+        raise HTTPException(
+            status_code=409,
+            detail='Secret is being read, try again',
+            headers={'Retry-After': '1'}
+        )
+    try:
+        yield secret
+    except InvalidPassphraseError:
+        await secret_db.release_secret(
+            secret_key,
+            failed=True,
+            max_failed_attempts=SECRET_MAX_FAILED_ATTEMPTS
+        )
+        if attempt_limiter is not None:
+            await attempt_limiter.record_failure(secret_key, client)
+        raise
+    except BaseException:
+        await secret_db.release_secret(secret_key)
+        raise
+    negative_cache.add(secret_key, CONSUMED)
+
+
+def _release_claimed(secret_key: str, claim: asyncio.Future) -> None:
+    if not claim.cancelled() and claim.exception() is None and claim.result():
+        _release_later(secret_key)
+
+
+async def _verify_passphrase(passphrase: str, passphrase_hash: str) -> None:
+    password_mgr = utils.PasswordManager()
+    if not await password_mgr.verify_password_async(
+        passphrase, passphrase_hash
+    ):
+        raise InvalidPassphraseError()
+
+
+@app.get(
+    '/secrets/{secret_key}/status',
+    response_model=shm.SecretStatusResponse
+)
+async def get_secret_status(
+    secret_key: str,
+    wait: float = Query(0, ge=0, le=RECEIPT_STATUS_MAX_WAIT)
+):
+    '''
+    Whether a one-time secret has been read, without reading it. While it
+    is unread the answer is held up to wait seconds for it to be read.
+    '''
+
+    if not READ_RECEIPTS_ENABLED:
         raise HTTPException(
-            status_code=410,
-            detail='Secret has already been consumed'
+            status_code=404,
+            detail='Read receipts are disabled'
         )
-    if secret.expires_at and secret.expires_at < datetime.now(UTC):
-        raise HTTPException(status_code=410, detail='Secret has expired')
-    if not password_mgr.verify_password(passphrase, secret.passphrase_hash):
-        raise HTTPException(status_code=403, detail='Invalid passphrase')
-    decrypted_secret = secret_mgr.decrypt_secret(secret.secret_data)
-    await secret_db.make_consume_mark(secret)
-    return {'secret': decrypted_secret}
+    left = deadline.remaining()
+    if left is not None:
+        # answer with the current status rather than a 504
+        wait = min(wait, max(left - 1, 0))
+    status = await receipts.secret_status(secret_key, wait)
+    if status is None:
+        _raise_for_state(MISSING)
+    return status
+
+
+@app.get('/secrets/{secret_key}', response_model=shm.SecretResponse)
+async def get_secret(request: Request, secret_key: str, passphrase: str):
+    '''
+    Recieve and decrypt a one-time secret usinfg secret key and passphrase
+    '''
+
+    async with _claimed_secret(secret_key, _client(request)) as secret:
+        if secret.is_stream:
+            raise HTTPException(
+                status_code=409,
+                detail='Secret is streamed, read it from /stream'
+            )
+        await _verify_passphrase(passphrase, secret.passphrase_hash)
+        secret_mgr = utils.SecretManager(passphrase)
+        decrypted_secret = await secret_mgr.decrypt_secret_async(
+            secret.secret_data
+        )
+    return SecretResponse(secret_key, {'secret': decrypted_secret})
+
+
+async def _decrypt_chunks(
+    decryptor: StreamDecryptor,
+    secret_key: str,
+    secret_id: str
+) -> AsyncIterator[bytes]:
+    chunks = secret_db.iter_secret_chunks(secret_key, secret_id)
+    async for data, last in streaming.with_last(chunks):
+        yield decryptor.decrypt_chunk(data, last)
+    # no chunks at all, or the stored last one was not marked as such
+    decryptor.finish()
+
+
+@app.get('/secrets/{secret_key}/stream')
+async def get_secret_stream(
+    request: Request,
+    secret_key: str,
+    passphrase: str
+):
+    '''
+    Recieve a one-time secret as a stream of raw bytes, decrypted chunk
+    by chunk. Secrets created by /generate can be read this way too.
+    '''
+
+    async with _claimed_secret(secret_key, _client(request)) as secret:
+        await _verify_passphrase(passphrase, secret.passphrase_hash)
+        secret_mgr = utils.SecretManager(passphrase)
+        if secret.is_stream:
+            decryptor = await secret_mgr.stream_decryptor_async(
+                secret.secret_data
+            )
+            body = _decrypt_chunks(decryptor, secret_key, secret.id)
+        else:
+            body = iter([
+                await secret_mgr.decrypt_bytes_async(secret.secret_data)
+            ])
+    return SecretStreamResponse(secret_key, body)
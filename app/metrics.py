@@ -0,0 +1,175 @@
+'''
+Minimal in-process metrics exported in the Prometheus text format
+'''
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, float] = {}
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, dict(key), value
+
+    def render(self) -> list[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function) -> None:
+        '''
+        Compute the value on every scrape instead of storing it
+        '''
+
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, {}, self._function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (
+        .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+    )
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            buckets: tuple = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0, 0]
+        counts = state[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def get(self, **labels) -> float:
+        '''
+        Number of observations
+        '''
+
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield (
+                    f'{self.name}_bucket',
+                    {**labels, 'le': _format_value(bound)},
+                    bucket_count
+                )
+            yield f'{self.name}_bucket', {**labels, 'le': '+Inf'}, count
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name: str, documentation: str) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation))
+
+
+def histogram(
+        name: str,
+        documentation: str,
+        buckets: tuple = Histogram.DEFAULT_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,207 @@
+'''
+Versioned schema migrations.
+
+Run them once per deploy, before the new code starts:
+
+    python -m app.migrations upgrade
+
+Workers only compare the version in schema_version with the latest one
+here at startup, unless AUTO_MIGRATE is set. A new database is created
+from the models and stamped with the latest version; a database from
+before versioning runs every migration, which is why they all tolerate
+changes that are already in place. On Postgres runners serialize on an
+advisory lock, so concurrent ones wait and then find nothing to do.
+'''
+
+import logging
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    insert,
+    select,
+    text
+)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import partitions
+from app.models import Base
+
+from . import (
+    v0001_reaper_columns,
+    v0002_secret_data_bytea,
+    v0003_streamed_secrets,
+    v0004_failed_attempts,
+    v0005_chunk_created_at,
+    v0006_uuid_columns,
+    v0007_read_receipts
+)
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    (1, v0001_reaper_columns),
+    (2, v0002_secret_data_bytea),
+    (3, v0003_streamed_secrets),
+    (4, v0004_failed_attempts),
+    (5, v0005_chunk_created_at),
+    (6, v0006_uuid_columns),
+    (7, v0007_read_receipts),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+# any constant shared by all runners
+ADVISORY_LOCK_KEY = 0x5ec2e7
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version',
+    metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column(
+        'applied_at',
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+)
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def _name(module) -> str:
+    return module.__name__.rsplit('.', 1)[-1]
+
+
+def configured_engines() -> list[AsyncEngine]:
+    '''
+    New engines of every database the configured storage uses, without
+    the statement_timeout of the application connections, which long
+    migrations would hit
+    '''
+
+    from dataclasses import replace
+
+    from app import database as db
+    from app.config import DB_SHARDS, STORAGE_BACKEND
+
+    settings = replace(db.DATABASE, statement_timeout=0)
+    if STORAGE_BACKEND == 'sharded':
+        return list(db.build_shard_engines(DB_SHARDS, settings).values())
+    return [db.build_engine(settings)] if settings.url else []
+
+
+async def current_version(engine: AsyncEngine) -> int | None:
+    '''
+    Latest applied version, None if the database is not versioned
+    '''
+
+    async with engine.connect() as conn:
+        exists = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table('schema_version')
+        )
+        if not exists:
+            return None
+        version = await conn.scalar(
+            select(func.max(schema_version.c.version))
+        )
+    return version or 0
+
+
+async def verify(engine: AsyncEngine) -> None:
+    '''
+    Fail unless the schema is at least at HEAD. A newer schema is fine,
+    it belongs to a rollout of newer code.
+    '''
+
+    version = await current_version(engine)
+    if version is None or version < HEAD:
+        raise SchemaVersionError(
+            f'Database schema is at version {version}, this code needs '
+            f'{HEAD}; run python -m app.migrations upgrade'
+        )
+    if version > HEAD:
+        logger.warning(
+            'Database schema version %d is newer than %d', version, HEAD
+        )
+
+
+async def _create(engine: AsyncEngine, partitioned: bool) -> None:
+    async with engine.begin() as conn:
+        if partitioned:
+            await partitions.setup(conn)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(metadata.create_all)
+        await conn.execute(insert(schema_version), [
+            {'version': version, 'name': _name(module)}
+            for version, module in MIGRATIONS
+        ])
+
+
+async def _upgrade(
+        engine: AsyncEngine,
+        partitioned: bool,
+        batch_size: int
+) -> list[int]:
+    async with engine.connect() as conn:
+        has_secrets = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table('secrets')
+        )
+    if not has_secrets:
+        await _create(engine, partitioned)
+        logger.info('Created schema version %d', HEAD)
+        return [version for version, _ in MIGRATIONS]
+
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    version = await current_version(engine)
+    applied = []
+    for target, module in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info('Applying migration %d %s', target, _name(module))
+        await module.upgrade(engine, batch_size)
+        async with engine.begin() as conn:
+            await conn.execute(
+                insert(schema_version),
+                {'version': target, 'name': _name(module)}
+            )
+        applied.append(target)
+    return applied
+
+
+async def upgrade(
+        engine: AsyncEngine,
+        partitioned: bool = False,
+        batch_size: int = 1000
+) -> list[int]:
+    '''
+    Bring the schema to HEAD and return the versions applied
+    '''
+
+    if engine.dialect.name != 'postgresql':
+        return await _upgrade(engine, partitioned, batch_size)
+    # a session level lock, held on its own connection while migrations
+    # use others
+    async with engine.connect() as lock:
+        await lock.execute(
+            text('SELECT pg_advisory_lock(:key)'),
+            {'key': ADVISORY_LOCK_KEY}
+        )
+        try:
+            return await _upgrade(engine, partitioned, batch_size)
+        finally:
+            await lock.execute(
+                text('SELECT pg_advisory_unlock(:key)'),
+                {'key': ADVISORY_LOCK_KEY}
+            )
@@ -0,0 +1,53 @@
+import argparse
+import asyncio
+import logging
+
+from app.config import PARTITIONING_ENABLED
+from app.repositories.sql_storage import SqlStorage
+
+from . import HEAD, configured_engines, current_version, upgrade
+
+
+async def _run(command: str, batch_size: int) -> None:
+    # every shard when secrets are sharded
+    for engine in configured_engines():
+        database = engine.url.render_as_string(hide_password=True)
+        try:
+            if command == 'status':
+                version = await current_version(engine)
+                print(f'{database}: schema version {version}, latest {HEAD}')
+                continue
+            applied = await upgrade(engine, PARTITIONING_ENABLED, batch_size)
+            # workers only maintain partitions from the reaper, so the
+            # ones new code writes to exist before it starts
+            await SqlStorage(engine, PARTITIONING_ENABLED).maintain()
+            print(f'{database}: applied {applied or "nothing"}, '
+                  f'schema version {HEAD}')
+        finally:
+            await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m app.migrations',
+        description='Apply or inspect schema migrations'
+    )
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=['upgrade', 'status'],
+        default='upgrade'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='rows per transaction in data migrations'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(args.command, args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
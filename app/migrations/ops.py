@@ -0,0 +1,34 @@
+'''
+Helpers for migrations that must work on databases created by any
+earlier release, with or without the change already in place
+'''
+
+from sqlalchemy import Column, inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.schema import CreateColumn
+
+
+def is_postgres(conn: AsyncConnection) -> bool:
+    return conn.dialect.name == 'postgresql'
+
+
+async def column_names(conn: AsyncConnection, table: str) -> set[str]:
+    columns = await conn.run_sync(
+        lambda sync_conn: inspect(sync_conn).get_columns(table)
+    )
+    return {column['name'] for column in columns}
+
+
+async def add_column(
+        conn: AsyncConnection,
+        table: str,
+        column: Column
+) -> None:
+    '''
+    Add column to table unless it is there already
+    '''
+
+    if column.name in await column_names(conn, table):
+        return
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    await conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {ddl}'))
@@ -0,0 +1,30 @@
+'''
+consumed_at and the partial indexes the reaper scans
+'''
+
+from sqlalchemy import Column, DateTime, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+INDEXES = [
+    '''
+    CREATE INDEX IF NOT EXISTS ix_secrets_expires_at_live ON secrets
+    (expires_at) WHERE consumed IS false AND expires_at IS NOT NULL
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS ix_secrets_consumed_at ON secrets
+    (consumed_at) WHERE consumed IS true
+    ''',
+]
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        await ops.add_column(
+            conn,
+            'secrets',
+            Column('consumed_at', DateTime(timezone=True), nullable=True)
+        )
+        for statement in INDEXES:
+            await conn.execute(text(statement))
@@ -0,0 +1,72 @@
+'''
+secret_data from base64 text to BYTEA (Postgres).
+
+Rows are converted into a new column in short batches, so the table stays
+writable while the bulk of the work is done. Only the final swap takes an
+exclusive lock, to convert rows written meanwhile and rename the column.
+Legacy Fernet tokens keep their ASCII text as bytes, versioned envelopes
+are base64 decoded to raw bytes.
+'''
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+CONVERT = '''
+    CASE WHEN secret_data LIKE 'gAAAAA%'
+        THEN convert_to(secret_data, 'UTF8')
+        ELSE decode(translate(secret_data, '-_', '+/'), 'base64')
+    END
+'''
+
+ADD_COLUMN = text(
+    'ALTER TABLE secrets ADD COLUMN IF NOT EXISTS secret_data_bin BYTEA'
+)
+
+CONVERT_BATCH = text(f'''
+    UPDATE secrets SET secret_data_bin = {CONVERT}
+    WHERE id IN (
+        SELECT id FROM secrets
+        WHERE secret_data_bin IS NULL
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+''')
+
+SWAP = [
+    text('LOCK TABLE secrets IN ACCESS EXCLUSIVE MODE'),
+    text(
+        f'UPDATE secrets SET secret_data_bin = {CONVERT} '
+        'WHERE secret_data_bin IS NULL'
+    ),
+    text('ALTER TABLE secrets DROP COLUMN secret_data'),
+    text('ALTER TABLE secrets RENAME COLUMN secret_data_bin TO secret_data'),
+    text('ALTER TABLE secrets ALTER COLUMN secret_data SET NOT NULL'),
+]
+
+COLUMN_TYPE = text('''
+    SELECT data_type FROM information_schema.columns
+    WHERE table_name = 'secrets' AND column_name = 'secret_data'
+''')
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        if not ops.is_postgres(conn):
+            return
+        if await conn.scalar(COLUMN_TYPE) == 'bytea':
+            return
+        await conn.execute(ADD_COLUMN)
+
+    while True:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                CONVERT_BATCH, {'batch_size': batch_size}
+            )
+        if result.rowcount < batch_size:
+            break
+
+    async with engine.begin() as conn:
+        for statement in SWAP:
+            await conn.execute(statement)
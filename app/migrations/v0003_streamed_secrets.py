@@ -0,0 +1,51 @@
+'''
+is_stream flag and the secret_chunks table of streamed secrets
+'''
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    false
+)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+metadata = MetaData()
+
+# only what the foreign key needs to resolve, the table exists already
+Table('secrets', metadata, Column('id', String, primary_key=True))
+
+secret_chunks = Table(
+    'secret_chunks',
+    metadata,
+    Column(
+        'secret_id',
+        String,
+        ForeignKey('secrets.id', ondelete='CASCADE'),
+        primary_key=True
+    ),
+    Column('seq', Integer, primary_key=True),
+    Column('data', LargeBinary, nullable=False)
+)
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        await ops.add_column(
+            conn,
+            'secrets',
+            Column(
+                'is_stream',
+                Boolean,
+                nullable=False,
+                server_default=false()
+            )
+        )
+        await conn.run_sync(secret_chunks.create, checkfirst=True)
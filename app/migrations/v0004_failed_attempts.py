@@ -0,0 +1,22 @@
+'''
+Counter of wrong passphrases per secret
+'''
+
+from sqlalchemy import Column, Integer
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        await ops.add_column(
+            conn,
+            'secrets',
+            Column(
+                'failed_attempts',
+                Integer,
+                nullable=False,
+                server_default='0'
+            )
+        )
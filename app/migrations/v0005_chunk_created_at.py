@@ -0,0 +1,17 @@
+'''
+created_at of chunks, the partition key of partitioned databases
+'''
+
+from sqlalchemy import Column, DateTime
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        await ops.add_column(
+            conn,
+            'secret_chunks',
+            Column('created_at', DateTime(timezone=True), nullable=True)
+        )
@@ -0,0 +1,220 @@
+'''
+secrets.id, secrets.secret_key and secret_chunks.secret_id from text to
+native UUID columns, dropping the redundant index on secrets.id.
+
+On Postgres new columns are filled by a trigger for new rows and in short
+batches for existing ones. NOT NULL is proven by validated CHECK
+constraints and the unique indexes are built concurrently, so the final
+swap under an exclusive lock only drops, renames and attaches, without
+scanning. SQLite keeps UUIDs as text, only their format changes.
+'''
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+COLUMN_TYPE = text('''
+    SELECT data_type FROM information_schema.columns
+    WHERE table_name = 'secrets' AND column_name = 'id'
+''')
+
+PREPARE = [
+    text('ALTER TABLE secrets ADD COLUMN IF NOT EXISTS id_uuid UUID'),
+    text('ALTER TABLE secrets ADD COLUMN IF NOT EXISTS secret_key_uuid UUID'),
+    text(
+        'ALTER TABLE secret_chunks '
+        'ADD COLUMN IF NOT EXISTS secret_id_uuid UUID'
+    ),
+    text('''
+        CREATE OR REPLACE FUNCTION secrets_uuid_sync() RETURNS trigger AS $$
+        BEGIN
+            NEW.id_uuid := NEW.id::uuid;
+            NEW.secret_key_uuid := NEW.secret_key::uuid;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+    '''),
+    text('''
+        CREATE OR REPLACE FUNCTION secret_chunks_uuid_sync()
+        RETURNS trigger AS $$
+        BEGIN
+            NEW.secret_id_uuid := NEW.secret_id::uuid;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+    '''),
+    text('DROP TRIGGER IF EXISTS secrets_uuid_sync ON secrets'),
+    text('''
+        CREATE TRIGGER secrets_uuid_sync BEFORE INSERT ON secrets
+        FOR EACH ROW EXECUTE FUNCTION secrets_uuid_sync()
+    '''),
+    text('DROP TRIGGER IF EXISTS secret_chunks_uuid_sync ON secret_chunks'),
+    text('''
+        CREATE TRIGGER secret_chunks_uuid_sync BEFORE INSERT ON secret_chunks
+        FOR EACH ROW EXECUTE FUNCTION secret_chunks_uuid_sync()
+    '''),
+]
+
+CONVERT_BATCH = [
+    text('''
+        UPDATE secrets
+        SET id_uuid = id::uuid, secret_key_uuid = secret_key::uuid
+        WHERE id IN (
+            SELECT id FROM secrets
+            WHERE id_uuid IS NULL
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+    '''),
+    text('''
+        UPDATE secret_chunks SET secret_id_uuid = secret_id::uuid
+        WHERE (secret_id, seq) IN (
+            SELECT secret_id, seq FROM secret_chunks
+            WHERE secret_id_uuid IS NULL
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+    '''),
+]
+
+# rows that were locked by someone else during the batches
+CONVERT_REST = [
+    text('''
+        UPDATE secrets
+        SET id_uuid = id::uuid, secret_key_uuid = secret_key::uuid
+        WHERE id_uuid IS NULL
+    '''),
+    text('''
+        UPDATE secret_chunks SET secret_id_uuid = secret_id::uuid
+        WHERE secret_id_uuid IS NULL
+    '''),
+]
+
+CHECKS = [
+    text(
+        'ALTER TABLE secrets DROP CONSTRAINT IF EXISTS secrets_uuid_not_null'
+    ),
+    text(
+        'ALTER TABLE secret_chunks '
+        'DROP CONSTRAINT IF EXISTS secret_chunks_uuid_not_null'
+    ),
+    text('''
+        ALTER TABLE secrets ADD CONSTRAINT secrets_uuid_not_null
+        CHECK (id_uuid IS NOT NULL AND secret_key_uuid IS NOT NULL)
+        NOT VALID
+    '''),
+    text('ALTER TABLE secrets VALIDATE CONSTRAINT secrets_uuid_not_null'),
+    text('''
+        ALTER TABLE secret_chunks ADD CONSTRAINT secret_chunks_uuid_not_null
+        CHECK (secret_id_uuid IS NOT NULL) NOT VALID
+    '''),
+    text(
+        'ALTER TABLE secret_chunks '
+        'VALIDATE CONSTRAINT secret_chunks_uuid_not_null'
+    ),
+]
+
+# CONCURRENTLY can not run in a transaction block
+INDEXES = [
+    text(
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS secrets_id_uuid_key '
+        'ON secrets (id_uuid)'
+    ),
+    text(
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+        'ix_secrets_secret_key_uuid ON secrets (secret_key_uuid)'
+    ),
+    text(
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+        'secret_chunks_uuid_pkey ON secret_chunks (secret_id_uuid, seq)'
+    ),
+]
+
+SWAP = [
+    text('LOCK TABLE secrets, secret_chunks IN ACCESS EXCLUSIVE MODE'),
+    text('DROP TRIGGER secrets_uuid_sync ON secrets'),
+    text('DROP TRIGGER secret_chunks_uuid_sync ON secret_chunks'),
+    text(
+        'ALTER TABLE secret_chunks '
+        'DROP CONSTRAINT IF EXISTS secret_chunks_secret_id_fkey'
+    ),
+    # takes the old primary keys and ix_secrets_id, ix_secrets_secret_key
+    text('ALTER TABLE secret_chunks DROP COLUMN secret_id'),
+    text('ALTER TABLE secrets DROP COLUMN id, DROP COLUMN secret_key'),
+    text('ALTER TABLE secrets RENAME COLUMN id_uuid TO id'),
+    text('ALTER TABLE secrets RENAME COLUMN secret_key_uuid TO secret_key'),
+    text('ALTER TABLE secret_chunks RENAME COLUMN secret_id_uuid TO secret_id'),
+    text(
+        'ALTER TABLE secrets ALTER COLUMN id SET NOT NULL, '
+        'ALTER COLUMN secret_key SET NOT NULL'
+    ),
+    text('ALTER TABLE secret_chunks ALTER COLUMN secret_id SET NOT NULL'),
+    text('ALTER TABLE secrets DROP CONSTRAINT secrets_uuid_not_null'),
+    text(
+        'ALTER TABLE secret_chunks '
+        'DROP CONSTRAINT secret_chunks_uuid_not_null'
+    ),
+    text(
+        'ALTER TABLE secrets ADD CONSTRAINT secrets_pkey '
+        'PRIMARY KEY USING INDEX secrets_id_uuid_key'
+    ),
+    text('ALTER INDEX ix_secrets_secret_key_uuid RENAME TO ix_secrets_secret_key'),
+    text(
+        'ALTER TABLE secret_chunks ADD CONSTRAINT secret_chunks_pkey '
+        'PRIMARY KEY USING INDEX secret_chunks_uuid_pkey'
+    ),
+    text('''
+        ALTER TABLE secret_chunks ADD CONSTRAINT secret_chunks_secret_id_fkey
+        FOREIGN KEY (secret_id) REFERENCES secrets (id) ON DELETE CASCADE
+        NOT VALID
+    '''),
+    text('DROP FUNCTION secrets_uuid_sync()'),
+    text('DROP FUNCTION secret_chunks_uuid_sync()'),
+]
+
+VALIDATE_FOREIGN_KEY = text(
+    'ALTER TABLE secret_chunks VALIDATE CONSTRAINT secret_chunks_secret_id_fkey'
+)
+
+SQLITE = [
+    text(
+        "UPDATE secrets SET id = replace(id, '-', ''), "
+        "secret_key = replace(secret_key, '-', '')"
+    ),
+    text("UPDATE secret_chunks SET secret_id = replace(secret_id, '-', '')"),
+]
+
+
+async def _execute(engine: AsyncEngine, statements: list) -> None:
+    async with engine.begin() as conn:
+        for statement in statements:
+            await conn.execute(statement)
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        if not ops.is_postgres(conn):
+            for statement in SQLITE:
+                await conn.execute(statement)
+            return
+        if await conn.scalar(COLUMN_TYPE) == 'uuid':
+            return
+    await _execute(engine, PREPARE)
+
+    for statement in CONVERT_BATCH:
+        while True:
+            async with engine.begin() as conn:
+                result = await conn.execute(
+                    statement, {'batch_size': batch_size}
+                )
+            if not result.rowcount:
+                break
+    await _execute(engine, CONVERT_REST)
+    await _execute(engine, CHECKS)
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in INDEXES:
+            await conn.execute(statement)
+
+    await _execute(engine, SWAP)
+    await _execute(engine, [VALIDATE_FOREIGN_KEY])
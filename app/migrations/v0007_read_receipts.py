@@ -0,0 +1,46 @@
+'''
+callback_url and read_at of secrets and the read_receipts outbox
+'''
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Uuid
+)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import ops
+
+metadata = MetaData()
+
+read_receipts = Table(
+    'read_receipts',
+    metadata,
+    Column('secret_key', Uuid(as_uuid=False), primary_key=True),
+    Column('callback_url', String, nullable=False),
+    Column('read_at', DateTime(timezone=True), nullable=False),
+    Column('next_attempt_at', DateTime(timezone=True), nullable=False),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Index('ix_read_receipts_next_attempt_at', 'next_attempt_at')
+)
+
+
+async def upgrade(engine: AsyncEngine, batch_size: int) -> None:
+    async with engine.begin() as conn:
+        # nullable columns without a default, no table rewrite
+        await ops.add_column(
+            conn,
+            'secrets',
+            Column('callback_url', String, nullable=True)
+        )
+        await ops.add_column(
+            conn,
+            'secrets',
+            Column('read_at', DateTime(timezone=True), nullable=True)
+        )
+        await conn.run_sync(read_receipts.create, checkfirst=True)
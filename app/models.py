@@ -1,6 +1,16 @@
 from datetime import datetime
 
-from sqlalchemy import String, DateTime, Boolean
+from sqlalchemy import (
+    String,
+    DateTime,
+    Boolean,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    Uuid,
+    false
+)
 from sqlalchemy.orm import mapped_column, Mapped, DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.sql import func
@@ -16,18 +26,104 @@ class Secret(Base):
 
     __tablename__ = 'secrets'
 
-    id: Mapped[str] = mapped_column(String, primary_key=True, index=True)
+    # native 16 byte UUIDs where the database has them, handled as str
+    id: Mapped[str] = mapped_column(Uuid(as_uuid=False), primary_key=True)
     secret_key: Mapped[str] = mapped_column(
-        String,
+        Uuid(as_uuid=False),
         unique=True,
         index=True,
         nullable=False
     )
-    secret_data: Mapped[str] = mapped_column(String, nullable=False)
+    secret_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     passphrase_hash: Mapped[str] = mapped_column(String, nullable=False)
     consumed: Mapped[bool] = mapped_column(Boolean, default=False)
+    is_stream: Mapped[bool] = mapped_column(
+        Boolean,
+        default=False,
+        server_default=false()
+    )
+    failed_attempts: Mapped[int] = mapped_column(
+        Integer,
+        default=0,
+        server_default='0'
+    )
     expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    consumed_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True
+    )
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
         server_default=func.now()
     )
+    # where a read receipt is sent, see app.receipts
+    callback_url: Mapped[str] = mapped_column(String, nullable=True)
+    # when the claimed secret was delivered to the reader
+    read_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True
+    )
+
+    # Partial indexes only cover rows the reaper is looking for, so they
+    # stay small no matter how many secrets are stored
+    __table_args__ = (
+        Index(
+            'ix_secrets_expires_at_live',
+            'expires_at',
+            postgresql_where=(consumed.is_(False) & expires_at.is_not(None)),
+            sqlite_where=(consumed.is_(False) & expires_at.is_not(None))
+        ),
+        Index(
+            'ix_secrets_consumed_at',
+            'consumed_at',
+            postgresql_where=consumed.is_(True),
+            sqlite_where=consumed.is_(True)
+        ),
+    )
+
+
+class SecretChunk(Base):
+    '''DB model for the encrypted chunks of a streamed secret'''
+
+    __tablename__ = 'secret_chunks'
+
+    secret_id: Mapped[str] = mapped_column(
+        Uuid(as_uuid=False),
+        ForeignKey('secrets.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # copy of the secret's created_at, the partition key when partitioned
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True
+    )
+
+
+class ReadReceipt(Base):
+    '''DB model for the outbox of read receipts waiting to be sent'''
+
+    __tablename__ = 'read_receipts'
+
+    # a secret is read at most once, and written only once its response
+    # has been delivered
+    secret_key: Mapped[str] = mapped_column(
+        Uuid(as_uuid=False),
+        primary_key=True
+    )
+    callback_url: Mapped[str] = mapped_column(String, nullable=False)
+    read_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False
+    )
+    next_attempt_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=False,
+        index=True
+    )
+    attempts: Mapped[int] = mapped_column(
+        Integer,
+        default=0,
+        server_default='0'
+    )
@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+from . import metrics
+from .config import (
+    NEGATIVE_CACHE_MAX_ENTRIES,
+    NEGATIVE_CACHE_MISSING_TTL,
+    NEGATIVE_CACHE_TTL
+)
+
+CONSUMED = 'consumed'
+EXPIRED = 'expired'
+MISSING = 'missing'
+
+hits_total = metrics.counter(
+    'negative_cache_hits_total',
+    'Secret lookups answered from the negative cache'
+)
+misses_total = metrics.counter(
+    'negative_cache_misses_total',
+    'Secret lookups not found in the negative cache'
+)
+evictions_total = metrics.counter(
+    'negative_cache_evictions_total',
+    'Entries evicted from the negative cache to stay within its size'
+)
+entries = metrics.gauge(
+    'negative_cache_entries',
+    'Entries in the negative cache'
+)
+
+
+class NegativeCache:
+    '''
+    Bounded LRU of secret keys that can not be read, with a TTL per entry.
+
+    Only states that hold for every worker should be added: a secret this
+    worker consumed or found expired never becomes readable again. A key
+    seen consumed by someone else may be a claim that is about to be
+    released, so it must not be cached.
+    '''
+
+    def __init__(
+            self,
+            max_entries: int,
+            ttl: float,
+            missing_ttl: float
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, secret_key: str) -> str | None:
+        '''
+        Cached state of the key, or None if nothing is known about it
+        '''
+
+        if not self.max_entries:
+            return None
+        entry = self._entries.get(secret_key)
+        if entry is None:
+            misses_total.inc()
+            return None
+        state, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[secret_key]
+            misses_total.inc()
+            return None
+        self._entries.move_to_end(secret_key)
+        hits_total.inc(state=state)
+        return state
+
+    def add(self, secret_key: str, state: str) -> None:
+        if not self.max_entries:
+            return
+        ttl = self.missing_ttl if state == MISSING else self.ttl
+        if ttl <= 0:
+            return
+        self._entries[secret_key] = (state, time.monotonic() + ttl)
+        self._entries.move_to_end(secret_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evictions_total.inc()
+
+    def discard(self, secret_key: str) -> None:
+        self._entries.pop(secret_key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+negative_cache = NegativeCache(
+    NEGATIVE_CACHE_MAX_ENTRIES,
+    NEGATIVE_CACHE_TTL,
+    NEGATIVE_CACHE_MISSING_TTL
+)
+
+entries.set_function(lambda: len(negative_cache))
@@ -0,0 +1,256 @@
+'''
+Day range partitions of the secrets and secret_chunks tables (Postgres).
+
+Partitioned tables need the partition key in every unique constraint, so
+created_at joins the primary keys and the secret_key constraint. Secret
+keys are UUIDv7 whose timestamp is the row's created_at; lookups add it
+to the predicate and Postgres prunes to a single partition. Older UUIDv4
+keys still work, by probing the secret_key index of every partition.
+'''
+
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import date, datetime, time as dt_time, timedelta, UTC
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('secrets', 'secret_chunks')
+
+# the name Postgres gives the constraint by default, which the chunk
+# partitions inherit
+CHUNKS_FOREIGN_KEY = 'secret_chunks_secret_id_created_at_fkey'
+
+CREATE_SECRETS = '''
+    CREATE TABLE IF NOT EXISTS secrets (
+        id UUID NOT NULL,
+        secret_key UUID NOT NULL,
+        secret_data BYTEA NOT NULL,
+        passphrase_hash VARCHAR NOT NULL,
+        consumed BOOLEAN,
+        is_stream BOOLEAN DEFAULT false,
+        failed_attempts INTEGER DEFAULT 0,
+        expires_at TIMESTAMP WITH TIME ZONE,
+        consumed_at TIMESTAMP WITH TIME ZONE,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+        callback_url VARCHAR,
+        read_at TIMESTAMP WITH TIME ZONE,
+        PRIMARY KEY (id, created_at),
+        UNIQUE (secret_key, created_at)
+    ) PARTITION BY RANGE (created_at)
+'''
+
+CREATE_CHUNKS = '''
+    CREATE TABLE IF NOT EXISTS secret_chunks (
+        secret_id UUID NOT NULL,
+        seq INTEGER NOT NULL,
+        data BYTEA NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (secret_id, created_at, seq),
+        CONSTRAINT {foreign_key} FOREIGN KEY (secret_id, created_at)
+            REFERENCES secrets (id, created_at) ON DELETE CASCADE
+    ) PARTITION BY RANGE (created_at)
+'''.format(foreign_key=CHUNKS_FOREIGN_KEY)
+
+CREATE_INDEXES = [
+    '''
+    CREATE INDEX IF NOT EXISTS ix_secrets_expires_at_live ON secrets
+    (expires_at) WHERE consumed IS false AND expires_at IS NOT NULL
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS ix_secrets_consumed_at ON secrets
+    (consumed_at) WHERE consumed IS true
+    ''',
+]
+
+IS_PARTITIONED = text('''
+    SELECT EXISTS (
+        SELECT 1 FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = 'secrets'
+    )
+''')
+
+TABLE_EXISTS = text("SELECT to_regclass('secrets') IS NOT NULL")
+
+LIST_PARTITIONS = text('''
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = :table
+''')
+
+TRY_LOCK = text('SELECT pg_try_advisory_xact_lock(:key)')
+
+_PARTITION_NAME = re.compile(r'^(?P<table>\w+)_p(?P<day>\d{8})$')
+
+created_total = metrics.counter(
+    'secret_partitions_created_total',
+    'Day partitions created ahead of time'
+)
+retired_total = metrics.counter(
+    'secret_partitions_retired_total',
+    'Day partitions dropped or detached after the retention period'
+)
+
+
+def uuid7() -> uuid.UUID:
+    '''
+    Time ordered UUID: 48 bits of Unix time in milliseconds, then random
+    bits (RFC 9562)
+    '''
+
+    millis = time.time_ns() // 1_000_000
+    random = int.from_bytes(os.urandom(10), 'big')
+    value = (millis & (1 << 48) - 1) << 80
+    value |= 0x7 << 76 | (random >> 62 & 0xfff) << 64
+    value |= 0b10 << 62 | random & (1 << 62) - 1
+    return uuid.UUID(int=value)
+
+
+def key_created_at(secret_key: str) -> datetime | None:
+    '''
+    Creation time carried by a UUIDv7 secret key, None for other keys
+    '''
+
+    try:
+        value = uuid.UUID(secret_key)
+    except ValueError:
+        return None
+    return uuid_created_at(value)
+
+
+def uuid_created_at(value: uuid.UUID) -> datetime | None:
+    if value.version != 7:
+        return None
+    millis = value.int >> 80
+    return (
+        datetime.fromtimestamp(millis // 1000, UTC)
+        + timedelta(milliseconds=millis % 1000)
+    )
+
+
+def partition_name(table: str, day: date) -> str:
+    return f'{table}_p{day:%Y%m%d}'
+
+
+def partition_day(name: str, table: str) -> date | None:
+    match = _PARTITION_NAME.match(name)
+    if not match or match['table'] != table:
+        return None
+    return datetime.strptime(match['day'], '%Y%m%d').date()
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, dt_time(), UTC)
+
+
+def create_partition_sql(table: str, day: date) -> str:
+    start = _day_start(day)
+    end = start + timedelta(days=1)
+    return (
+        f'CREATE TABLE IF NOT EXISTS {partition_name(table, day)} '
+        f'PARTITION OF {table} '
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+
+def retire_partition_sql(table: str, day: date, mode: str) -> list[str]:
+    name = partition_name(table, day)
+    statements = [f'ALTER TABLE {table} DETACH PARTITION {name}']
+    if mode == 'drop':
+        statements.append(f'DROP TABLE {name}')
+    elif table == 'secret_chunks':
+        # a detached chunks partition would still reference the secrets
+        # table and keep its partition from being detached and dropped
+        statements.append(
+            f'ALTER TABLE {name} DROP CONSTRAINT IF EXISTS '
+            f'{CHUNKS_FOREIGN_KEY}'
+        )
+    return statements
+
+
+def retirable(day: date, now: datetime, retention: timedelta) -> bool:
+    '''
+    Whether every secret created on day is past the retention
+    '''
+
+    return _day_start(day) + timedelta(days=1) + retention <= now
+
+
+async def setup(conn: AsyncConnection) -> None:
+    '''
+    Create the partitioned tables and their indexes. An existing plain
+    secrets table is not converted.
+    '''
+
+    exists = (await conn.execute(TABLE_EXISTS)).scalar()
+    if exists and not (await conn.execute(IS_PARTITIONED)).scalar():
+        raise RuntimeError(
+            'PARTITIONING_ENABLED is set but the secrets table is not '
+            'partitioned; partitioning is only available for new databases'
+        )
+    for statement in [CREATE_SECRETS, CREATE_CHUNKS, *CREATE_INDEXES]:
+        await conn.execute(text(statement))
+
+
+async def _existing_days(conn: AsyncConnection, table: str) -> set[date]:
+    result = await conn.execute(LIST_PARTITIONS, {'table': table})
+    days = (partition_day(name, table) for name in result.scalars())
+    return {day for day in days if day is not None}
+
+
+async def maintain(
+        engine: AsyncEngine,
+        premake_days: int,
+        retention: timedelta,
+        mode: str = 'drop',
+        now: datetime | None = None,
+        lock_key: int | None = None
+) -> tuple[int, int]:
+    '''
+    Create partitions from today up to premake_days ahead and retire the
+    ones past retention. Chunk partitions are retired before the secrets
+    partitions they reference. Returns (created, retired).
+    With lock_key, nothing is done while another transaction or session
+    holds that advisory lock.
+    '''
+
+    now = now or datetime.now(UTC)
+    today = now.date()
+    created = retired = 0
+    async with engine.begin() as conn:
+        if lock_key is not None and not (await conn.execute(
+            TRY_LOCK, {'key': lock_key}
+        )).scalar():
+            logger.info('Partition maintenance is running elsewhere')
+            return created, retired
+        existing = await _existing_days(conn, 'secrets')
+        for offset in range(premake_days + 1):
+            day = today + timedelta(days=offset)
+            if day in existing:
+                continue
+            for table in TABLES:
+                await conn.execute(text(create_partition_sql(table, day)))
+            created += 1
+        for day in sorted(existing):
+            if not retirable(day, now, retention):
+                continue
+            for table in reversed(TABLES):
+                for statement in retire_partition_sql(table, day, mode):
+                    await conn.execute(text(statement))
+            retired += 1
+    created_total.inc(created)
+    retired_total.inc(retired)
+    if created or retired:
+        logger.info(
+            'Partitions: %d days created, %d days retired', created, retired
+        )
+    return created, retired
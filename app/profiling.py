@@ -0,0 +1,208 @@
+'''
+On-demand profiling of a running worker.
+
+SamplingProfiler samples the stacks of every thread in the process with
+sys._current_frames() from a background thread, so the code it watches is
+not instrumented and pays only for the GIL the sampler takes. Samples are
+folded into collapsed stacks, one ``frame;frame;... count`` line per
+distinct stack, the input of flamegraph.pl and speedscope.
+
+SlowRequestLog keeps the stage breakdown of the last requests slower than
+a threshold, with a snapshot of where the request was waiting when it
+crossed the threshold, in a bounded ring buffer.
+'''
+
+import asyncio
+from collections import Counter, deque
+from datetime import datetime, UTC
+import os
+import sys
+import threading
+
+from .config import (
+    PROFILE_INTERVAL,
+    SLOW_REQUEST_LOG_SIZE,
+    SLOW_REQUEST_THRESHOLD
+)
+
+MAX_DEPTH = 128
+
+
+class ProfilerBusyError(Exception):
+    '''Raised when a profile is already being taken in this worker'''
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_qualname}'
+
+
+def _collapse(frame) -> list[str]:
+    # outermost frame first
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def collapsed(stacks: Counter) -> str:
+    return ''.join(
+        f'{stack} {count}\n' for stack, count in stacks.most_common()
+    )
+
+
+class SamplingProfiler:
+    '''
+    Samples all threads every interval seconds while profile() runs. One
+    profile at a time per worker.
+    '''
+
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self.running = False
+
+    def _sample(self, stacks: Counter, stop: threading.Event) -> None:
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = [names.get(ident, str(ident)), *_collapse(frame)]
+                stacks[';'.join(stack)] += 1
+
+    async def profile(self, seconds: float) -> Counter:
+        '''
+        Sample for seconds and return the count of every collapsed stack.
+        The event loop thread shows up idle in the selector while it waits.
+        '''
+
+        if self.running:
+            raise ProfilerBusyError('A profile is already running')
+        self.running = True
+        stacks: Counter = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(stacks, stop),
+            name='profiler',
+            daemon=True
+        )
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            sampler.join()
+            self.running = False
+        return stacks
+
+
+_AWAITABLE_ATTRS = (
+    ('cr_frame', 'cr_await'),
+    ('ag_frame', 'ag_await'),
+    ('gi_frame', 'gi_yieldfrom')
+)
+
+
+def task_stack(task: asyncio.Task) -> list[str]:
+    '''
+    Where a suspended task is waiting, outermost coroutine first. Unlike
+    Task.get_stack(), follows the chain of awaited coroutines.
+    '''
+
+    stack = []
+    awaitable = task.get_coro()
+    while awaitable is not None and len(stack) < MAX_DEPTH:
+        for frame_attr, await_attr in _AWAITABLE_ATTRS:
+            frame = getattr(awaitable, frame_attr, None)
+            if frame is not None:
+                break
+        else:
+            # a future or other object with no frame of its own
+            break
+        stack.append(f'{_frame_name(frame)}:{frame.f_lineno}')
+        awaitable = getattr(awaitable, await_attr)
+    return stack
+
+
+class _Watch:
+    __slots__ = ('task', 'handle', 'stack')
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.handle: asyncio.TimerHandle | None = None
+        self.stack: list[str] | None = None
+
+    def snapshot(self) -> None:
+        if not self.task.done():
+            self.stack = task_stack(self.task)
+
+
+class SlowRequestLog:
+    '''
+    Ring buffer of the last size requests that took threshold seconds or
+    more. Entries name the route, never the path, which holds secret keys.
+    '''
+
+    def __init__(
+            self,
+            threshold: float = SLOW_REQUEST_THRESHOLD,
+            size: int = SLOW_REQUEST_LOG_SIZE
+    ) -> None:
+        self.threshold = threshold
+        self._entries: deque[dict] = deque(maxlen=size)
+
+    def watch(self, task: asyncio.Task) -> _Watch:
+        '''
+        Take a stack snapshot of task once it has run for threshold seconds
+        '''
+
+        watch = _Watch(task)
+        watch.handle = asyncio.get_running_loop().call_later(
+            self.threshold, watch.snapshot
+        )
+        return watch
+
+    def record(
+            self,
+            watch: _Watch,
+            method: str,
+            route: str,
+            status: int,
+            seconds: float,
+            spans: list
+    ) -> None:
+        watch.handle.cancel()
+        if seconds < self.threshold:
+            return
+        stages: dict[str, float] = {}
+        for stage, elapsed in spans:
+            stages[stage] = stages.get(stage, 0) + elapsed
+        self._entries.append({
+            'finished_at': datetime.now(UTC).isoformat(),
+            'method': method,
+            'route': route,
+            'status': status,
+            'seconds': seconds,
+            'stages': stages,
+            'stack': watch.stack
+        })
+
+    def entries(self) -> list[dict]:
+        '''
+        Recorded requests, the most recent first
+        '''
+
+        return list(reversed(self._entries))
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+profiler = SamplingProfiler()
+slow_requests = SlowRequestLog()
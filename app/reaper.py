@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from . import metrics
+from .config import (
+    REAPER_BATCH_SIZE,
+    REAPER_CONSUMED_GRACE,
+    REAPER_INTERVAL,
+    REAPER_MAX_BATCHES,
+    REAPER_READ_RETENTION
+)
+from .repositories import secret_repository as secret_db
+
+logger = logging.getLogger(__name__)
+
+reaped_total = metrics.counter(
+    'secrets_reaped_total',
+    'Expired or consumed secrets deleted by the reaper'
+)
+reaped_last_cycle = metrics.gauge(
+    'secrets_reaper_last_cycle_rows',
+    'Secrets deleted during the last reaper cycle'
+)
+cycle_seconds = metrics.gauge(
+    'secrets_reaper_last_cycle_seconds',
+    'Duration of the last reaper cycle'
+)
+stored = metrics.gauge(
+    'secrets_stored',
+    'Stored secrets by state, estimated on Postgres'
+)
+cycle_errors = metrics.counter(
+    'secrets_reaper_errors_total',
+    'Reaper cycles that failed'
+)
+
+
+async def reap_once(
+        batch_size: int = REAPER_BATCH_SIZE,
+        max_batches: int = REAPER_MAX_BATCHES,
+        consumed_grace: float = REAPER_CONSUMED_GRACE,
+        read_retention: float = REAPER_READ_RETENTION
+) -> int:
+    '''
+    Run one reaper cycle: delete batches until a batch comes back short
+    or max_batches is reached. Returns the number of deleted rows.
+    '''
+
+    started = time.monotonic()
+    total = 0
+    for _ in range(max_batches):
+        deleted = await secret_db.delete_expired_secrets(
+            batch_size,
+            timedelta(seconds=consumed_grace),
+            timedelta(seconds=read_retention)
+        )
+        total += deleted
+        if deleted < batch_size:
+            break
+    reaped_total.inc(total)
+    reaped_last_cycle.set(total)
+    cycle_seconds.set(time.monotonic() - started)
+    return total
+
+
+async def run_reaper(interval: float = REAPER_INTERVAL) -> None:
+    '''
+    Reap forever, sleeping interval seconds between cycles
+    '''
+
+    while True:
+        try:
+            reaped = await reap_once()
+            if reaped:
+                logger.info('Reaped %d secrets', reaped)
+            await secret_db.maintain_storage()
+            for state, count in (await secret_db.secret_stats()).items():
+                stored.set(count, state=state)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            cycle_errors.inc()
+            logger.exception('Reaper cycle failed')
+        await asyncio.sleep(interval)
@@ -0,0 +1,47 @@
+'''
+Move secrets to the shards the current ring assigns them:
+
+    python -m app.rebalance [--batch-size N]
+
+Run it once the workers use the new DB_SHARD_RING with the old one in
+DB_SHARD_PREVIOUS_RING. When it has moved everything, the previous ring,
+and any shard drained out of the ring, can be dropped from the settings.
+If it is interrupted, run it again: moves left halfway are finished or
+undone first.
+'''
+
+import argparse
+import asyncio
+import logging
+
+from app.repositories.storage import build_storage
+
+
+async def _run(batch_size: int) -> None:
+    storage = build_storage('sharded')
+    await storage.start()
+    try:
+        moved = await storage.rebalance(batch_size)
+        print(f'moved {moved} secrets')
+    finally:
+        await storage.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m app.rebalance',
+        description='Move secrets between shards after a ring change'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='secrets read from a shard at a time'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
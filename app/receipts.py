@@ -0,0 +1,323 @@
+'''
+Read receipts.
+
+Delivering a secret created with a callback_url to its reader leaves a
+row in the read_receipts outbox, written in the transaction that records
+the read; a claim released before that, after a wrong passphrase or an
+undelivered response, leaves nothing. ReceiptDispatcher, run by one
+worker, POSTs due receipts to their callback URLs in batches, so the read
+path never waits for a callback. It wakes when the storage reports a new
+receipt, through Postgres LISTEN/NOTIFY or in process, and polls when it
+can not.
+
+secret_status() tells whether a secret has been read without consuming
+it, waiting for the read if asked to.
+'''
+
+import asyncio
+from contextlib import suppress
+from datetime import datetime, timedelta, UTC
+import ipaddress
+import logging
+import socket
+import uuid
+
+import httpx
+
+from . import metrics
+from .config import (
+    RECEIPT_BATCH_SIZE,
+    RECEIPT_CALLBACK_HOSTS,
+    RECEIPT_MAX_ATTEMPTS,
+    RECEIPT_POLL_INTERVAL,
+    RECEIPT_RETRY_BASE,
+    RECEIPT_RETRY_MAX,
+    RECEIPT_TIMEOUT,
+    SECRET_MAX_FAILED_ATTEMPTS
+)
+from .repositories import secret_repository as secret_db
+
+logger = logging.getLogger(__name__)
+
+delivered_total = metrics.counter(
+    'read_receipts_delivered_total',
+    'Read receipts delivered to their callback URL'
+)
+failed_total = metrics.counter(
+    'read_receipts_failed_attempts_total',
+    'Read receipt deliveries that failed and will be retried'
+)
+dropped_total = metrics.counter(
+    'read_receipts_dropped_total',
+    'Read receipts given up after RECEIPT_MAX_ATTEMPTS deliveries'
+)
+dispatch_errors = metrics.counter(
+    'read_receipts_dispatch_errors_total',
+    'Receipt dispatcher cycles that failed'
+)
+
+# with notifications, a poll in case one was missed, e.g. while the
+# listening connection was down
+IDLE_POLL_INTERVAL = 60
+
+
+def _utc(value: datetime | None) -> datetime | None:
+    # SQLite gives back the stored UTC times without their zone
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=UTC)
+
+
+def _normalize(secret_key: str) -> str:
+    try:
+        return str(uuid.UUID(secret_key))
+    except ValueError:
+        return secret_key
+
+
+class CallbackRefusedError(Exception):
+    '''Raised for a callback host that resolves to a non-public address'''
+
+
+async def public_address(host: str, port: int) -> str:
+    '''
+    An address of host to connect to, if every address it resolves to is
+    public: not loopback, private, link-local or otherwise reserved
+    '''
+
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        host, port, type=socket.SOCK_STREAM
+    )
+    addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        if not ipaddress.ip_address(address).is_global:
+            raise CallbackRefusedError(f'{host} resolves to {address}')
+    return addresses[0]
+
+
+async def _pinned(url: httpx.URL) -> dict:
+    '''
+    Arguments that POST to url on an address checked by public_address,
+    so the name can not be resolved again to another one. Hosts on
+    RECEIPT_CALLBACK_HOSTS are trusted as they are.
+    '''
+
+    host = url.raw_host.decode('ascii')
+    if host in RECEIPT_CALLBACK_HOSTS:
+        return {'url': url}
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    address = await public_address(host, port)
+    pinned = {
+        'url': url.copy_with(host=address),
+        'headers': {'Host': url.netloc.decode('ascii')}
+    }
+    if url.scheme == 'https':
+        pinned['extensions'] = {'sni_hostname': host}
+    return pinned
+
+
+def retry_at(attempts: int, now: datetime) -> datetime:
+    '''
+    When to try a receipt again after its attempts-th failed delivery
+    '''
+
+    delay = min(RECEIPT_RETRY_BASE * 2 ** attempts, RECEIPT_RETRY_MAX)
+    return now + timedelta(seconds=delay)
+
+
+class ReceiptWaiters:
+    '''
+    Status requests of this worker waiting for secrets to be read
+    '''
+
+    def __init__(self) -> None:
+        self._events: dict[str, set[asyncio.Event]] = {}
+
+    def notify(self, secret_key: str) -> None:
+        for event in self._events.get(_normalize(secret_key), ()):
+            event.set()
+
+    async def wait(self, secret_key: str, timeout: float) -> bool:
+        '''
+        Wait up to timeout seconds for a notification about secret_key
+        '''
+
+        secret_key = _normalize(secret_key)
+        event = asyncio.Event()
+        self._events.setdefault(secret_key, set()).add(event)
+        try:
+            async with asyncio.timeout(timeout):
+                await event.wait()
+            return True
+        except TimeoutError:
+            return False
+        finally:
+            events = self._events[secret_key]
+            events.discard(event)
+            if not events:
+                del self._events[secret_key]
+
+
+waiters = ReceiptWaiters()
+
+
+class ReceiptDispatcher:
+    '''
+    Delivers due read receipts, batch_size at a time, retrying failed ones
+    with exponential backoff until max_attempts
+    '''
+
+    def __init__(
+            self,
+            batch_size: int = RECEIPT_BATCH_SIZE,
+            max_attempts: int = RECEIPT_MAX_ATTEMPTS,
+            timeout: float = RECEIPT_TIMEOUT
+    ) -> None:
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        # claimed receipts are due again, for another dispatcher, only
+        # after every delivery of the batch has timed out
+        self.lease = timedelta(seconds=2 * timeout)
+        self._wakeup = asyncio.Event()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def _deliver(self, client: httpx.AsyncClient, receipt) -> bool:
+        try:
+            async with asyncio.timeout(self.timeout):
+                response = await client.post(
+                    **await _pinned(httpx.URL(receipt.callback_url)),
+                    json={
+                        'secret_key': receipt.secret_key,
+                        'read_at': _utc(receipt.read_at).isoformat()
+                    }
+                )
+        except CallbackRefusedError as exc:
+            logger.warning('Read receipt callback refused: %s', exc)
+            return False
+        except (httpx.HTTPError, OSError, TimeoutError) as exc:
+            logger.info('Read receipt delivery failed: %r', exc)
+            return False
+        return response.is_success
+
+    async def dispatch_once(self, client: httpx.AsyncClient) -> int:
+        '''
+        Deliver one batch of due receipts. Returns the size of the batch.
+        '''
+
+        receipts = await secret_db.claim_receipts(self.batch_size, self.lease)
+        if not receipts:
+            return 0
+        results = await asyncio.gather(*(
+            self._deliver(client, receipt) for receipt in receipts
+        ))
+        now = datetime.now(UTC)
+        done, retries = [], {}
+        for receipt, delivered in zip(receipts, results):
+            if delivered:
+                delivered_total.inc()
+                done.append(receipt.secret_key)
+            elif receipt.attempts + 1 >= self.max_attempts:
+                dropped_total.inc()
+                done.append(receipt.secret_key)
+            else:
+                failed_total.inc()
+                retries[receipt.secret_key] = retry_at(receipt.attempts, now)
+        await secret_db.finish_receipts(done, retries)
+        return len(receipts)
+
+    async def run(
+            self,
+            client: httpx.AsyncClient,
+            listening: bool,
+            poll_interval: float = RECEIPT_POLL_INTERVAL
+    ) -> None:
+        '''
+        Dispatch forever, sleeping until the next receipt is due or a new
+        one is reported
+        '''
+
+        idle = IDLE_POLL_INTERVAL if listening else poll_interval
+        while True:
+            # a receipt reported from here on wakes the wait below
+            self._wakeup.clear()
+            timeout = idle
+            try:
+                if await self.dispatch_once(client) >= self.batch_size:
+                    continue
+                next_at = _utc(await secret_db.next_receipt_at())
+                if next_at is not None:
+                    due_in = (next_at - datetime.now(UTC)).total_seconds()
+                    timeout = min(idle, max(due_in, 0))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                dispatch_errors.inc()
+                logger.exception('Read receipt dispatch failed')
+            with suppress(TimeoutError):
+                async with asyncio.timeout(timeout):
+                    await self._wakeup.wait()
+
+
+async def run_receipts(dispatch: bool = True) -> None:
+    '''
+    Listen for new receipts on behalf of the status requests of this
+    worker and, with dispatch, deliver receipts until cancelled
+    '''
+
+    dispatcher = ReceiptDispatcher()
+
+    def on_receipt(secret_key: str) -> None:
+        waiters.notify(secret_key)
+        dispatcher.wake()
+
+    listening = await secret_db.listen_receipts(on_receipt)
+    if not dispatch:
+        return
+    async with httpx.AsyncClient(
+        timeout=RECEIPT_TIMEOUT,
+        follow_redirects=False
+    ) as client:
+        await dispatcher.run(client, listening)
+
+
+def _status(secret, now: datetime) -> str:
+    expires_at = _utc(secret.expires_at)
+    if secret.read_at is not None:
+        return 'read'
+    if not secret.consumed:
+        if expires_at is not None and expires_at <= now:
+            return 'expired'
+        return 'unread'
+    if (
+        SECRET_MAX_FAILED_ATTEMPTS
+        and secret.failed_attempts >= SECRET_MAX_FAILED_ATTEMPTS
+    ):
+        return 'locked'
+    # claimed and not delivered yet, or being moved to another shard
+    return 'unread'
+
+
+async def secret_status(secret_key: str, wait: float = 0) -> dict | None:
+    '''
+    Whether a secret has been read, without consuming it; None if it does
+    not exist (any more). A read counts once the secret has been delivered,
+    as for receipts, and counts until the reaper deletes the read secret,
+    REAPER_READ_RETENTION after the read. While the secret is unread,
+    waits up to wait seconds for that to change.
+    '''
+
+    loop = asyncio.get_running_loop()
+    until = loop.time() + wait
+    while True:
+        secret = await secret_db.get_secret(secret_key)
+        if secret is None:
+            return None
+        status = _status(secret, datetime.now(UTC))
+        left = until - loop.time()
+        if status != 'unread' or left <= 0:
+            read_at = _utc(secret.read_at) if status == 'read' else None
+            return {'status': status, 'read_at': read_at}
+        await waiters.wait(secret_key, min(left, RECEIPT_POLL_INTERVAL))
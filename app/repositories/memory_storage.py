@@ -0,0 +1,323 @@
+import heapq
+import math
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+from typing import AsyncIterable, AsyncIterator, Callable
+import uuid
+
+from app import models
+
+
+def _normalize(secret_key: str) -> str:
+    # the same key in any of the spellings SqlStorage accepts
+    try:
+        return str(uuid.UUID(secret_key))
+    except ValueError:
+        return secret_key
+
+
+@dataclass(slots=True)
+class StoredSecret:
+    id: str
+    secret_key: str
+    secret_data: bytes
+    passphrase_hash: str
+    expires_at: datetime | None
+    is_stream: bool = False
+    consumed: bool = False
+    consumed_at: datetime | None = None
+    failed_attempts: int = 0
+    callback_url: str | None = None
+    read_at: datetime | None = None
+
+
+@dataclass(slots=True)
+class StoredReceipt:
+    secret_key: str
+    callback_url: str
+    read_at: datetime
+    next_attempt_at: datetime
+    attempts: int = 0
+
+
+class TimerWheel:
+    '''
+    Keys bucketed by due time, resolution seconds per bucket.
+
+    Entries are never removed when a secret changes state, the caller
+    checks every popped key against its record and re-adds keys that
+    become due again.
+    '''
+
+    def __init__(self, resolution: float) -> None:
+        self.resolution = resolution
+        self._buckets: dict[int, set[str]] = {}
+        self._slots: list[int] = []
+
+    def add(self, key: str, due: float) -> None:
+        # round up, so a bucket is due only when all its keys are
+        slot = math.ceil(due / self.resolution)
+        bucket = self._buckets.get(slot)
+        if bucket is None:
+            bucket = self._buckets[slot] = set()
+            heapq.heappush(self._slots, slot)
+        bucket.add(key)
+
+    def pop(self, now: float) -> str | None:
+        '''
+        Remove and return a key due at now, or None
+        '''
+
+        while self._slots and self._slots[0] * self.resolution <= now:
+            slot = self._slots[0]
+            bucket = self._buckets[slot]
+            if bucket:
+                return bucket.pop()
+            heapq.heappop(self._slots)
+            del self._buckets[slot]
+        return None
+
+
+class MemoryStorage:
+    '''
+    Secrets in process memory, for a single worker on an edge node or in
+    CI. Nothing survives a restart.
+
+    Secrets are spread over dict shards, so no single table has to be
+    resized all at once, and expire through timer wheels instead of
+    scans. Everything runs on the event loop without awaiting between a
+    check and an update, so claims need no locks.
+    '''
+
+    def __init__(self, shards: int = 16, wheel_resolution: float = 1) -> None:
+        self._shards: list[dict[str, StoredSecret]] = [
+            {} for _ in range(shards)
+        ]
+        self._chunks: dict[str, list[bytes]] = {}
+        self._expiring = TimerWheel(wheel_resolution)
+        self._consumed = TimerWheel(wheel_resolution)
+        self._consumed_count = 0
+        self._receipts: dict[str, StoredReceipt] = {}
+        self._receipt_listener: Callable[[str], None] | None = None
+
+    def _shard(self, secret_key: str) -> dict[str, StoredSecret]:
+        return self._shards[hash(secret_key) % len(self._shards)]
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def maintain(self) -> None:
+        pass
+
+    def _add(self, secret: models.Secret, is_stream: bool = False) -> None:
+        record = StoredSecret(
+            id=secret.id,
+            secret_key=_normalize(secret.secret_key),
+            secret_data=secret.secret_data,
+            passphrase_hash=secret.passphrase_hash,
+            expires_at=secret.expires_at,
+            is_stream=is_stream,
+            callback_url=secret.callback_url
+        )
+        self._shard(record.secret_key)[record.secret_key] = record
+        if record.expires_at is not None:
+            self._expiring.add(record.secret_key, record.expires_at.timestamp())
+
+    async def create(self, secret: models.Secret) -> None:
+        self._add(secret)
+
+    async def create_many(self, secrets: list[models.Secret]) -> None:
+        for secret in secrets:
+            self._add(secret)
+
+    async def create_stream(
+            self,
+            secret: models.Secret,
+            chunks: AsyncIterable[bytes]
+    ) -> None:
+        stored = [data async for data in chunks]
+        self._chunks[secret.id] = stored
+        self._add(secret, is_stream=True)
+
+    async def iter_chunks(
+            self,
+            secret_key: str,
+            secret_id: str
+    ) -> AsyncIterator[bytes]:
+        for data in self._chunks.get(secret_id, ()):
+            yield data
+
+    async def get(self, secret_key: str) -> StoredSecret | None:
+        secret_key = _normalize(secret_key)
+        return self._shard(secret_key).get(secret_key)
+
+    async def consume(self, secret_key: str) -> StoredSecret | None:
+        secret_key = _normalize(secret_key)
+        record = self._shard(secret_key).get(secret_key)
+        now = datetime.now(UTC)
+        if record is None or record.consumed:
+            return None
+        if record.expires_at is not None and record.expires_at <= now:
+            return None
+        self._mark_consumed(record, now)
+        return record
+
+    async def mark_read(self, secret_key: str) -> None:
+        secret_key = _normalize(secret_key)
+        record = self._shard(secret_key).get(secret_key)
+        if (
+            record is None
+            or not record.consumed
+            or record.read_at is not None
+        ):
+            return
+        now = record.read_at = datetime.now(UTC)
+        # only the record is kept, for its status
+        record.secret_data = b''
+        self._chunks.pop(record.id, None)
+        if record.callback_url is not None:
+            self._receipts[secret_key] = StoredReceipt(
+                secret_key=secret_key,
+                callback_url=record.callback_url,
+                read_at=now,
+                next_attempt_at=now
+            )
+            if self._receipt_listener is not None:
+                self._receipt_listener(secret_key)
+
+    def _mark_consumed(self, record: StoredSecret, now: datetime) -> None:
+        if not record.consumed:
+            self._consumed_count += 1
+        record.consumed = True
+        record.consumed_at = now
+        self._consumed.add(record.secret_key, now.timestamp())
+
+    async def release(
+            self,
+            secret_key: str,
+            failed: bool = False,
+            max_failed_attempts: int = 0
+    ) -> None:
+        secret_key = _normalize(secret_key)
+        record = self._shard(secret_key).get(secret_key)
+        if record is None or not record.consumed:
+            return
+        if failed:
+            record.failed_attempts += 1
+            if (
+                max_failed_attempts
+                and record.failed_attempts >= max_failed_attempts
+            ):
+                self._mark_consumed(record, datetime.now(UTC))
+                return
+        record.consumed = False
+        record.consumed_at = None
+        self._consumed_count -= 1
+        if record.expires_at is not None:
+            self._expiring.add(secret_key, record.expires_at.timestamp())
+
+    def _delete(self, record: StoredSecret) -> None:
+        del self._shard(record.secret_key)[record.secret_key]
+        self._chunks.pop(record.id, None)
+        if record.consumed:
+            self._consumed_count -= 1
+
+    async def delete_expired(
+            self,
+            batch_size: int,
+            consumed_grace: timedelta,
+            read_retention: timedelta = timedelta(0)
+    ) -> int:
+        now = datetime.now(UTC)
+        deleted = 0
+        for wheel, due in (
+            (self._expiring, now),
+            (self._consumed, now - consumed_grace)
+        ):
+            reaped = 0
+            while reaped < batch_size:
+                secret_key = wheel.pop(due.timestamp())
+                if secret_key is None:
+                    break
+                record = self._shard(secret_key).get(secret_key)
+                if record is None:
+                    continue
+                if wheel is self._expiring:
+                    stale = record.consumed or record.expires_at > now
+                else:
+                    stale = not record.consumed or record.consumed_at > due
+                    kept_until = (
+                        record.read_at + read_retention
+                        if record.read_at is not None else None
+                    )
+                    if not stale and kept_until and kept_until > now:
+                        # due again once the read is past retention
+                        wheel.add(
+                            secret_key,
+                            (kept_until - consumed_grace).timestamp()
+                        )
+                        stale = True
+                if not stale:
+                    self._delete(record)
+                    reaped += 1
+            deleted += reaped
+        return deleted
+
+    async def stats(self) -> dict[str, int]:
+        total = sum(len(shard) for shard in self._shards)
+        return {
+            'live': total - self._consumed_count,
+            'consumed': self._consumed_count
+        }
+
+    async def claim_receipts(
+            self,
+            limit: int,
+            lease: timedelta
+    ) -> list[StoredReceipt]:
+        now = datetime.now(UTC)
+        due = sorted(
+            (
+                receipt for receipt in self._receipts.values()
+                if receipt.next_attempt_at <= now
+            ),
+            key=lambda receipt: receipt.next_attempt_at
+        )[:limit]
+        claimed = []
+        for receipt in due:
+            # a copy, as a row would be
+            claimed.append(StoredReceipt(
+                receipt.secret_key,
+                receipt.callback_url,
+                receipt.read_at,
+                receipt.next_attempt_at,
+                receipt.attempts
+            ))
+            receipt.next_attempt_at = now + lease
+        return claimed
+
+    async def finish_receipts(
+            self,
+            done: list[str],
+            retries: dict[str, datetime]
+    ) -> None:
+        for secret_key in done:
+            self._receipts.pop(secret_key, None)
+        for secret_key, at in retries.items():
+            receipt = self._receipts.get(secret_key)
+            if receipt is not None:
+                receipt.attempts += 1
+                receipt.next_attempt_at = at
+
+    async def next_receipt_at(self) -> datetime | None:
+        return min(
+            (receipt.next_attempt_at for receipt in self._receipts.values()),
+            default=None
+        )
+
+    async def listen_receipts(self, callback: Callable[[str], None]) -> bool:
+        self._receipt_listener = callback
+        return True
@@ -1,69 +1,322 @@
+import asyncio
 from datetime import datetime, timedelta, UTC
+from typing import AsyncIterable, AsyncIterator, Callable
 import uuid
 
-from sqlalchemy import select
-
-from app import database as db
 from app import schemas as shm
 from app import utils
 from app import models
+from app import streaming
+from app import partitions
+from app.coalescer import WriteCoalescer
+from app.config import (
+    PARTITIONING_ENABLED,
+    SECRET_MAX_TTL,
+    STORAGE_BACKEND,
+    WRITE_COALESCING_ENABLED,
+    WRITE_COALESCING_MAX_BATCH,
+    WRITE_COALESCING_MAX_DELAY
+)
+from app.executor import crypto_executor
+from app.instrumentation import timed
+from app.repositories.storage import (
+    ClaimedSecret,
+    ReadReceipt,
+    build_storage
+)
+
+storage = build_storage(STORAGE_BACKEND)
+
+write_coalescer = WriteCoalescer(
+    storage.create_many,
+    WRITE_COALESCING_MAX_DELAY,
+    WRITE_COALESCING_MAX_BATCH
+) if WRITE_COALESCING_ENABLED else None
+
+
+def _expires_at(ttl: int | None) -> datetime | None:
+    # partitions are retired after SECRET_MAX_TTL, so no secret may
+    # outlive it there
+    if PARTITIONING_ENABLED and (not ttl or ttl > SECRET_MAX_TTL):
+        ttl = SECRET_MAX_TTL
+    if ttl:
+        return datetime.now(UTC) + timedelta(seconds=ttl)
+    return None
+
+
+def _new_secret_key() -> tuple[str, datetime | None]:
+    '''
+    A new secret key and the creation time to store with it. With
+    partitioning the key is a UUIDv7 carrying that time.
+    '''
+
+    if PARTITIONING_ENABLED:
+        secret_key = str(partitions.uuid7())
+        return secret_key, partitions.key_created_at(secret_key)
+    return str(uuid.uuid4()), None
 
 
 class SecretFactory:
     @staticmethod
-    def create(secret: shm.SecretCreate) -> models.Secret:
+    async def create(secret: shm.SecretCreate) -> models.Secret:
         '''
-        Factory method for creating instance of secret model
+        Factory method for creating instance of secret model.
+        Hashing and encryption run concurrently in the crypto executor.
         '''
 
         password_mgr = utils.PasswordManager()
         secret_mgr = utils.SecretManager(secret.passphrase)
-        secret_key = str(uuid.uuid4())
-        passphrase_hash = password_mgr.get_password_hash(secret.passphrase)
-        encrypted_secret = secret_mgr.encrypt_secret(secret.secret)
-        expires_at = None
-        if secret.ttl:
-            expires_at = datetime.now(UTC) + timedelta(seconds=secret.ttl)
-        return models.Secret(
+        secret_key, created_at = _new_secret_key()
+        passphrase_hash, encrypted_secret = await asyncio.gather(
+            password_mgr.get_password_hash_async(
+                secret.passphrase, secret.ttl
+            ),
+            secret_mgr.encrypt_secret_async(secret.secret)
+        )
+        db_secret = models.Secret(
             id=str(uuid.uuid4()),
             secret_key=secret_key,
             secret_data=encrypted_secret,
             passphrase_hash=passphrase_hash,
-            expires_at=expires_at
+            expires_at=_expires_at(secret.ttl),
+            callback_url=secret.callback_url
         )
+        # an explicit None would override the server default
+        if created_at is not None:
+            db_secret.created_at = created_at
+        return db_secret
+
+    @staticmethod
+    async def create_many(
+            secrets: list[shm.SecretCreate]
+    ) -> list[models.Secret | Exception]:
+        '''
+        Create model instances for many secrets in parallel.
+        Fan-out is capped at the crypto executor worker count so a batch
+        does not fill the executor queue on its own. A failed item is
+        returned as its exception instead of failing the whole batch.
+        '''
+
+        limit = asyncio.Semaphore(crypto_executor.max_workers)
+
+        async def create(secret: shm.SecretCreate) -> models.Secret:
+            async with limit:
+                return await SecretFactory.create(secret)
+
+        return await asyncio.gather(
+            *(create(secret) for secret in secrets),
+            return_exceptions=True
+        )
+
+
+async def init_storage() -> None:
+    await storage.start()
+
+
+async def close_storage() -> None:
+    if write_coalescer is not None:
+        await write_coalescer.close()
+    await storage.close()
+
+
+async def maintain_storage() -> None:
+    '''
+    Periodic housekeeping of the storage beyond deleting secrets
+    '''
+
+    await storage.maintain()
 
 
 async def create_secret(secret: shm.SecretCreate) -> str:
     '''
-    Create record in db with new secret
+    Create record in db with new secret. With write coalescing on, the
+    insert is batched with concurrent creates.
     '''
 
-    db_secret = SecretFactory.create(secret)
+    db_secret = await SecretFactory.create(secret)
+    # read before the commit expires the instance
     secret_key = db_secret.secret_key
-    async with db.async_session() as session:
-        session.add(db_secret)
-        await session.commit()
+    if write_coalescer is None:
+        await storage.create(db_secret)
+        return secret_key
+    with timed('db_insert_coalesced'):
+        await write_coalescer.submit(db_secret)
+    return secret_key
+
+
+async def create_secrets(
+        secrets: list[shm.SecretCreate]
+) -> list[str | Exception]:
+    '''
+    Create records for many secrets in a single write.
+    Returns the secret key, or the error, for every item.
+    '''
+
+    created = await SecretFactory.create_many(secrets)
+    secrets_ok = [
+        secret for secret in created if isinstance(secret, models.Secret)
+    ]
+    if secrets_ok:
+        await storage.create_many(secrets_ok)
+    return [
+        secret.secret_key if isinstance(secret, models.Secret) else secret
+        for secret in created
+    ]
+
+
+async def create_stream_secret(
+        passphrase: str,
+        ttl: int | None,
+        chunks: AsyncIterable[bytes],
+        callback_url: str | None = None
+) -> str:
+    '''
+    Create a streamed secret. Incoming data is encrypted and stored chunk
+    by chunk, so memory use does not depend on the secret size with the
+    SQL storage. The secret becomes visible only when complete.
+    '''
+
+    password_mgr = utils.PasswordManager()
+    secret_mgr = utils.SecretManager(passphrase)
+    passphrase_hash, encryptor = await asyncio.gather(
+        password_mgr.get_password_hash_async(passphrase, ttl),
+        secret_mgr.stream_encryptor_async()
+    )
+    secret_key, created_at = _new_secret_key()
+    secret = models.Secret(
+        id=str(uuid.uuid4()),
+        secret_key=secret_key,
+        secret_data=encryptor.header,
+        passphrase_hash=passphrase_hash,
+        expires_at=_expires_at(ttl),
+        callback_url=callback_url
+    )
+    if created_at is not None:
+        secret.created_at = created_at
+
+    async def encrypted() -> AsyncIterator[bytes]:
+        async for frame, last in streaming.read_frames(chunks):
+            yield encryptor.encrypt_chunk(frame, last)
+
+    await storage.create_stream(secret, encrypted())
     return secret_key
 
 
-async def get_secret(secret_key: str) -> models.Secret:
+def iter_secret_chunks(
+        secret_key: str,
+        secret_id: str
+) -> AsyncIterator[bytes]:
+    '''
+    Yield the encrypted chunks of a streamed secret in order
+    '''
+
+    return storage.iter_chunks(secret_key, secret_id)
+
+
+async def get_secret(secret_key: str):
     '''
     Get a secret by its secret key
     '''
 
-    async with db.async_session() as session:
-        result = await session.execute(
-            select(models.Secret).
-            where(models.Secret.secret_key == secret_key)
-        )
-    return result.scalars().first()
+    return await storage.get(secret_key)
+
+
+async def consume_secret(secret_key: str) -> ClaimedSecret | None:
+    '''
+    Claim a one-time secret and mark it consumed.
+
+    Returns the id, encrypted data, passphrase hash and stream flag of the
+    claimed secret, or None when the secret is missing, already consumed
+    or expired. Only one concurrent caller can claim a given secret.
+    '''
+
+    return await storage.consume(secret_key)
+
+
+async def mark_secret_read(secret_key: str) -> None:
+    '''
+    Record that a secret claimed by consume_secret has been delivered to
+    its reader, and queue its read receipt if it has a callback_url
+    '''
+
+    await storage.mark_read(secret_key)
+
+
+async def release_secret(
+        secret_key: str,
+        failed: bool = False,
+        max_failed_attempts: int = 0
+) -> None:
+    '''
+    Undo a claim made by consume_secret, e.g. after a wrong passphrase,
+    so the secret can still be read with the right one.
+
+    A failed attempt is counted at the same time. Once there have been
+    max_failed_attempts of them the claim is kept instead, which
+    invalidates the secret; 0 never does.
+    '''
+
+    await storage.release(secret_key, failed, max_failed_attempts)
+
+
+async def delete_expired_secrets(
+        batch_size: int,
+        consumed_grace: timedelta = timedelta(0),
+        read_retention: timedelta = timedelta(0)
+) -> int:
+    '''
+    Delete at most batch_size expired secrets and at most batch_size
+    secrets consumed more than consumed_grace ago, keeping read ones until
+    read_retention after the read.
+    Returns the number of deleted secrets.
+    '''
+
+    return await storage.delete_expired(
+        batch_size, consumed_grace, read_retention
+    )
+
+
+async def secret_stats() -> dict[str, int]:
+    '''
+    Number of stored secrets that are live and consumed
+    '''
+
+    return await storage.stats()
+
+
+async def claim_receipts(limit: int, lease: timedelta) -> list[ReadReceipt]:
+    '''
+    Read receipts due for delivery, hidden from other dispatchers for
+    lease
+    '''
+
+    return await storage.claim_receipts(limit, lease)
+
+
+async def finish_receipts(
+        done: list[str],
+        retries: dict[str, datetime]
+) -> None:
+    '''
+    Delete the receipts of the secret keys in done and retry the others
+    at the given times
+    '''
+
+    await storage.finish_receipts(done, retries)
+
+
+async def next_receipt_at() -> datetime | None:
+    '''
+    When the next read receipt is due, None without any
+    '''
+
+    return await storage.next_receipt_at()
 
 
-async def make_consume_mark(secret: models.Secret) -> None:
+async def listen_receipts(callback: Callable[[str], None]) -> bool:
     '''
-    Marking secret as consumed
+    Call callback with the secret key of every new read receipt, if the
+    storage can tell; returns whether it can
     '''
 
-    async with db.async_session() as session:
-        secret.consumed = True
-        await session.commit()
+    return await storage.listen_receipts(callback)
@@ -0,0 +1,378 @@
+'''
+Secrets spread over several SQL databases by key
+'''
+
+import asyncio
+import bisect
+from datetime import datetime, timedelta, UTC
+import hashlib
+from typing import AsyncIterable, AsyncIterator, Callable
+import uuid
+
+from sqlalchemy import Row, and_, delete, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import metrics
+from app import models
+from .sql_storage import SqlStorage, chunk_table, secret_table
+
+secrets_moved_total = metrics.counter(
+    'shard_secrets_moved_total',
+    'Secrets moved to another shard by a rebalance'
+)
+
+
+def _routing_key(secret_key: str) -> bytes:
+    # the same secret whatever way its UUID is spelled
+    try:
+        return uuid.UUID(secret_key).bytes
+    except ValueError:
+        return secret_key.encode()
+
+
+def _hash(data: bytes) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=8).digest(),
+        'big'
+    )
+
+
+class HashRing:
+    '''
+    Consistent hashing of secret keys onto shard names. Every shard owns
+    vnodes points of the ring, so adding or removing one only moves the
+    keys of its share.
+    '''
+
+    def __init__(self, shards: list[str], vnodes: int = 64) -> None:
+        if not shards:
+            raise ValueError('A hash ring needs at least one shard')
+        points = sorted(
+            (_hash(f'{shard}#{index}'.encode()), shard)
+            for shard in shards
+            for index in range(vnodes)
+        )
+        self.shards = list(shards)
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard(self, secret_key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(_routing_key(secret_key)))
+        return self._owners[index % len(self._owners)]
+
+
+async def _scan(engine: AsyncEngine, after: str | None, limit: int) -> list:
+    now = datetime.now(UTC)
+    query = (
+        select(secret_table).
+        where(
+            secret_table.c.consumed.is_(False),
+            or_(
+                secret_table.c.expires_at.is_(None),
+                secret_table.c.expires_at > now
+            )
+        ).
+        order_by(secret_table.c.id).
+        limit(limit)
+    )
+    if after is not None:
+        query = query.where(secret_table.c.id > after)
+    async with engine.connect() as conn:
+        return (await conn.execute(query)).all()
+
+
+# consumed without a consumed_at: a copy or an original in the middle of
+# a move, which neither consume, release nor the reaper match
+HIDDEN = and_(
+    secret_table.c.consumed.is_(True),
+    secret_table.c.consumed_at.is_(None)
+)
+
+
+async def _move(source: AsyncEngine, target: AsyncEngine, rows: list) -> int:
+    '''
+    Move rows with their chunks from source to target. The copies are
+    hidden until the originals are hidden in turn, which commits the move;
+    the copies are then shown and the originals deleted. An original
+    claimed in the meantime stays where it is. A move interrupted after
+    the commit is finished by _recover().
+    '''
+
+    ids = [row.id for row in rows]
+    streams = [row.id for row in rows if row.is_stream]
+    chunks = []
+    if streams:
+        async with source.connect() as conn:
+            chunks = (await conn.execute(
+                select(chunk_table).
+                where(chunk_table.c.secret_id.in_(streams))
+            )).mappings().all()
+    batch = secret_table.c.id.in_(ids)
+    async with target.begin() as conn:
+        # copies left by an interrupted move
+        await conn.execute(delete(secret_table).where(batch, HIDDEN))
+        await conn.execute(insert(secret_table), [
+            {**row._mapping, 'consumed': True, 'consumed_at': None}
+            for row in rows
+        ])
+        if chunks:
+            await conn.execute(
+                insert(chunk_table),
+                [dict(chunk) for chunk in chunks]
+            )
+    async with source.begin() as conn:
+        result = await conn.execute(
+            update(secret_table).
+            where(batch, secret_table.c.consumed.is_(False)).
+            values(consumed=True, consumed_at=None).
+            returning(secret_table.c.id)
+        )
+        moved = set(result.scalars())
+    async with target.begin() as conn:
+        if moved:
+            await conn.execute(
+                update(secret_table).
+                where(secret_table.c.id.in_(moved)).
+                values(consumed=False)
+            )
+        gone = set(ids) - moved
+        if gone:
+            await conn.execute(
+                delete(secret_table).where(secret_table.c.id.in_(gone))
+            )
+    if moved:
+        async with source.begin() as conn:
+            await conn.execute(delete(secret_table).where(
+                secret_table.c.id.in_(moved), HIDDEN
+            ))
+    return len(moved)
+
+
+class ShardedStorage:
+    '''
+    Secrets on several SqlStorage shards, each with its own engine and
+    pool, placed by a HashRing of the names in ring.
+
+    While shards are added or drained, previous is the ring before the
+    change: a secret not found on its shard is looked for on the one it
+    had before, until rebalance() has moved it.
+    '''
+
+    def __init__(
+            self,
+            engines: dict[str, AsyncEngine],
+            ring: list[str],
+            previous: list[str] | None = None,
+            vnodes: int = 64,
+            partitioned: bool = False,
+            auto_migrate: bool = False
+    ) -> None:
+        unknown = (set(ring) | set(previous or ())) - set(engines)
+        if unknown:
+            raise ValueError(f'Shards without a database: {sorted(unknown)}')
+        self.shards = {
+            name: SqlStorage(engine, partitioned, auto_migrate)
+            for name, engine in engines.items()
+        }
+        self.ring = HashRing(ring, vnodes)
+        self.previous = HashRing(previous, vnodes) if previous else None
+
+    def _owner(self, secret_key: str) -> SqlStorage:
+        return self.shards[self.ring.shard(secret_key)]
+
+    def _owners(self, secret_key: str) -> list[SqlStorage]:
+        # the shard of secret_key, then the one it had before if different
+        names = [self.ring.shard(secret_key)]
+        if self.previous is not None:
+            previous = self.previous.shard(secret_key)
+            if previous != names[0]:
+                names.append(previous)
+        return [self.shards[name] for name in names]
+
+    async def _each(self, method: str, *args) -> list:
+        return await asyncio.gather(*(
+            getattr(shard, method)(*args) for shard in self.shards.values()
+        ))
+
+    async def start(self) -> None:
+        await self._each('start')
+
+    async def close(self) -> None:
+        await self._each('close')
+
+    async def maintain(self) -> None:
+        await self._each('maintain')
+
+    async def create(self, secret: models.Secret) -> None:
+        await self._owner(secret.secret_key).create(secret)
+
+    async def create_many(self, secrets: list[models.Secret]) -> None:
+        by_shard: dict[str, list[models.Secret]] = {}
+        for secret in secrets:
+            by_shard.setdefault(
+                self.ring.shard(secret.secret_key), []
+            ).append(secret)
+        await asyncio.gather(*(
+            self.shards[name].create_many(batch)
+            for name, batch in by_shard.items()
+        ))
+
+    async def create_stream(
+            self,
+            secret: models.Secret,
+            chunks: AsyncIterable[bytes]
+    ) -> None:
+        await self._owner(secret.secret_key).create_stream(secret, chunks)
+
+    async def iter_chunks(
+            self,
+            secret_key: str,
+            secret_id: str
+    ) -> AsyncIterator[bytes]:
+        for shard in self._owners(secret_key):
+            found = False
+            async for data in shard.iter_chunks(secret_key, secret_id):
+                found = True
+                yield data
+            if found:
+                return
+
+    async def get(self, secret_key: str) -> Row | None:
+        for shard in self._owners(secret_key):
+            row = await shard.get(secret_key)
+            if row is not None:
+                return row
+        return None
+
+    async def consume(self, secret_key: str) -> Row | None:
+        for shard in self._owners(secret_key):
+            claimed = await shard.consume(secret_key)
+            if claimed is not None:
+                return claimed
+        return None
+
+    async def mark_read(self, secret_key: str) -> None:
+        # only the shard holding the claim has a row to update
+        for shard in self._owners(secret_key):
+            await shard.mark_read(secret_key)
+
+    async def release(
+            self,
+            secret_key: str,
+            failed: bool = False,
+            max_failed_attempts: int = 0
+    ) -> None:
+        # only the shard holding the claim has a row to update
+        for shard in self._owners(secret_key):
+            await shard.release(secret_key, failed, max_failed_attempts)
+
+    async def delete_expired(
+            self,
+            batch_size: int,
+            consumed_grace: timedelta,
+            read_retention: timedelta = timedelta(0)
+    ) -> int:
+        return sum(
+            await self._each(
+                'delete_expired', batch_size, consumed_grace, read_retention
+            )
+        )
+
+    async def stats(self) -> dict[str, int]:
+        totals = {'live': 0, 'consumed': 0}
+        for stats in await self._each('stats'):
+            for state, count in stats.items():
+                totals[state] += count
+        return totals
+
+    async def claim_receipts(self, limit: int, lease: timedelta) -> list:
+        # up to limit from every shard: trimming would leave the rest
+        # leased but undelivered
+        claimed = await self._each('claim_receipts', limit, lease)
+        return [receipt for shard in claimed for receipt in shard]
+
+    async def finish_receipts(
+            self,
+            done: list[str],
+            retries: dict[str, datetime]
+    ) -> None:
+        # receipts stay on the shard the secret was read from, which
+        # rebalance() may have moved it away from since
+        await self._each('finish_receipts', done, retries)
+
+    async def next_receipt_at(self) -> datetime | None:
+        return min(
+            (at for at in await self._each('next_receipt_at') if at),
+            default=None
+        )
+
+    async def listen_receipts(self, callback: Callable[[str], None]) -> bool:
+        return all(await self._each('listen_receipts', callback))
+
+    async def _recover(self) -> None:
+        '''
+        Finish or undo the moves an earlier rebalance() left halfway. A
+        secret hidden on two shards had its move committed: its copy on
+        the shard it belongs to (or any one) is shown and the others are
+        deleted. A secret hidden on one shard only is a copy whose move
+        never committed, or an original left over once its copy was
+        shown, and is deleted.
+        '''
+
+        hidden: dict[str, list[str]] = {}
+        keys: dict[str, str] = {}
+        for name, shard in self.shards.items():
+            async with shard.engine.connect() as conn:
+                rows = (await conn.execute(
+                    select(secret_table.c.id, secret_table.c.secret_key).
+                    where(HIDDEN)
+                )).all()
+            for row in rows:
+                hidden.setdefault(row.id, []).append(name)
+                keys[row.id] = row.secret_key
+        for secret_id, names in hidden.items():
+            if len(names) > 1:
+                owner = self.ring.shard(keys[secret_id])
+                keep = owner if owner in names else names[0]
+                async with self.shards[keep].engine.begin() as conn:
+                    await conn.execute(
+                        update(secret_table).
+                        where(secret_table.c.id == secret_id, HIDDEN).
+                        values(consumed=False)
+                    )
+                names = [name for name in names if name != keep]
+            for name in names:
+                async with self.shards[name].engine.begin() as conn:
+                    await conn.execute(delete(secret_table).where(
+                        secret_table.c.id == secret_id, HIDDEN
+                    ))
+
+    async def rebalance(self, batch_size: int = 1000) -> int:
+        '''
+        Move every live secret that is not on its shard there, in batches
+        of batch_size. Returns the number moved. A secret is never
+        readable on two shards; a read during its move finds it hidden
+        and is asked to retry. Moves interrupted by a crash are recovered
+        first, so rebalance() must not run twice at the same time.
+        '''
+
+        await self._recover()
+        moved = 0
+        for name, shard in self.shards.items():
+            after = None
+            while rows := await _scan(shard.engine, after, batch_size):
+                after = rows[-1].id
+                by_target: dict[str, list] = {}
+                for row in rows:
+                    target = self.ring.shard(row.secret_key)
+                    if target != name:
+                        by_target.setdefault(target, []).append(row)
+                for target, batch in by_target.items():
+                    count = await _move(
+                        shard.engine,
+                        self.shards[target].engine,
+                        batch
+                    )
+                    secrets_moved_total.inc(count)
+                    moved += count
+        return moved
@@ -0,0 +1,679 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta, UTC
+import logging
+from typing import AsyncIterable, AsyncIterator, Callable
+import uuid
+
+from sqlalchemy import (
+    Row,
+    bindparam,
+    case,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    update
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from app import database as db
+from app import deadline
+from app import migrations
+from app import models
+from app import partitions
+from app.config import (
+    PARTITION_PREMAKE_DAYS,
+    PARTITION_RETIRE,
+    REAPER_CONSUMED_GRACE,
+    SECRET_MAX_TTL
+)
+from app.instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+
+# The hot path statements are built once at import and work on the table,
+# not the mapped class: no ORM bookkeeping, rows come back as plain tuples
+# of the needed columns. Each has a variant adding the created_at of a
+# UUIDv7 key.
+secret_table = models.Secret.__table__
+chunk_table = models.SecretChunk.__table__
+receipt_table = models.ReadReceipt.__table__
+
+_BY_CREATED_AT = secret_table.c.created_at == bindparam('key_created_at')
+
+
+def _as_row(secret: models.Secret) -> dict:
+    row = {
+        'id': secret.id,
+        'secret_key': secret.secret_key,
+        'secret_data': secret.secret_data,
+        'passphrase_hash': secret.passphrase_hash,
+        'expires_at': secret.expires_at,
+        'consumed': False,
+        'is_stream': False,
+        'callback_url': secret.callback_url
+    }
+    if secret.created_at is not None:
+        row['created_at'] = secret.created_at
+    return row
+
+
+def _parse_key(secret_key: str) -> tuple[str, datetime | None] | None:
+    '''
+    Normalized key and the creation time it carries, or None if the key
+    can not be stored in a UUID column and so can not exist. The creation
+    time of UUIDv7 keys lets a partitioned table scan a single partition.
+    '''
+
+    try:
+        value = uuid.UUID(secret_key)
+    except ValueError:
+        return None
+    return str(value), partitions.uuid_created_at(value)
+
+
+def _by_key(secret_key: str, created_at: datetime | None) -> list:
+    clauses = [secret_table.c.secret_key == secret_key]
+    if created_at is not None:
+        clauses.append(secret_table.c.created_at == created_at)
+    return clauses
+
+
+def _key_params(secret_key: str) -> tuple[bool, dict] | None:
+    '''
+    Parameters of the prebuilt statements and whether the variant matching
+    on created_at is needed
+    '''
+
+    parsed = _parse_key(secret_key)
+    if parsed is None:
+        return None
+    secret_key, created_at = parsed
+    params = {'key': secret_key}
+    if created_at is not None:
+        params['key_created_at'] = created_at
+    return created_at is not None, params
+
+
+INSERT_SECRET = insert(secret_table)
+
+_LOOKUP = (
+    select(
+        secret_table.c.consumed,
+        secret_table.c.expires_at,
+        secret_table.c.consumed_at,
+        secret_table.c.failed_attempts,
+        secret_table.c.read_at
+    ).
+    where(secret_table.c.secret_key == bindparam('key'))
+)
+LOOKUP = (_LOOKUP, _LOOKUP.where(_BY_CREATED_AT))
+
+_CONSUME = (
+    update(secret_table).
+    where(
+        secret_table.c.secret_key == bindparam('key'),
+        secret_table.c.consumed.is_(False),
+        or_(
+            secret_table.c.expires_at.is_(None),
+            secret_table.c.expires_at > bindparam('now')
+        )
+    ).
+    values(consumed=True, consumed_at=bindparam('now')).
+    returning(
+        secret_table.c.id,
+        secret_table.c.secret_data,
+        secret_table.c.passphrase_hash,
+        secret_table.c.is_stream
+    )
+)
+CONSUME = (_CONSUME, _CONSUME.where(_BY_CREATED_AT))
+
+INSERT_RECEIPT = insert(receipt_table)
+NOTIFY_RECEIPT = select(
+    func.pg_notify(bindparam('channel'), bindparam('key'))
+)
+
+# Postgres channel notified when a read receipt is written
+RECEIPT_CHANNEL = 'read_receipts'
+
+# the listening connection is checked every LISTEN_CHECK_INTERVAL seconds
+# and reopened after LISTEN_RETRY_BASE seconds, doubling up to
+# LISTEN_RETRY_MAX while it can not be
+LISTEN_CHECK_INTERVAL = 10
+LISTEN_RETRY_BASE = 1
+LISTEN_RETRY_MAX = 60
+
+SET_STATEMENT_TIMEOUT = select(
+    func.set_config('statement_timeout', bindparam('timeout'), True)
+)
+
+# the connection default statement_timeout is kept, saving a round trip,
+# for requests with at most this fraction of it less time left
+STATEMENT_TIMEOUT_SLACK = 0.1
+
+# query_canceled, raised by Postgres when statement_timeout fires
+QUERY_CANCELED = '57014'
+
+# rows of a table or an index and of its partitions, as last estimated by
+# VACUUM and ANALYZE; -1 until a relation has been analyzed
+ESTIMATE_ROWS = text('''
+    SELECT coalesce(sum(greatest(c.reltuples, 0)), 0)::bigint
+    FROM pg_class c
+    WHERE c.oid = to_regclass(:relation)
+    OR c.oid IN (
+        SELECT inhrelid FROM pg_inherits
+        WHERE inhparent = to_regclass(:relation)
+    )
+''')
+
+
+class SqlStorage:
+    '''
+    Secrets in a SQL database through SQLAlchemy: Postgres, or SQLite for
+    a single node. Without an engine the application engine from
+    app.database is used. partitioned selects the Postgres day partition
+    layout from app.partitions. start() only checks the schema version
+    unless auto_migrate is set, see app.migrations.
+    '''
+
+    def __init__(
+            self,
+            engine: AsyncEngine | None = None,
+            partitioned: bool = False,
+            auto_migrate: bool = False
+    ) -> None:
+        self.engine = engine
+        self.partitioned = partitioned
+        self.auto_migrate = auto_migrate
+        self._sessionmaker = async_sessionmaker(engine) if engine else None
+        self._notify = False
+        self._listener = None
+
+    def _session(self):
+        return (self._sessionmaker or db.async_session)()
+
+    @asynccontextmanager
+    async def _bounded_session(self):
+        '''
+        A session within the request deadline, if there is one: checking
+        out a connection, timed as the db_pool_wait stage, waits no longer
+        than the time left, and on Postgres that is the statement_timeout
+        of the transaction unless the connection default is about as short
+        '''
+
+        async with self._session() as session:
+            left = deadline.check()
+            try:
+                with timed('db_pool_wait'):
+                    async with asyncio.timeout(left):
+                        connection = await session.connection()
+            except TimeoutError as exc:
+                if left is None:
+                    raise
+                raise deadline.DeadlineExceeded(
+                    'No database connection within the deadline'
+                ) from exc
+            if left is None:
+                yield session
+                return
+            left = deadline.check()
+            default = db.DATABASE.connection_statement_timeout
+            if connection.dialect.name == 'postgresql' and not (
+                default and left >= default * (1 - STATEMENT_TIMEOUT_SLACK)
+            ):
+                await session.execute(
+                    SET_STATEMENT_TIMEOUT,
+                    {'timeout': str(max(1, int(left * 1000)))}
+                )
+            try:
+                yield session
+            except DBAPIError as exc:
+                if getattr(exc.orig, 'sqlstate', None) == QUERY_CANCELED:
+                    raise deadline.DeadlineExceeded(
+                        'Statement cancelled at the deadline'
+                    ) from exc
+                raise
+
+    async def start(self) -> None:
+        engine = self.engine or db.engine
+        if self.partitioned and engine.dialect.name != 'postgresql':
+            raise RuntimeError('Partitioning needs Postgres')
+        if self.engine is None:
+            db.log_engine_settings(engine, db.DATABASE)
+        if self.auto_migrate:
+            await migrations.upgrade(engine, self.partitioned)
+            await self.maintain()
+        else:
+            await migrations.verify(engine)
+        self._notify = engine.dialect.name == 'postgresql'
+
+    async def maintain(self) -> None:
+        '''
+        Create upcoming day partitions and retire expired ones. Runs after
+        python -m app.migrations upgrade and in the worker running the
+        reaper, skipped while migrations or another maintainer hold the
+        advisory lock.
+        '''
+
+        if self.partitioned:
+            await partitions.maintain(
+                self.engine or db.engine,
+                PARTITION_PREMAKE_DAYS,
+                timedelta(seconds=SECRET_MAX_TTL + REAPER_CONSUMED_GRACE),
+                PARTITION_RETIRE,
+                lock_key=migrations.ADVISORY_LOCK_KEY
+            )
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        if self.engine is None:
+            await db.dispose_engine()
+        else:
+            await self.engine.dispose()
+
+    async def create(self, secret: models.Secret) -> None:
+        with timed('db_insert'):
+            async with self._bounded_session() as session:
+                await session.execute(INSERT_SECRET, _as_row(secret))
+                await session.commit()
+
+    async def create_many(self, secrets: list[models.Secret]) -> None:
+        '''
+        Insert all secrets with one multi-row INSERT in a single
+        transaction
+        '''
+
+        with timed('db_insert'):
+            async with self._bounded_session() as session:
+                await session.execute(
+                    INSERT_SECRET,
+                    [_as_row(secret) for secret in secrets]
+                )
+                await session.commit()
+
+    async def create_stream(
+            self,
+            secret: models.Secret,
+            chunks: AsyncIterable[bytes]
+    ) -> None:
+        '''
+        Insert a streamed secret and its chunks in one transaction, so it
+        becomes visible only when complete. The chunks are read first and
+        written with one executemany, so no connection is held while the
+        client uploads.
+        '''
+
+        # chunks carry the partition key only when there is one
+        created_at = (
+            {} if secret.created_at is None
+            else {'created_at': secret.created_at}
+        )
+        rows = []
+        async for data in chunks:
+            rows.append({
+                'secret_id': secret.id,
+                'seq': len(rows),
+                'data': data,
+                **created_at
+            })
+        with timed('db_insert'):
+            async with self._bounded_session() as session:
+                await session.execute(
+                    insert(secret_table).
+                    values({**_as_row(secret), 'is_stream': True})
+                )
+                if rows:
+                    await session.execute(insert(chunk_table), rows)
+                await session.commit()
+
+    async def iter_chunks(
+            self,
+            secret_key: str,
+            secret_id: str
+    ) -> AsyncIterator[bytes]:
+        '''
+        Yield the encrypted chunks of a streamed secret in order.
+        A single server side cursor is used, so all chunks come from one
+        snapshot even if the secret is reaped meanwhile.
+        '''
+
+        async with self._session() as session:
+            result = await session.stream(
+                select(chunk_table.c.data).
+                where(chunk_table.c.secret_id == secret_id).
+                order_by(chunk_table.c.seq).
+                execution_options(yield_per=4)
+            )
+            async for data in result.scalars():
+                yield data
+
+    async def get(self, secret_key: str) -> Row | None:
+        '''
+        The consumed flag, expiry time, consumed_at, failed attempts and
+        read_at of a secret
+        '''
+
+        key_params = _key_params(secret_key)
+        if key_params is None:
+            return None
+        by_time, params = key_params
+        with timed('db_lookup'):
+            async with self._bounded_session() as session:
+                result = await session.execute(LOOKUP[by_time], params)
+                return result.first()
+
+    async def consume(self, secret_key: str) -> Row | None:
+        '''
+        Claim a one-time secret and mark it consumed in a single statement
+        '''
+
+        key_params = _key_params(secret_key)
+        if key_params is None:
+            return None
+        by_time, params = key_params
+        params['now'] = datetime.now(UTC)
+        with timed('db_consume'):
+            async with self._bounded_session() as session:
+                result = await session.execute(CONSUME[by_time], params)
+                claimed = result.first()
+                await session.commit()
+        return claimed
+
+    async def mark_read(self, secret_key: str) -> None:
+        '''
+        Record that a claimed secret has been delivered; its data is wiped
+        and only the row is kept, for its status. A secret with a
+        callback_url gets its read receipt written to the outbox, due at
+        once, in the same transaction.
+        '''
+
+        parsed = _parse_key(secret_key)
+        if parsed is None:
+            return
+        now = datetime.now(UTC)
+        with timed('db_mark_read'):
+            async with self._session() as session:
+                result = await session.execute(
+                    update(secret_table).
+                    where(
+                        *_by_key(*parsed),
+                        secret_table.c.consumed.is_(True),
+                        secret_table.c.read_at.is_(None)
+                    ).
+                    values(read_at=now, secret_data=b'').
+                    returning(
+                        secret_table.c.id,
+                        secret_table.c.is_stream,
+                        secret_table.c.callback_url
+                    )
+                )
+                read = result.one_or_none()
+                if read is None:
+                    return
+                if read.is_stream:
+                    await session.execute(
+                        delete(chunk_table).
+                        where(chunk_table.c.secret_id == read.id)
+                    )
+                callback_url = read.callback_url
+                if callback_url is not None:
+                    await session.execute(INSERT_RECEIPT, {
+                        'secret_key': parsed[0],
+                        'callback_url': callback_url,
+                        'read_at': now,
+                        'next_attempt_at': now,
+                        'attempts': 0
+                    })
+                    if self._notify:
+                        # delivered to listeners on commit
+                        await session.execute(
+                            NOTIFY_RECEIPT,
+                            {'channel': RECEIPT_CHANNEL, 'key': parsed[0]}
+                        )
+                await session.commit()
+
+    async def release(
+            self,
+            secret_key: str,
+            failed: bool = False,
+            max_failed_attempts: int = 0
+    ) -> None:
+        '''
+        Undo a claim, counting a failed attempt in the same statement
+        '''
+
+        parsed = _parse_key(secret_key)
+        if parsed is None:
+            return
+        values = {'consumed': False, 'consumed_at': None}
+        if failed:
+            attempts = secret_table.c.failed_attempts + 1
+            values['failed_attempts'] = attempts
+            if max_failed_attempts:
+                exhausted = attempts >= max_failed_attempts
+                values['consumed'] = exhausted
+                values['consumed_at'] = case(
+                    (exhausted, datetime.now(UTC)),
+                    else_=None
+                )
+        with timed('db_release'):
+            async with self._session() as session:
+                await session.execute(
+                    update(secret_table).
+                    where(
+                        *_by_key(*parsed),
+                        secret_table.c.consumed.is_(True),
+                        # a claim always sets consumed_at; rows hidden
+                        # while a shard rebalance copies them have none
+                        secret_table.c.consumed_at.is_not(None)
+                    ).
+                    values(**values)
+                )
+                await session.commit()
+
+    async def delete_expired(
+            self,
+            batch_size: int,
+            consumed_grace: timedelta,
+            read_retention: timedelta = timedelta(0)
+    ) -> int:
+        '''
+        Delete a batch of expired and a batch of consumed secrets; read
+        secrets are kept for read_retention after the read. Rows locked by other reapers are skipped; SQLite has no row locks
+        and ignores FOR UPDATE. Partitioned tables leave expired secrets
+        to the partition drop.
+        '''
+
+        now = datetime.now(UTC)
+        expired = (
+            select(models.Secret.id).
+            where(
+                models.Secret.consumed.is_(False),
+                models.Secret.expires_at.is_not(None),
+                models.Secret.expires_at <= now
+            ).
+            limit(batch_size).
+            with_for_update(skip_locked=True)
+        )
+        consumed = (
+            select(models.Secret.id).
+            where(
+                models.Secret.consumed.is_(True),
+                models.Secret.consumed_at <= now - consumed_grace,
+                or_(
+                    models.Secret.read_at.is_(None),
+                    models.Secret.read_at <= now - read_retention
+                )
+            ).
+            limit(batch_size).
+            with_for_update(skip_locked=True)
+        )
+        deleted = 0
+        async with self._session() as session:
+            for doomed in (consumed,) if self.partitioned else (
+                expired, consumed
+            ):
+                result = await session.execute(
+                    delete(models.Secret).
+                    where(models.Secret.id.in_(doomed.scalar_subquery())).
+                    execution_options(synchronize_session=False)
+                )
+                deleted += result.rowcount
+            await session.commit()
+        return deleted
+
+    async def stats(self) -> dict[str, int]:
+        '''
+        Live and consumed secrets. Postgres gives the planner estimates of
+        the table and of the partial index on consumed rows, so the reaper
+        does not count the whole table every cycle; SQLite counts.
+        '''
+
+        async with self._session() as session:
+            if (self.engine or db.engine).dialect.name == 'postgresql':
+                total, consumed = [
+                    (await session.execute(
+                        ESTIMATE_ROWS, {'relation': relation}
+                    )).scalar_one()
+                    for relation in ('secrets', 'ix_secrets_consumed_at')
+                ]
+                consumed = min(consumed, total)
+                return {'live': total - consumed, 'consumed': consumed}
+            result = await session.execute(
+                select(
+                    func.count(),
+                    func.count().filter(models.Secret.consumed.is_(True))
+                ).select_from(models.Secret)
+            )
+        total, consumed = result.one()
+        return {'live': total - consumed, 'consumed': consumed}
+
+    async def claim_receipts(self, limit: int, lease: timedelta) -> list:
+        '''
+        Up to limit receipts due for a delivery attempt, oldest first. They
+        are not due again for lease, so concurrent dispatchers skip them;
+        rows locked by another dispatcher are skipped on Postgres.
+        '''
+
+        now = datetime.now(UTC)
+        due = (
+            select(receipt_table.c.secret_key).
+            where(receipt_table.c.next_attempt_at <= now).
+            order_by(receipt_table.c.next_attempt_at).
+            limit(limit).
+            with_for_update(skip_locked=True)
+        )
+        async with self._session() as session:
+            result = await session.execute(
+                update(receipt_table).
+                where(receipt_table.c.secret_key.in_(due.scalar_subquery())).
+                values(next_attempt_at=now + lease).
+                returning(
+                    receipt_table.c.secret_key,
+                    receipt_table.c.callback_url,
+                    receipt_table.c.read_at,
+                    receipt_table.c.attempts
+                )
+            )
+            claimed = result.all()
+            await session.commit()
+        return claimed
+
+    async def finish_receipts(
+            self,
+            done: list[str],
+            retries: dict[str, datetime]
+    ) -> None:
+        '''
+        Delete the receipts in done and schedule the next attempt of
+        those in retries
+        '''
+
+        async with self._session() as session:
+            if done:
+                await session.execute(
+                    delete(receipt_table).
+                    where(receipt_table.c.secret_key.in_(done))
+                )
+            if retries:
+                await session.execute(
+                    update(receipt_table).
+                    where(receipt_table.c.secret_key == bindparam('key')).
+                    values(
+                        attempts=receipt_table.c.attempts + 1,
+                        next_attempt_at=bindparam('at')
+                    ).
+                    execution_options(synchronize_session=False),
+                    [{'key': key, 'at': at} for key, at in retries.items()]
+                )
+            await session.commit()
+
+    async def next_receipt_at(self) -> datetime | None:
+        async with self._session() as session:
+            return await session.scalar(
+                select(func.min(receipt_table.c.next_attempt_at))
+            )
+
+    async def listen_receipts(self, callback: Callable[[str], None]) -> bool:
+        '''
+        Call callback with the secret key of every read receipt written
+        from now on. Needs asyncpg on a direct connection, LISTEN does not
+        work through PgBouncer in transaction mode; returns False when
+        receipts have to be polled for instead. The listening connection
+        is opened outside the pool and reopened when it drops, until
+        close().
+        '''
+
+        engine = self.engine or db.engine
+        if engine.dialect.driver != 'asyncpg' or db.DATABASE.pgbouncer:
+            return False
+        self._listener = asyncio.create_task(self._listen(engine, callback))
+        return True
+
+    async def _listen(
+            self,
+            engine: AsyncEngine,
+            callback: Callable[[str], None]
+    ) -> None:
+        import asyncpg
+
+        _, params = engine.dialect.create_connect_args(engine.url)
+        params['server_settings'] = {
+            'application_name': f'{db.DATABASE.application_name}-listener'
+        }
+        delay = LISTEN_RETRY_BASE
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(**params)
+                await connection.add_listener(
+                    RECEIPT_CHANNEL,
+                    lambda conn, pid, channel, payload: callback(payload)
+                )
+                delay = LISTEN_RETRY_BASE
+                # notifications arrive between the checks, which notice a
+                # connection that dropped without being closed
+                while True:
+                    await asyncio.sleep(LISTEN_CHECK_INTERVAL)
+                    async with asyncio.timeout(LISTEN_CHECK_INTERVAL):
+                        await connection.execute('SELECT 1')
+            except Exception as exc:
+                logger.warning(
+                    'Read receipt listener lost, retrying in %ss: %r',
+                    delay, exc
+                )
+            finally:
+                if connection is not None:
+                    connection.terminate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX)
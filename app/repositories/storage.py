@@ -0,0 +1,135 @@
+'''
+Storage backends for secrets
+'''
+
+from datetime import datetime, timedelta
+from typing import AsyncIterable, AsyncIterator, Callable, Protocol
+
+from app import models
+
+
+class ClaimedSecret(Protocol):
+    id: str
+    secret_data: bytes
+    passphrase_hash: str
+    is_stream: bool
+
+
+class ReadReceipt(Protocol):
+    secret_key: str
+    callback_url: str
+    read_at: datetime
+    attempts: int
+
+
+class Storage(Protocol):
+    '''
+    What the repository needs from a storage backend.
+
+    Secrets arrive already encrypted and hashed; backends only keep them
+    and enforce the one-time semantics: consume must let exactly one of
+    concurrent callers claim a secret. Once a claimed secret has been
+    delivered, mark_read records it and, for a secret with a callback_url,
+    writes its read receipt in the same transaction.
+    '''
+
+    async def start(self) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def maintain(self) -> None: ...
+
+    async def create(self, secret: models.Secret) -> None: ...
+
+    async def create_many(self, secrets: list[models.Secret]) -> None: ...
+
+    async def create_stream(
+            self,
+            secret: models.Secret,
+            chunks: AsyncIterable[bytes]
+    ) -> None: ...
+
+    def iter_chunks(
+            self,
+            secret_key: str,
+            secret_id: str
+    ) -> AsyncIterator[bytes]: ...
+
+    async def get(self, secret_key: str): ...
+
+    async def consume(self, secret_key: str) -> ClaimedSecret | None: ...
+
+    async def mark_read(self, secret_key: str) -> None: ...
+
+    async def release(
+            self,
+            secret_key: str,
+            failed: bool = False,
+            max_failed_attempts: int = 0
+    ) -> None: ...
+
+    async def delete_expired(
+            self,
+            batch_size: int,
+            consumed_grace: timedelta,
+            read_retention: timedelta = timedelta(0)
+    ) -> int: ...
+
+    async def stats(self) -> dict[str, int]: ...
+
+    async def claim_receipts(
+            self,
+            limit: int,
+            lease: timedelta
+    ) -> list[ReadReceipt]: ...
+
+    async def finish_receipts(
+            self,
+            done: list[str],
+            retries: dict[str, datetime]
+    ) -> None: ...
+
+    async def next_receipt_at(self) -> datetime | None: ...
+
+    async def listen_receipts(
+            self,
+            callback: Callable[[str], None]
+    ) -> bool: ...
+
+
+def build_storage(backend: str) -> Storage:
+    '''
+    Storage for the STORAGE_BACKEND setting
+    '''
+
+    if backend == 'sql':
+        from app.config import AUTO_MIGRATE, PARTITIONING_ENABLED
+        from .sql_storage import SqlStorage
+        return SqlStorage(
+            partitioned=PARTITIONING_ENABLED,
+            auto_migrate=AUTO_MIGRATE
+        )
+    if backend == 'sharded':
+        from app.config import (
+            AUTO_MIGRATE,
+            DB_SHARD_PREVIOUS_RING,
+            DB_SHARD_RING,
+            DB_SHARD_VNODES,
+            DB_SHARDS,
+            PARTITIONING_ENABLED
+        )
+        from app.database import build_shard_engines
+        from .sharded_storage import ShardedStorage
+        return ShardedStorage(
+            build_shard_engines(DB_SHARDS),
+            DB_SHARD_RING,
+            DB_SHARD_PREVIOUS_RING,
+            DB_SHARD_VNODES,
+            PARTITIONING_ENABLED,
+            AUTO_MIGRATE
+        )
+    if backend == 'memory':
+        from app.config import MEMORY_SHARDS, MEMORY_WHEEL_RESOLUTION
+        from .memory_storage import MemoryStorage
+        return MemoryStorage(MEMORY_SHARDS, MEMORY_WHEEL_RESOLUTION)
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -1,6 +1,41 @@
-from typing import Optional
+from datetime import datetime
+import ipaddress
+from typing import Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import AnyHttpUrl, BaseModel, Field, field_validator
+
+from .config import (
+    BATCH_MAX_SIZE,
+    READ_RECEIPTS_ENABLED,
+    RECEIPT_CALLBACK_HOSTS,
+    SECRET_MAX_DECOMPRESSED_SIZE
+)
+
+
+def check_callback_url(url: str | None) -> str | None:
+    '''
+    Refuse callback URLs while read receipts are off, to hosts outside
+    RECEIPT_CALLBACK_HOSTS if that is set, and to addresses that are not
+    public unless listed there. Names are checked when the receipt is
+    sent, see app.receipts.
+    '''
+
+    if url is None:
+        return None
+    if not READ_RECEIPTS_ENABLED:
+        raise ValueError('Read receipts are disabled')
+    host = AnyHttpUrl(url).host
+    if host in RECEIPT_CALLBACK_HOSTS:
+        return url
+    if RECEIPT_CALLBACK_HOSTS:
+        raise ValueError(f'Callbacks to {host} are not allowed')
+    try:
+        address = ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        return url
+    if not address.is_global:
+        raise ValueError(f'Callbacks to {host} are not allowed')
+    return url
 
 
 class SecretBase(BaseModel):
@@ -16,6 +51,35 @@ class SecretBase(BaseModel):
 class SecretCreate(SecretBase):
     '''Schema for creating secrets'''
 
+    callback_url: Optional[str] = Field(
+        None,
+        max_length=2048,
+        description='URL a read receipt is POSTed to once the secret is read'
+    )
+
+    @field_validator('secret')
+    @classmethod
+    def _check_secret_size(cls, secret: str) -> str:
+        # a larger secret would be stored compressed but fail to decrypt
+        if len(secret.encode()) > SECRET_MAX_DECOMPRESSED_SIZE:
+            raise ValueError(
+                f'Secret is larger than {SECRET_MAX_DECOMPRESSED_SIZE} bytes'
+            )
+        return secret
+
+    @field_validator('callback_url')
+    @classmethod
+    def _check_callback_url(cls, url: str | None) -> str | None:
+        return check_callback_url(url)
+
+
+class SecretBatchCreate(BaseModel):
+    '''Schema for creating many secrets at once'''
+
+    secrets: list[SecretCreate] = Field(
+        ..., min_length=1, max_length=BATCH_MAX_SIZE
+    )
+
 
 class SecretKeyResponse(BaseModel):
     '''Recponse schema containing the generated secret key'''
@@ -26,3 +90,24 @@ class SecretResponse(BaseModel):
     '''Response schema containing the dewcrypted secret'''
 
     secret: str
+
+
+class SecretBatchItemResult(BaseModel):
+    '''Result of creating one secret of a batch'''
+
+    index: int
+    secret_key: Optional[str] = None
+    error: Optional[str] = None
+
+
+class SecretBatchResponse(BaseModel):
+    '''Response schema with a result for every secret of a batch'''
+
+    results: list[SecretBatchItemResult]
+
+
+class SecretStatusResponse(BaseModel):
+    '''Response schema with the state of a secret, which is not consumed'''
+
+    status: Literal['unread', 'read', 'expired', 'locked']
+    read_at: Optional[datetime] = None
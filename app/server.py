@@ -0,0 +1,239 @@
+'''
+Production server: python -m app.server [--workers N] [--host H] [--port P]
+
+The master binds the socket, imports the application once and forks
+uvicorn workers that share the socket, so crypto work uses every core.
+It restarts workers that die, backing off while they keep dying and
+giving up with exit status 1 after too many restarts, and on SIGTERM or
+SIGINT lets each of them finish its requests in flight, streamed secret
+reads included, before exiting. uvloop and httptools are used when
+installed.
+'''
+
+import argparse
+import asyncio
+from collections import deque
+import logging
+import os
+import signal
+import sys
+import time
+
+logger = logging.getLogger('uvicorn.error')
+
+# seconds to wait before replacing a worker that died, doubled for every
+# other restart within RESPAWN_WINDOW seconds up to RESPAWN_DELAY_MAX; the
+# master gives up after RESPAWN_LIMIT restarts within the window
+RESPAWN_DELAY = 1
+RESPAWN_DELAY_MAX = 30
+RESPAWN_WINDOW = 300
+RESPAWN_LIMIT = 10
+
+
+def _respawn_delay(recent: int) -> float:
+    return min(RESPAWN_DELAY * 2 ** recent, RESPAWN_DELAY_MAX)
+
+
+def _configure(workers: int | None) -> int:
+    # must happen before the app modules read their configuration
+    from dotenv import load_dotenv
+    load_dotenv()
+    if workers is None:
+        workers = int(os.getenv('WEB_WORKERS', os.cpu_count() or 1))
+    os.environ['WEB_WORKERS'] = str(workers)
+    # the crypto threads of all workers together match the cores
+    os.environ.setdefault(
+        'CRYPTO_MAX_WORKERS',
+        str(max(1, (os.cpu_count() or 1) // workers))
+    )
+    return workers
+
+
+def _event_loop() -> tuple[str, str]:
+    try:
+        import uvloop  # noqa: F401
+        loop = 'uvloop'
+    except ImportError:
+        loop = 'asyncio'
+    try:
+        import httptools  # noqa: F401
+        http = 'httptools'
+    except ImportError:
+        http = 'h11'
+    return loop, http
+
+
+def _migrate() -> None:
+    # once here rather than racing in every worker; the engine is
+    # disposed so no connection is shared with the forks
+    from app import migrations
+    from app.config import PARTITIONING_ENABLED
+
+    async def upgrade():
+        for engine in migrations.configured_engines():
+            try:
+                await migrations.upgrade(engine, PARTITIONING_ENABLED)
+            finally:
+                await engine.dispose()
+
+    asyncio.run(upgrade())
+
+
+class Master:
+    '''
+    Forks workers running config on sock and keeps workers of them alive
+    until stopped
+    '''
+
+    def __init__(self, config, sock, workers: int) -> None:
+        self.config = config
+        self.sock = sock
+        self.workers = workers
+        self.children: dict[int, int] = {}
+        self.stopping = False
+
+    def _serve(self, index: int) -> None:
+        import uvicorn
+        from app.main import app
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        app.state.background_tasks = index == 0
+        uvicorn.Server(self.config).run(sockets=[self.sock])
+
+    def spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._serve(index)
+            except BaseException:
+                logger.exception('Worker %d failed', index)
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        logger.info('Started worker %d [%d]', index, pid)
+
+    def stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _reap(self) -> list[int]:
+        exited = []
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            index = self.children.pop(pid, None)
+            if index is not None:
+                logger.info(
+                    'Worker %d [%d] exited with %d',
+                    index, pid, os.waitstatus_to_exitcode(status)
+                )
+                exited.append(index)
+        return exited
+
+    def _shutdown(self, timeout: float) -> None:
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            logger.warning('Killing worker [%d]', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.children.pop(pid)
+
+    def run(self, graceful_timeout: float) -> int:
+        '''
+        Serve until stopped; returns the exit status, 1 if workers kept
+        dying
+        '''
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        restarts: deque[float] = deque()
+        respawns: dict[int, float] = {}
+        code = 0
+        while not self.stopping:
+            time.sleep(0.2)
+            now = time.monotonic()
+            for index in self._reap():
+                while restarts and restarts[0] <= now - RESPAWN_WINDOW:
+                    restarts.popleft()
+                if len(restarts) >= RESPAWN_LIMIT:
+                    logger.error(
+                        'Workers restarted %d times within %d seconds, '
+                        'giving up', len(restarts), RESPAWN_WINDOW
+                    )
+                    self.stopping = True
+                    code = 1
+                    break
+                respawns[index] = now + _respawn_delay(len(restarts))
+                restarts.append(now)
+            for index, due in list(respawns.items()):
+                if due <= now and not self.stopping:
+                    del respawns[index]
+                    self.spawn(index)
+        logger.info('Shutting down %d workers', len(self.children))
+        # workers get the graceful timeout plus time for lifespan shutdown
+        self._shutdown(graceful_timeout + 10)
+        self.sock.close()
+        return code
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m app.server',
+        description='Run the application with a pool of worker processes'
+    )
+    parser.add_argument('--workers', type=int, help='default WEB_WORKERS')
+    parser.add_argument('--host', help='default SERVER_HOST')
+    parser.add_argument('--port', type=int, help='default SERVER_PORT')
+    args = parser.parse_args()
+    workers = _configure(args.workers)
+
+    import uvicorn
+    from app import config
+
+    if config.STORAGE_BACKEND == 'memory' and workers > 1:
+        parser.error('STORAGE_BACKEND=memory only works with one worker')
+    loop, http = _event_loop()
+    # logging is set up by uvicorn.Config
+    server_config = uvicorn.Config(
+        'app.main:app',
+        host=args.host or config.SERVER_HOST,
+        port=args.port or config.SERVER_PORT,
+        loop=loop,
+        http=http,
+        lifespan='on',
+        timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT,
+        proxy_headers=True,
+        forwarded_allow_ips=config.FORWARDED_ALLOW_IPS
+    )
+    if config.AUTO_MIGRATE:
+        _migrate()
+    # preload: the forks share the imported modules
+    server_config.load()
+    logger.info(
+        'Running %d workers with %s and %s', workers, loop, http
+    )
+    sock = server_config.bind_socket()
+    sys.exit(
+        Master(server_config, sock, workers).
+        run(config.SERVER_GRACEFUL_TIMEOUT)
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+from typing import AsyncIterable, AsyncIterator
+
+from .config import STREAM_CHUNK_SIZE, STREAM_MAX_SIZE
+
+
+class SecretTooLargeError(Exception):
+    '''Raised when a streamed secret exceeds the configured size limit'''
+
+
+async def read_frames(
+        chunks: AsyncIterable[bytes],
+        frame_size: int = STREAM_CHUNK_SIZE,
+        max_size: int = STREAM_MAX_SIZE
+) -> AsyncIterator[tuple[bytes, bool]]:
+    '''
+    Regroup an incoming byte stream into frames of frame_size bytes.
+    Yields (frame, last) pairs; the last frame may be short or empty.
+    At most one frame plus one incoming chunk is held in memory.
+    '''
+
+    buffer = bytearray()
+    ready = None
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_size:
+            raise SecretTooLargeError(
+                f'Secret is larger than {max_size} bytes'
+            )
+        buffer += chunk
+        while len(buffer) >= frame_size:
+            if ready is not None:
+                yield ready, False
+            ready = bytes(buffer[:frame_size])
+            del buffer[:frame_size]
+    if ready is not None:
+        if not buffer:
+            yield ready, True
+            return
+        yield ready, False
+    yield bytes(buffer), True
+
+
+async def with_last(items: AsyncIterable) -> AsyncIterator[tuple[object, bool]]:
+    '''
+    Yield (item, last) pairs by looking one item ahead
+    '''
+
+    previous = None
+    has_previous = False
+    async for item in items:
+        if has_previous:
+            yield previous, False
+        previous = item
+        has_previous = True
+    if has_previous:
+        yield previous, True
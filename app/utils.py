@@ -3,18 +3,45 @@ import base64
 from cryptography.fernet import Fernet
 from passlib.context import CryptContext
 
+from . import cipher
+from . import hashing
+from .executor import crypto_executor
+from .instrumentation import timed
+
 
 class PasswordManager:
     '''
-    Class for managing hash and password check
+    Class for managing hash and password check.
+    Uses the module level context from app.hashing unless given another.
     '''
 
-    def __init__(self, schemes=['bcrypt']):
-        self.pwd_context = CryptContext(schemes=schemes)
+    def __init__(self, pwd_context: CryptContext | None = None):
+        self.pwd_context = pwd_context or hashing.pwd_context
+        # copies of pwd_context hashing with another default scheme
+        self._contexts: dict[str, CryptContext] = {}
+
+    def __getstate__(self) -> dict:
+        # CryptContext itself can not be pickled, so process pool workers
+        # use their own module level context
+        return {}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+
+    def _context_for_ttl(self, ttl: int | None) -> CryptContext:
+        scheme = hashing.scheme_for_ttl(ttl)
+        if scheme is None:
+            return self.pwd_context
+        context = self._contexts.get(scheme)
+        if context is None:
+            context = self._contexts[scheme] = self.pwd_context.copy(
+                default=scheme
+            )
+        return context
 
-    def get_password_hash(self, password: str) -> str:
+    def get_password_hash(self, password: str, ttl: int | None = None) -> str:
         '''method for hashing pasword'''
-        return self.pwd_context.hash(password)
+        return self._context_for_ttl(ttl).hash(password)
 
     def verify_password(
             self,
@@ -27,34 +54,158 @@ class PasswordManager:
 
         return self.pwd_context.verify(password, hashed_password)
 
+    def needs_update(self, hashed_password: str) -> bool:
+        '''
+        Whether the hash uses a deprecated scheme or weaker settings
+        '''
+
+        return self.pwd_context.needs_update(hashed_password)
+
+    async def get_password_hash_async(
+            self,
+            password: str,
+            ttl: int | None = None
+    ) -> str:
+        '''
+        Hash password in the crypto executor
+        '''
+
+        with timed('hash'):
+            return await crypto_executor.run(
+                self.get_password_hash, password, ttl
+            )
+
+    async def verify_password_async(
+            self,
+            password: str,
+            hashed_password: str
+    ) -> bool:
+        '''
+        Compare password and hash in the crypto executor
+        '''
+
+        with timed('verify'):
+            return await crypto_executor.run(
+                self.verify_password, password, hashed_password
+            )
+
 
 class SecretManager:
-    def __init__(self, passphrase: str) -> None:
+    '''
+    Class for encrypting secrets with a passphrase.
+    New secrets use the versioned format from app.cipher, secrets stored
+    before it are plain Fernet tokens and still decrypt.
+    '''
+
+    def __init__(
+            self,
+            passphrase: str,
+            algorithm: str = cipher.CIPHER_ALGORITHM,
+            kdf: str = cipher.CIPHER_KDF
+    ) -> None:
         self.passphrase = passphrase
         self.key = self._get_key(passphrase)
+        self.envelope = cipher.Envelope(passphrase, algorithm, kdf)
+        self._fernet = None
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, '_fernet': None}
 
     @staticmethod
     def _get_key(passphrase: str) -> bytes:
         '''
-        get the encryption key from passphrase
+        get the legacy Fernet key from passphrase
         '''
 
         sha = hashlib.sha256()
         sha.update(passphrase.encode())
         return base64.urlsafe_b64encode(sha.digest())
 
-    def encrypt_secret(self, secret: str) -> str:
+    @property
+    def fernet(self) -> Fernet:
+        if self._fernet is None:
+            self._fernet = Fernet(self.key)
+        return self._fernet
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        '''
+        Encrypt raw bytes into a versioned envelope
+        '''
+
+        return self.envelope.encrypt(data)
+
+    def decrypt_bytes(self, encrypted_data: bytes) -> bytes:
+        '''
+        Decrypt an envelope or a legacy Fernet token into raw bytes
+        '''
+
+        if cipher.is_legacy(encrypted_data):
+            return self.fernet.decrypt(encrypted_data)
+        return self.envelope.decrypt(encrypted_data)
+
+    def encrypt_secret(self, secret: str) -> bytes:
         '''
         Encrypt the secret using the passphrase
         '''
 
-        f = Fernet(self.key)
-        return f.encrypt(secret.encode()).decode()
+        return self.encrypt_bytes(secret.encode())
 
-    def decrypt_secret(self, encrypted_secret: str) -> str:
+    def decrypt_secret(self, encrypted_secret: bytes) -> str:
         '''
         Decrypt the secret using the passphrase
         '''
 
-        f = Fernet(self.key)
-        return f.decrypt(encrypted_secret.encode()).decode()
+        return self.decrypt_bytes(encrypted_secret).decode()
+
+    async def encrypt_secret_async(self, secret: str) -> bytes:
+        '''
+        Encrypt the secret in the crypto executor
+        '''
+
+        with timed('encrypt'):
+            return await crypto_executor.run(self.encrypt_secret, secret)
+
+    async def decrypt_secret_async(self, encrypted_secret: bytes) -> str:
+        '''
+        Decrypt the secret in the crypto executor
+        '''
+
+        with timed('decrypt'):
+            return await crypto_executor.run(
+                self.decrypt_secret, encrypted_secret
+            )
+
+    async def decrypt_bytes_async(self, encrypted_data: bytes) -> bytes:
+        '''
+        Decrypt raw bytes in the crypto executor
+        '''
+
+        with timed('decrypt'):
+            return await crypto_executor.run(
+                self.decrypt_bytes, encrypted_data
+            )
+
+    async def stream_encryptor_async(self) -> cipher.StreamEncryptor:
+        '''
+        Start encrypting a streamed secret, deriving its key in the
+        crypto executor
+        '''
+
+        header = self.envelope.new_stream_header()
+        with timed('derive_key'):
+            key = await crypto_executor.run(self.envelope.derive_key, header)
+        return cipher.StreamEncryptor(header, key)
+
+    async def stream_decryptor_async(
+            self,
+            header_data: bytes
+    ) -> cipher.StreamDecryptor:
+        '''
+        Start decrypting a streamed secret, deriving its key in the
+        crypto executor
+        '''
+
+        header = self.envelope.read_stream_header(header_data)
+        with timed('derive_key'):
+            key = await crypto_executor.run(self.envelope.derive_key, header)
+        return cipher.StreamDecryptor(header, key)
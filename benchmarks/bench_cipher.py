@@ -0,0 +1,91 @@
+'''
+Encrypt and decrypt throughput of each cipher mode across secret sizes.
+
+Key derivation is measured separately, because it is paid once per
+secret regardless of its size:
+
+    python -m benchmarks.bench_cipher --iterations 200
+'''
+
+import argparse
+import os
+import time
+
+from cryptography.fernet import Fernet
+
+from app.cipher import ALGORITHMS, KDFS, Envelope, Header
+
+SIZES = [256, 4 * 1024, 64 * 1024, 1024 * 1024]
+
+
+def measure(function, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - started) / iterations
+
+
+def bench_kdf(iterations: int) -> None:
+    print(f'{"kdf":<10}{"ms":>10}')
+    for kdf in KDFS:
+        envelope = Envelope('benchmark passphrase', 'aesgcm', kdf)
+        header = Header.unpack(envelope.encrypt(b''))
+
+        def derive():
+            envelope._ciphers.clear()
+            envelope._get_cipher(header)
+
+        print(f'{kdf:<10}{measure(derive, iterations) * 1000:>10.3f}')
+    print()
+
+
+def bench_ciphers(iterations: int) -> None:
+    print(
+        f'{"mode":<16}{"size":>10}{"enc MB/s":>12}{"dec MB/s":>12}'
+        f'{"stored":>12}'
+    )
+    for size in SIZES:
+        data = os.urandom(size)
+        modes = {'legacy fernet': None, **{name: name for name in ALGORITHMS}}
+        for title, algorithm in modes.items():
+            if algorithm is None:
+                fernet = Fernet(Fernet.generate_key())
+                encrypt = lambda: fernet.encrypt(data)
+                token = encrypt()
+                decrypt = lambda: fernet.decrypt(token)
+                stored = len(token)
+            else:
+                envelope = Envelope('benchmark passphrase', algorithm, 'hkdf')
+                token = envelope.encrypt(data)
+                # reuse the derived key so only the cipher itself is timed;
+                # decrypt hits the per salt cache of the envelope
+                header = Header.unpack(token)
+                aead = envelope._get_cipher(header)
+                if algorithm == 'fernet':
+                    encrypt = lambda: aead.encrypt(data)
+                else:
+                    encrypt = lambda: aead.encrypt(
+                        header.nonce, data, header.pack()
+                    )
+                decrypt = lambda: envelope.decrypt(token)
+                stored = len(token)
+            megabytes = size / 1024 / 1024
+            print(
+                f'{title:<16}{size:>10}'
+                f'{megabytes / measure(encrypt, iterations):>12.1f}'
+                f'{megabytes / measure(decrypt, iterations):>12.1f}'
+                f'{stored:>12}'
+            )
+        print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+    bench_kdf(max(args.iterations // 20, 1))
+    bench_ciphers(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''
+Passphrase hashing cost per scheme.
+
+Prints hash and verify latency for each configuration, so HASH_* settings
+can be picked from numbers measured on the target hardware:
+
+    python -m benchmarks.bench_kdf --iterations 20
+'''
+
+import argparse
+import time
+
+from app.hashing import build_context, hmac_sha256
+
+CONFIGURATIONS = [
+    ('bcrypt rounds=10', 'bcrypt', {'bcrypt_rounds': 10}),
+    ('bcrypt rounds=12', 'bcrypt', {'bcrypt_rounds': 12}),
+    ('bcrypt rounds=14', 'bcrypt', {'bcrypt_rounds': 14}),
+    ('argon2id m=19MiB t=2', 'argon2', {
+        'argon2_memory_cost': 19456, 'argon2_time_cost': 2
+    }),
+    ('argon2id m=64MiB t=3', 'argon2', {
+        'argon2_memory_cost': 65536, 'argon2_time_cost': 3
+    }),
+    ('hmac_sha256', 'hmac_sha256', {}),
+]
+
+
+def measure(function, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - started) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    hmac_sha256.key = b'benchmark-key'
+    print(f'{"scheme":<24}{"hash ms":>10}{"verify ms":>12}{"ops/s":>10}')
+    for title, scheme, options in CONFIGURATIONS:
+        default = scheme if scheme != 'hmac_sha256' else 'bcrypt'
+        context = build_context(default=default, **options)
+        hashed = context.hash('benchmark passphrase', scheme=scheme)
+        hash_time = measure(
+            lambda: context.hash('benchmark passphrase', scheme=scheme),
+            args.iterations
+        )
+        verify_time = measure(
+            lambda: context.verify('benchmark passphrase', hashed),
+            args.iterations
+        )
+        print(
+            f'{title:<24}{hash_time * 1000:>10.2f}'
+            f'{verify_time * 1000:>12.2f}{1 / verify_time:>10.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+Compare two benchmark result files and report regressions
+'''
+
+from dataclasses import dataclass
+
+HIGHER_IS_BETTER = ('rps', 'ops_per_s', 'mb_per_s')
+
+
+@dataclass(frozen=True)
+class Change:
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def higher_is_better(self) -> bool:
+        return self.metric.endswith(HIGHER_IS_BETTER)
+
+    @property
+    def regression(self) -> float:
+        '''
+        Relative change in the bad direction, negative for improvements
+        '''
+
+        if not self.baseline:
+            return 0.0
+        delta = (self.current - self.baseline) / self.baseline
+        return -delta if self.higher_is_better else delta
+
+
+def compare(
+        baseline: dict[str, float],
+        current: dict[str, float],
+        threshold: float,
+        thresholds: dict[str, float] | None = None
+) -> tuple[list[Change], list[Change]]:
+    '''
+    Return (all changes, regressions beyond their threshold). A metric
+    threshold is looked up by the longest matching prefix in thresholds
+    and falls back to threshold.
+    '''
+
+    thresholds = thresholds or {}
+    changes = []
+    regressions = []
+    for metric in sorted(baseline.keys() & current.keys()):
+        change = Change(metric, baseline[metric], current[metric])
+        changes.append(change)
+        prefixes = [prefix for prefix in thresholds if metric.startswith(prefix)]
+        limit = thresholds[max(prefixes, key=len)] if prefixes else threshold
+        if change.regression > limit:
+            regressions.append(change)
+    return changes, regressions
@@ -0,0 +1,89 @@
+'''
+Load benchmark of the HTTP API through an in-process ASGI client
+'''
+
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from app.main import app
+
+
+def _percentile(latencies: list[float], percent: float) -> float:
+    if len(latencies) == 1:
+        return latencies[0]
+    return statistics.quantiles(latencies, n=100, method='inclusive')[
+        int(percent) - 1
+    ]
+
+
+async def _drive(requests: list, concurrency: int) -> tuple[float, list]:
+    '''
+    Send requests with at most concurrency in flight.
+    Returns the wall time and the latency of every request.
+    '''
+
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+
+    async def worker():
+        while not queue.empty():
+            send = queue.get_nowait()
+            started = time.perf_counter()
+            response = await send()
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+
+def _summary(name: str, elapsed: float, latencies: list) -> dict:
+    return {
+        f'{name}.rps': len(latencies) / elapsed,
+        f'{name}.p50_ms': 1000 * _percentile(latencies, 50),
+        f'{name}.p95_ms': 1000 * _percentile(latencies, 95),
+        f'{name}.p99_ms': 1000 * _percentile(latencies, 99),
+    }
+
+
+async def _run(requests: int, concurrency_levels: list[int]) -> dict:
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), httpx.AsyncClient(
+        transport=transport, base_url='http://bench'
+    ) as client:
+        payload = {'secret': 'benchmark secret' * 8, 'passphrase': 'pass'}
+        for concurrency in concurrency_levels:
+            generate = [
+                lambda: client.post('/generate', json=payload)
+            ] * requests
+            elapsed, latencies = await _drive(generate, concurrency)
+            results.update(_summary(
+                f'load.generate.c{concurrency}', elapsed, latencies
+            ))
+
+            response = await client.post(
+                '/generate/batch', json={'secrets': [payload] * requests}
+            )
+            keys = [item['secret_key'] for item in response.json()['results']]
+            read = [
+                lambda key=key: client.get(
+                    f'/secrets/{key}', params={'passphrase': 'pass'}
+                )
+                for key in keys
+            ]
+            elapsed, latencies = await _drive(read, concurrency)
+            results.update(_summary(
+                f'load.read.c{concurrency}', elapsed, latencies
+            ))
+    return results
+
+
+def run(requests: int, concurrency_levels: list[int]) -> dict[str, float]:
+    return asyncio.run(_run(requests, concurrency_levels))
@@ -0,0 +1,51 @@
+'''
+Microbenchmarks of PasswordManager and SecretManager
+'''
+
+import os
+import time
+
+from app.utils import PasswordManager, SecretManager
+
+SIZES = [256, 4 * 1024, 64 * 1024, 1024 * 1024]
+
+
+def _per_call(function, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - started) / iterations
+
+
+def run(iterations: int) -> dict[str, float]:
+    results = {}
+
+    password_mgr = PasswordManager()
+    hashed = password_mgr.get_password_hash('benchmark passphrase')
+    results['micro.password.hash_ms'] = 1000 * _per_call(
+        lambda: password_mgr.get_password_hash('benchmark passphrase'),
+        iterations
+    )
+    results['micro.password.verify_ms'] = 1000 * _per_call(
+        lambda: password_mgr.verify_password('benchmark passphrase', hashed),
+        iterations
+    )
+
+    for size in SIZES:
+        data = os.urandom(size)
+        # a new manager per call, like the request handlers do
+        encrypted = SecretManager('benchmark passphrase').encrypt_bytes(data)
+        encrypt = _per_call(
+            lambda: SecretManager('benchmark passphrase').encrypt_bytes(data),
+            iterations
+        )
+        decrypt = _per_call(
+            lambda: SecretManager('benchmark passphrase').decrypt_bytes(
+                encrypted
+            ),
+            iterations
+        )
+        results[f'micro.secret.encrypt.{size}.ms'] = 1000 * encrypt
+        results[f'micro.secret.decrypt.{size}.ms'] = 1000 * decrypt
+        results[f'micro.secret.stored.{size}.bytes'] = len(encrypted)
+    return results
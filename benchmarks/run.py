@@ -0,0 +1,104 @@
+'''
+Benchmark suite: load tests of /generate and /secrets/{secret_key} at
+several concurrency levels plus microbenchmarks of the crypto managers.
+
+Runs without outside services: the app is driven in process against an
+SQLite database in a temporary directory unless DB_URL is set. KDF costs
+default to cheap settings so the numbers show everything but the KDF;
+pass --realistic to keep the configured ones.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json --threshold 0.2
+
+With --compare the run exits with status 1 if any metric got worse than
+the baseline by more than its threshold.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+
+def _configure(realistic: bool, directory: str) -> None:
+    # must happen before the app modules read their configuration
+    os.environ.setdefault(
+        'DB_URL', f'sqlite+aiosqlite:///{directory}/benchmark.db'
+    )
+    os.environ.setdefault('REAPER_ENABLED', 'false')
+    os.environ.setdefault('AUTO_MIGRATE', 'true')
+    if not realistic:
+        os.environ.setdefault('HASH_BCRYPT_ROUNDS', '4')
+        os.environ.setdefault('CIPHER_KDF', 'hkdf')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument(
+        '--concurrency', type=int, nargs='+', default=[1, 8, 32]
+    )
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--realistic', action='store_true')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument(
+        '--thresholds',
+        help='JSON file mapping metric name prefixes to thresholds'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        _configure(args.realistic, directory)
+        from benchmarks import load, micro
+        from benchmarks.compare import compare
+
+        metrics = {}
+        metrics.update(micro.run(args.iterations))
+        metrics.update(load.run(args.requests, args.concurrency))
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'requests': args.requests,
+            'realistic': args.realistic,
+        },
+        'metrics': metrics,
+    }
+    for name, value in sorted(metrics.items()):
+        print(f'{name:<40}{value:>14.3f}')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if not args.compare:
+        return 0
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)['metrics']
+    thresholds = None
+    if args.thresholds:
+        with open(args.thresholds) as thresholds_file:
+            thresholds = json.load(thresholds_file)
+    changes, regressions = compare(
+        baseline, metrics, args.threshold, thresholds
+    )
+    print()
+    for change in changes:
+        marker = ' REGRESSION' if change in regressions else ''
+        print(
+            f'{change.metric:<40}{change.baseline:>12.3f}'
+            f'{change.current:>12.3f}{change.regression:>+9.1%}{marker}'
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
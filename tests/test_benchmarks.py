@@ -0,0 +1,45 @@
+from benchmarks.compare import compare
+
+
+def test_latency_increase_is_regression():
+    _, regressions = compare(
+        {'load.read.c1.p99_ms': 10.0}, {'load.read.c1.p99_ms': 13.0}, 0.2
+    )
+
+    assert [change.metric for change in regressions] == ['load.read.c1.p99_ms']
+
+
+def test_throughput_decrease_is_regression():
+    _, regressions = compare(
+        {'load.read.c1.rps': 100.0}, {'load.read.c1.rps': 70.0}, 0.2
+    )
+
+    assert len(regressions) == 1
+
+
+def test_improvements_and_small_changes_pass():
+    changes, regressions = compare(
+        {'load.read.c1.rps': 100.0, 'micro.password.hash_ms': 2.0},
+        {'load.read.c1.rps': 150.0, 'micro.password.hash_ms': 2.2},
+        0.2
+    )
+
+    assert len(changes) == 2
+    assert regressions == []
+
+
+def test_longest_prefix_threshold_wins():
+    _, regressions = compare(
+        {'micro.secret.encrypt.256.ms': 1.0},
+        {'micro.secret.encrypt.256.ms': 1.3},
+        0.5,
+        {'micro.': 1.0, 'micro.secret.': 0.1}
+    )
+
+    assert len(regressions) == 1
+
+
+def test_metrics_missing_from_either_run_are_ignored():
+    changes, regressions = compare({'a.ms': 1.0}, {'b.ms': 5.0}, 0.2)
+
+    assert changes == [] and regressions == []
@@ -0,0 +1,151 @@
+import os
+
+import pytest
+
+from app import cipher
+from app import compression
+from app.cipher import DecryptionError, Envelope, Header
+
+
+def test_header_round_trip():
+    envelope = Envelope('test_passphrase', 'chacha20', 'scrypt')
+    data = envelope.encrypt(b'test_secret')
+
+    header = Header.unpack(data)
+
+    assert header.version == cipher.VERSION
+    assert header.algorithm == cipher.ALGORITHMS['chacha20']
+    assert header.kdf == cipher.KDFS['scrypt']
+    assert header.params == cipher.default_params('scrypt')
+    assert len(header.salt) == cipher.SALT_SIZE
+    assert header.pack() == data[:header.size]
+
+
+def test_aead_overhead_is_fixed():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf', 'none')
+    header_size = 7 + cipher.SALT_SIZE + cipher.NONCE_SIZE
+
+    assert len(envelope.encrypt(b'x' * 1000)) == 1000 + header_size + 16
+
+
+def test_tampered_header_is_rejected():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf')
+    data = bytearray(envelope.encrypt(b'test_secret'))
+    data[1] ^= 1
+
+    with pytest.raises(DecryptionError):
+        envelope.decrypt(bytes(data))
+
+
+def test_unknown_version_is_rejected():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf')
+    data = envelope.encrypt(b'test_secret')
+
+    with pytest.raises(DecryptionError):
+        envelope.decrypt(b'\x02' + data[1:])
+
+
+def test_legacy_detection():
+    assert cipher.is_legacy(b'gAAAAABm' + b'A' * 40)
+    assert not cipher.is_legacy(Envelope('p', 'aesgcm', 'hkdf').encrypt(b''))
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        Envelope('test_passphrase', 'rot13', 'hkdf')
+
+
+def test_stream_chunks_round_trip():
+    envelope = Envelope('test_passphrase', 'chacha20', 'hkdf')
+    encryptor = envelope.stream_encryptor()
+    chunks = [
+        encryptor.encrypt_chunk(b'one'),
+        encryptor.encrypt_chunk(b'two'),
+        encryptor.encrypt_chunk(b'three', last=True)
+    ]
+
+    decryptor = envelope.stream_decryptor(encryptor.header)
+
+    assert decryptor.decrypt_chunk(chunks[0]) == b'one'
+    assert decryptor.decrypt_chunk(chunks[1]) == b'two'
+    assert decryptor.decrypt_chunk(chunks[2], last=True) == b'three'
+
+
+def test_stream_chunks_can_not_be_reordered_or_truncated():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf')
+    encryptor = envelope.stream_encryptor()
+    first = encryptor.encrypt_chunk(b'one')
+    second = encryptor.encrypt_chunk(b'two', last=True)
+
+    with pytest.raises(DecryptionError):
+        envelope.stream_decryptor(encryptor.header).decrypt_chunk(second)
+    with pytest.raises(DecryptionError):
+        envelope.stream_decryptor(encryptor.header).decrypt_chunk(
+            first, last=True
+        )
+    decryptor = envelope.stream_decryptor(encryptor.header)
+    with pytest.raises(DecryptionError):
+        decryptor.finish()
+    decryptor.decrypt_chunk(first)
+    decryptor.decrypt_chunk(second, last=True)
+    decryptor.finish()
+
+
+def test_stream_header_is_not_a_plain_envelope():
+    envelope = Envelope('test_passphrase', 'fernet', 'hkdf')
+    encryptor = envelope.stream_encryptor()
+
+    assert Header.unpack(encryptor.header).algorithm == (
+        cipher.ALGORITHMS['aesgcm']
+    )
+    with pytest.raises(DecryptionError):
+        envelope.decrypt(encryptor.header)
+    with pytest.raises(DecryptionError):
+        envelope.stream_decryptor(envelope.encrypt(b'plain'))
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'zstd'])
+def test_large_payload_is_compressed(codec):
+    if not compression.available(codec):
+        pytest.skip(f'{codec} is not installed')
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf', codec)
+    payload = b'{"key": "value"}\n' * 200
+
+    data = envelope.encrypt(payload)
+
+    assert Header.unpack(data).flags == cipher.COMPRESSION_FLAGS[codec]
+    assert len(data) < len(payload) // 5
+    assert envelope.decrypt(data) == payload
+
+
+def test_small_or_incompressible_payload_is_not_compressed():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf', 'zlib')
+    random = os.urandom(4096)
+
+    for payload in (b'short', random):
+        data = envelope.encrypt(payload)
+        assert Header.unpack(data).flags == 0
+        assert envelope.decrypt(data) == payload
+
+
+def test_decompression_is_bounded():
+    payload = b'0' * 10 ** 6
+    data = Envelope('test_passphrase', 'aesgcm', 'hkdf', 'zlib').encrypt(
+        payload
+    )
+    envelope = Envelope(
+        'test_passphrase', 'aesgcm', 'hkdf', 'zlib',
+        max_decompressed_size=10 ** 5
+    )
+
+    with pytest.raises(DecryptionError):
+        envelope.decrypt(data)
+
+
+def test_unknown_flags_are_rejected():
+    envelope = Envelope('test_passphrase', 'aesgcm', 'hkdf')
+    data = bytearray(envelope.encrypt(b'test_secret'))
+    data[1] |= 0x80
+
+    with pytest.raises(DecryptionError):
+        envelope.decrypt(bytes(data))
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from app.coalescer import WriteCoalescer
+
+
+class Recorder:
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.fail_on = fail_on
+
+    async def __call__(self, items):
+        await asyncio.sleep(0)
+        self.batches.append(list(items))
+        if self.fail_on in items:
+            raise ValueError(self.fail_on)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_submits_share_a_flush():
+    flush = Recorder()
+    coalescer = WriteCoalescer(flush, max_delay=0.01, max_batch=100)
+
+    await asyncio.gather(*(coalescer.submit(i) for i in range(5)))
+
+    assert flush.batches == [[0, 1, 2, 3, 4]]
+
+
+@pytest.mark.asyncio
+async def test_full_batch_flushes_without_waiting():
+    flush = Recorder()
+    coalescer = WriteCoalescer(flush, max_delay=60, max_batch=2)
+
+    await asyncio.wait_for(
+        asyncio.gather(*(coalescer.submit(i) for i in range(4))),
+        timeout=1
+    )
+
+    assert flush.batches == [[0, 1], [2, 3]]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_fails_only_the_bad_item():
+    flush = Recorder(fail_on=1)
+    coalescer = WriteCoalescer(flush, max_delay=0.01, max_batch=100)
+
+    results = await asyncio.gather(
+        *(coalescer.submit(i) for i in range(3)),
+        return_exceptions=True
+    )
+
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], ValueError)
+    assert flush.batches == [[0, 1, 2], [0], [1], [2]]
+
+
+@pytest.mark.asyncio
+async def test_close_flushes_pending():
+    flush = Recorder()
+    coalescer = WriteCoalescer(flush, max_delay=60, max_batch=100)
+    submitted = asyncio.create_task(coalescer.submit('item'))
+    await asyncio.sleep(0)
+
+    await coalescer.close()
+
+    await submitted
+    assert flush.batches == [['item']]
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from app import deadline
+from app.deadline import DeadlineMiddleware
+
+
+def _scope(method='GET', headers=()):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': '/',
+        'headers': list(headers),
+    }
+
+
+async def _call(app, scope, disconnect_after=None):
+    sent = []
+
+    async def receive():
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(disconnect_after)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent
+
+
+def _responder(delay, seen=None):
+    async def app(scope, receive, send):
+        if seen is not None:
+            seen.append(deadline.remaining())
+        await asyncio.sleep(delay)
+        await send({'type': 'http.response.start', 'status': 200})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+    return app
+
+
+@pytest.mark.asyncio
+async def test_client_header_shortens_the_budget():
+    seen = []
+    middleware = DeadlineMiddleware(_responder(0, seen), timeout=30)
+
+    await _call(middleware, _scope(headers=[(b'x-request-timeout', b'2')]))
+    await _call(middleware, _scope(headers=[(b'x-request-timeout', b'x')]))
+
+    assert 1 < seen[0] <= 2
+    assert 29 < seen[1] <= 30
+
+
+@pytest.mark.asyncio
+async def test_slow_request_gets_504():
+    middleware = DeadlineMiddleware(_responder(1), timeout=0.05)
+
+    sent = await _call(middleware, _scope())
+
+    assert sent[0]['status'] == 504
+
+
+@pytest.mark.asyncio
+async def test_disconnect_cancels_the_handler():
+    cancelled = asyncio.Event()
+
+    async def app(scope, receive, send):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    middleware = DeadlineMiddleware(app, timeout=0)
+
+    sent = await _call(middleware, _scope(), disconnect_after=0.01)
+
+    assert sent == []
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_started_response_is_not_cut_by_the_deadline():
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200})
+        await asyncio.sleep(0.1)
+        assert deadline.remaining() is None
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    middleware = DeadlineMiddleware(app, timeout=0.05)
+
+    sent = await _call(middleware, _scope())
+
+    assert sent[-1]['body'] == b'ok'
+
+
+@pytest.mark.asyncio
+async def test_budget_starts_after_the_body():
+    seen = []
+    bodies = [
+        {'type': 'http.request', 'body': b'a', 'more_body': True},
+        {'type': 'http.request', 'body': b'b'},
+    ]
+
+    async def app(scope, receive, send):
+        seen.append(deadline.remaining())
+        while (await receive()).get('more_body'):
+            pass
+        seen.append(deadline.remaining())
+        await send({'type': 'http.response.start', 'status': 200})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def receive():
+        if bodies:
+            return bodies.pop(0)
+        await asyncio.Event().wait()
+
+    middleware = DeadlineMiddleware(app, timeout=5)
+    await middleware(_scope('POST'), receive, lambda message: asyncio.sleep(0))
+
+    assert seen[0] is None
+    assert 4 < seen[1] <= 5
+
+
+def test_check_raises_when_out_of_time():
+    with deadline.scope(-1):
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.check()
+    with deadline.scope(None):
+        assert deadline.check() is None
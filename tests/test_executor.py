@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+import pytest
+
+from app import deadline
+from app.executor import CryptoExecutor, ExecutorSaturatedError
+from app.utils import PasswordManager, SecretManager
+
+
+@pytest.mark.asyncio
+async def test_run_returns_result():
+    executor = CryptoExecutor(max_workers=2, max_queue=2)
+    try:
+        result = await executor.run(sum, [1, 2, 3])
+        assert result == 6
+        assert executor.pending == 0
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_rejects_when_saturated():
+    executor = CryptoExecutor(max_workers=1, max_queue=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    try:
+        task = asyncio.create_task(executor.run(blocking))
+        await asyncio.to_thread(started.wait, 5)
+
+        with pytest.raises(ExecutorSaturatedError):
+            await executor.run(sum, [1])
+
+        release.set()
+        assert await task == 'done'
+        assert executor.pending == 0
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_unknown_executor_kind():
+    with pytest.raises(ValueError):
+        CryptoExecutor(kind='fiber')
+
+
+@pytest.mark.asyncio
+async def test_managers_in_process_pool():
+    executor = CryptoExecutor(kind='process', max_workers=1, max_queue=4)
+    password_mgr = PasswordManager()
+    secret_mgr = SecretManager('test_passphrase')
+    try:
+        hashed = await executor.run(
+            password_mgr.get_password_hash, 'test_passphrase'
+        )
+        assert password_mgr.verify_password('test_passphrase', hashed)
+        encrypted = await executor.run(secret_mgr.encrypt_secret, 'secret')
+        assert secret_mgr.decrypt_secret(encrypted) == 'secret'
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_queued_job_is_skipped_after_the_deadline():
+    executor = CryptoExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    ran = []
+
+    try:
+        blocker = asyncio.create_task(executor.run(release.wait, 5))
+        with deadline.scope(0.05):
+            queued = asyncio.create_task(executor.run(ran.append, 1))
+        await asyncio.sleep(0.1)
+        release.set()
+
+        with pytest.raises(deadline.DeadlineExceeded):
+            await queued
+        assert await blocker is True
+        assert ran == []
+    finally:
+        executor.shutdown()
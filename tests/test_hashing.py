@@ -0,0 +1,81 @@
+from unittest.mock import patch
+import warnings
+
+import pytest
+
+from app import hashing
+from app.hashing import build_context, hmac_sha256
+from app.utils import PasswordManager
+
+
+@pytest.fixture
+def hmac_key():
+    with patch.object(hmac_sha256, 'key', b'test_key'):
+        yield
+
+
+def test_hmac_scheme_round_trip(hmac_key):
+    context = build_context(bcrypt_rounds=4).copy(default='hmac_sha256')
+    hashed = context.hash('test_password')
+
+    assert hashed.startswith('$hmac-sha256$')
+    assert context.verify('test_password', hashed)
+    assert not context.verify('wrong_password', hashed)
+    assert hashed != context.hash('test_password')
+
+
+def test_hmac_scheme_requires_key():
+    context = build_context(bcrypt_rounds=4).copy(default='hmac_sha256')
+    with patch.object(hmac_sha256, 'key', None):
+        with pytest.raises(RuntimeError):
+            context.hash('test_password')
+
+
+def test_old_bcrypt_hash_verifies_after_switch_to_argon2():
+    bcrypt_context = build_context(bcrypt_rounds=4)
+    argon2_context = build_context(
+        default='argon2',
+        argon2_memory_cost=1024,
+        argon2_time_cost=1
+    )
+    hashed = bcrypt_context.hash('test_password')
+
+    assert argon2_context.verify('test_password', hashed)
+    assert argon2_context.needs_update(hashed)
+    assert argon2_context.hash('test_password').startswith('$argon2id$')
+
+
+def test_needs_update_on_raised_bcrypt_rounds():
+    hashed = build_context(bcrypt_rounds=4).hash('test_password')
+    password_mgr = PasswordManager(build_context(bcrypt_rounds=5))
+
+    assert password_mgr.verify_password('test_password', hashed)
+    assert password_mgr.needs_update(hashed)
+
+
+def test_unknown_default_scheme():
+    with pytest.raises(ValueError):
+        build_context(default='md5_crypt')
+
+
+def test_short_ttl_uses_fast_scheme(hmac_key):
+    password_mgr = PasswordManager(build_context(bcrypt_rounds=4))
+    with patch.object(hashing, 'HASH_FAST_TTL', 300), \
+            warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        assert password_mgr.get_password_hash('pw', ttl=60).startswith(
+            '$hmac-sha256$'
+        )
+        assert password_mgr.get_password_hash('pw', ttl=600).startswith(
+            '$2b$'
+        )
+        assert password_mgr.get_password_hash('pw').startswith('$2b$')
+
+
+def test_fast_scheme_context_is_reused(hmac_key):
+    password_mgr = PasswordManager(build_context(bcrypt_rounds=4))
+    with patch.object(hashing, 'HASH_FAST_TTL', 300):
+        context = password_mgr._context_for_ttl(60)
+
+        assert password_mgr._context_for_ttl(120) is context
+        assert password_mgr._context_for_ttl(600) is password_mgr.pwd_context
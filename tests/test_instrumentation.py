@@ -0,0 +1,59 @@
+from unittest.mock import patch
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app import instrumentation
+from app.instrumentation import InstrumentationMiddleware, timed
+
+
+def _app(server_timing: bool) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(InstrumentationMiddleware, server_timing=server_timing)
+
+    @app.get('/items/{item_id}')
+    async def get_item(item_id: str):
+        with timed('lookup'):
+            pass
+        if item_id == 'missing':
+            raise HTTPException(status_code=404)
+        return {'item_id': item_id}
+
+    return app
+
+
+def test_middleware_counts_by_route_template():
+    client = TestClient(_app(server_timing=False))
+    before = instrumentation.requests_total.get(
+        route='/items/{item_id}', status=404
+    )
+
+    response = client.get('/items/missing')
+
+    assert response.status_code == 404
+    assert 'server-timing' not in response.headers
+    assert instrumentation.requests_total.get(
+        route='/items/{item_id}', status=404
+    ) == before + 1
+
+
+def test_middleware_adds_server_timing():
+    client = TestClient(_app(server_timing=True))
+
+    response = client.get('/items/present')
+
+    assert response.headers['server-timing'].startswith('lookup;dur=')
+
+
+def test_timed_records_stage_histogram():
+    before = instrumentation.stage_seconds.get(stage='unit_test')
+
+    with timed('unit_test'):
+        pass
+
+    assert instrumentation.stage_seconds.get(stage='unit_test') == before + 1
+
+
+def test_timed_is_noop_when_disabled():
+    with patch.object(instrumentation, 'METRICS_ENABLED', False):
+        assert timed('a') is timed('b')
@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+import pytest
+
+from app.limiter import (
+    AttemptLimiter,
+    MemoryBackend,
+    TooManyAttemptsError,
+    retry_after_header
+)
+
+
+def _limiter(max_entries=100):
+    return AttemptLimiter(MemoryBackend(max_entries), 2, 60, 3, 10)
+
+
+@pytest.mark.asyncio
+async def test_key_is_limited_after_burst():
+    limiter = _limiter()
+    await limiter.record_failure('key', 'client')
+    await limiter.check('key', 'client')
+    await limiter.record_failure('key', 'client')
+
+    with pytest.raises(TooManyAttemptsError) as exc_info:
+        await limiter.check('key', 'client')
+    assert 59 < exc_info.value.retry_after <= 60
+    assert retry_after_header(exc_info.value) == '60'
+    await limiter.check('other', 'another client')
+
+
+@pytest.mark.asyncio
+async def test_client_is_limited_across_keys():
+    limiter = _limiter()
+    for key in ('a', 'b', 'c'):
+        await limiter.record_failure(key, 'client')
+
+    with pytest.raises(TooManyAttemptsError):
+        await limiter.check('d', 'client')
+    await limiter.check('d', 'another client')
+
+
+@pytest.mark.asyncio
+async def test_buckets_refill():
+    limiter = _limiter()
+    with patch('app.limiter.time.monotonic', return_value=1000):
+        await limiter.record_failure('key', None)
+        await limiter.record_failure('key', None)
+    with patch('app.limiter.time.monotonic', return_value=1060):
+        await limiter.check('key', None)
+    with patch('app.limiter.time.monotonic', return_value=1120):
+        await limiter.check('key', None)
+        assert len(limiter.backend) == 0
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_is_bounded():
+    limiter = _limiter(max_entries=2)
+    await limiter.record_failure('a', None)
+    await limiter.record_failure('b', None)
+    await limiter.record_failure('c', None)
+
+    assert len(limiter.backend) == 2
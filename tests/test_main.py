@@ -0,0 +1,579 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+from unittest.mock import patch, AsyncMock, MagicMock
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from app import models, reaper
+from app.cipher import DecryptionError, Envelope
+from app.limiter import attempt_limiter
+from app.main import app
+from app.negative_cache import negative_cache
+from app.repositories.memory_storage import MemoryStorage
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def clear_negative_cache():
+    negative_cache.clear()
+    yield
+    negative_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_attempt_limiter():
+    attempt_limiter.backend.clear()
+    yield
+    attempt_limiter.backend.clear()
+
+
+@pytest.fixture
+def secret_db():
+    with patch('app.main.secret_db') as mock_secret_db:
+        mock_secret_db.consume_secret = AsyncMock()
+        mock_secret_db.release_secret = AsyncMock()
+        mock_secret_db.get_secret = AsyncMock()
+        mock_secret_db.mark_secret_read = AsyncMock()
+        yield mock_secret_db
+
+
+def _claimed(passphrase_hash='hash', secret_data='data', is_stream=False):
+    claimed = MagicMock()
+    claimed.id = 'id'
+    claimed.passphrase_hash = passphrase_hash
+    claimed.secret_data = secret_data
+    claimed.is_stream = is_stream
+    return claimed
+
+
+def test_get_secret_success(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ), patch(
+        'app.main.utils.SecretManager.decrypt_secret_async',
+        new_callable=AsyncMock,
+        return_value='decrypted'
+    ):
+        response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 200
+    assert response.json() == {'secret': 'decrypted'}
+    secret_db.release_secret.assert_not_awaited()
+
+
+def test_get_secret_wrong_passphrase_releases_claim(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=False
+    ):
+        response = client.get('/secrets/key', params={'passphrase': 'bad'})
+
+    assert response.status_code == 403
+    secret_db.release_secret.assert_awaited_once_with(
+        'key', failed=True, max_failed_attempts=10
+    )
+
+
+def test_get_secret_too_many_attempts_skips_claim(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=False
+    ) as verify:
+        statuses = [
+            client.get('/secrets/key', params={'passphrase': 'bad'}).status_code
+            for _ in range(6)
+        ]
+
+    assert statuses == [403] * 5 + [429]
+    assert verify.await_count == 5
+    assert secret_db.consume_secret.await_count == 5
+
+
+def test_attempts_are_limited_per_forwarded_client(secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    proxied = TestClient(ProxyHeadersMiddleware(app, trusted_hosts='*'))
+
+    def attempt(index, client):
+        return proxied.get(
+            f'/secrets/key-{index}',
+            params={'passphrase': 'bad'},
+            headers={'X-Forwarded-For': client}
+        ).status_code
+
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=False
+    ):
+        statuses = [attempt(index, '203.0.113.1') for index in range(21)]
+        other = attempt(21, '203.0.113.2')
+
+    assert statuses == [403] * 20 + [429]
+    assert other == 403
+
+
+def test_get_secret_not_found(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = None
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 404
+
+
+def test_get_secret_already_consumed(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key',
+        consumed=True,
+        expires_at=None,
+        failed_attempts=0,
+        read_at=datetime.now(UTC)
+    )
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 410
+
+
+def test_get_secret_claimed_by_others_is_retried_later(client, secret_db):
+    # claimed, but not read yet: the claim may still be released
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key', consumed=True, expires_at=None, failed_attempts=0
+    )
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '1'
+    assert negative_cache.get('key') is None
+
+
+def test_get_secret_locked_by_failed_attempts(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key', consumed=True, expires_at=None, failed_attempts=10
+    )
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 410
+
+
+def test_generate_batch_reports_per_item(client):
+    from app.executor import ExecutorSaturatedError
+
+    with patch(
+        'app.main.secret_db.create_secrets',
+        new_callable=AsyncMock,
+        return_value=['key-0', ExecutorSaturatedError(), ValueError()]
+    ):
+        response = client.post('/generate/batch', json={'secrets': [
+            {'secret': 's0', 'passphrase': 'p0'},
+            {'secret': 's1', 'passphrase': 'p1'},
+            {'secret': 's2', 'passphrase': 'p2', 'ttl': 60}
+        ]})
+
+    assert response.status_code == 200
+    assert response.json() == {'results': [
+        {'index': 0, 'secret_key': 'key-0', 'error': None},
+        {'index': 1, 'secret_key': None, 'error': 'Server is busy'},
+        {'index': 2, 'secret_key': None, 'error': 'Failed to create secret'}
+    ]}
+
+
+def test_generate_batch_rejects_empty_batch(client):
+    response = client.post('/generate/batch', json={'secrets': []})
+
+    assert response.status_code == 422
+
+
+def test_get_secret_streamed_secret_conflict(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed(is_stream=True)
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 409
+    secret_db.release_secret.assert_awaited_once_with('key')
+
+
+def test_generate_stream_rejects_large_content_length(client):
+    with patch('app.main.STREAM_MAX_SIZE', 10):
+        response = client.post(
+            '/generate/stream',
+            params={'passphrase': 'pass'},
+            content=b'x' * 11
+        )
+
+    assert response.status_code == 413
+
+
+def test_generate_stream_rejects_invalid_content_length(client):
+    response = client.post(
+        '/generate/stream',
+        params={'passphrase': 'pass'},
+        headers={'Content-Length': 'abc'}
+    )
+
+    assert response.status_code == 400
+
+
+def test_get_secret_stream_decrypts_chunks(client, secret_db):
+    encryptor = Envelope('pass', 'aesgcm', 'hkdf').stream_encryptor()
+    chunks = [
+        encryptor.encrypt_chunk(b'first '),
+        encryptor.encrypt_chunk(b'second', last=True)
+    ]
+
+    async def iter_chunks(secret_key, secret_id):
+        for chunk in chunks:
+            yield chunk
+
+    secret_db.consume_secret.return_value = _claimed(
+        secret_data=encryptor.header, is_stream=True
+    )
+    secret_db.iter_secret_chunks = iter_chunks
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ):
+        response = client.get(
+            '/secrets/key/stream', params={'passphrase': 'pass'}
+        )
+
+    assert response.status_code == 200
+    assert response.content == b'first second'
+
+
+def test_get_secret_stream_without_chunks_fails(client, secret_db):
+    encryptor = Envelope('pass', 'aesgcm', 'hkdf').stream_encryptor()
+
+    async def iter_chunks(secret_key, secret_id):
+        return
+        yield
+
+    secret_db.consume_secret.return_value = _claimed(
+        secret_data=encryptor.header, is_stream=True
+    )
+    secret_db.iter_secret_chunks = iter_chunks
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ), pytest.raises(DecryptionError):
+        client.get('/secrets/key/stream', params={'passphrase': 'pass'})
+
+    secret_db.release_secret.assert_awaited_once_with('key')
+
+
+def test_consumed_secret_is_answered_from_cache(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ), patch(
+        'app.main.utils.SecretManager.decrypt_secret_async',
+        new_callable=AsyncMock,
+        return_value='decrypted'
+    ):
+        client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 410
+    secret_db.consume_secret.assert_awaited_once()
+
+
+def test_missing_secret_is_answered_from_cache(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = None
+
+    client.get('/secrets/key', params={'passphrase': 'pass'})
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 404
+    secret_db.consume_secret.assert_awaited_once()
+
+
+def test_secret_seen_consumed_by_others_is_not_cached(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key',
+        consumed=True,
+        expires_at=None,
+        failed_attempts=0,
+        read_at=datetime.now(UTC)
+    )
+
+    client.get('/secrets/key', params={'passphrase': 'pass'})
+    client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert secret_db.consume_secret.await_count == 2
+
+
+def test_secret_released_by_wrong_passphrase_is_claimed_again(
+        client, secret_db
+):
+    # a wrong-passphrase read held the claim and released it in between
+    secret_db.consume_secret.side_effect = [None, _claimed()]
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key', consumed=False, expires_at=None
+    )
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ), patch(
+        'app.main.utils.SecretManager.decrypt_secret_async',
+        new_callable=AsyncMock,
+        return_value='decrypted'
+    ):
+        response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 200
+    assert response.json() == {'secret': 'decrypted'}
+
+
+@pytest.mark.asyncio
+async def test_wrong_passphrase_does_not_lock_out_concurrent_reader():
+    storage = MemoryStorage()
+    await storage.create(models.Secret(
+        id='id',
+        secret_key='key',
+        secret_data=b'data',
+        passphrase_hash='hash',
+        expires_at=None
+    ))
+    checking = asyncio.Event()
+    checked = asyncio.Event()
+
+    async def verify(passphrase, passphrase_hash, *args):
+        if passphrase == 'bad':
+            checking.set()
+            await checked.wait()
+        return passphrase == 'pass'
+
+    transport = httpx.ASGITransport(app=app)
+    with patch('app.repositories.secret_repository.storage', storage), patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        side_effect=verify
+    ), patch(
+        'app.main.utils.SecretManager.decrypt_secret_async',
+        new_callable=AsyncMock,
+        return_value='decrypted'
+    ):
+        async with httpx.AsyncClient(
+            transport=transport, base_url='http://test'
+        ) as client:
+            wrong = asyncio.create_task(
+                client.get('/secrets/key', params={'passphrase': 'bad'})
+            )
+            await checking.wait()
+            busy = await client.get(
+                '/secrets/key', params={'passphrase': 'pass'}
+            )
+            checked.set()
+            assert (await wrong).status_code == 403
+            read = await client.get(
+                '/secrets/key', params={'passphrase': 'pass'}
+            )
+            again = await client.get(
+                '/secrets/key', params={'passphrase': 'pass'}
+            )
+
+    assert busy.status_code == 409
+    assert busy.headers['Retry-After'] == '1'
+    assert read.status_code == 200
+    assert read.json() == {'secret': 'decrypted'}
+    assert again.status_code == 410
+
+
+def test_unexpired_secret_that_can_not_be_claimed_is_not_cached(
+        client, secret_db
+):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key',
+        consumed=False,
+        expires_at=datetime.now(UTC) + timedelta(hours=1)
+    )
+
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 409
+    assert negative_cache.get('key') is None
+
+
+def test_expired_secret_is_answered_from_cache(client, secret_db):
+    secret_db.consume_secret.return_value = None
+    secret_db.get_secret.return_value = models.Secret(
+        secret_key='key',
+        consumed=False,
+        expires_at=datetime.now(UTC) - timedelta(seconds=1)
+    )
+
+    client.get('/secrets/key', params={'passphrase': 'pass'})
+    response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 410
+    assert response.json() == {'detail': 'Secret has expired'}
+    secret_db.consume_secret.assert_awaited_once()
+
+
+def test_get_secret_past_deadline_releases_claim(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+
+    async def slow_verify(*args):
+        await asyncio.sleep(1)
+
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new=slow_verify
+    ):
+        response = client.get(
+            '/secrets/key',
+            params={'passphrase': 'pass'},
+            headers={'X-Request-Timeout': '0.05'}
+        )
+
+    assert response.status_code == 504
+    secret_db.release_secret.assert_awaited_once_with('key')
+
+
+def test_secret_status_does_not_consume(client, secret_db):
+    with patch('app.main.READ_RECEIPTS_ENABLED', True), patch(
+        'app.main.receipts.secret_status',
+        new_callable=AsyncMock,
+        return_value={'status': 'unread', 'read_at': None}
+    ) as secret_status:
+        response = client.get('/secrets/key/status', params={'wait': 2})
+
+    assert response.status_code == 200
+    assert response.json() == {'status': 'unread', 'read_at': None}
+    assert secret_status.await_args.args[0] == 'key'
+    assert 0 < secret_status.await_args.args[1] <= 2
+    secret_db.consume_secret.assert_not_awaited()
+
+
+def test_secret_status_not_found(client, secret_db):
+    with patch('app.main.READ_RECEIPTS_ENABLED', True), patch(
+        'app.main.receipts.secret_status',
+        new_callable=AsyncMock,
+        return_value=None
+    ):
+        response = client.get('/secrets/key/status')
+
+    assert response.status_code == 404
+
+
+def test_secret_status_needs_read_receipts(client, secret_db):
+    response = client.get('/secrets/key/status')
+
+    assert response.status_code == 404
+    secret_db.get_secret.assert_not_awaited()
+
+
+def test_delivered_secret_is_marked_read(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=True
+    ), patch(
+        'app.main.utils.SecretManager.decrypt_secret_async',
+        new_callable=AsyncMock,
+        return_value='decrypted'
+    ):
+        response = client.get('/secrets/key', params={'passphrase': 'pass'})
+
+    assert response.status_code == 200
+    secret_db.mark_secret_read.assert_awaited_once_with('key')
+
+
+def test_wrong_passphrase_is_not_marked_read(client, secret_db):
+    secret_db.consume_secret.return_value = _claimed()
+    with patch(
+        'app.main.utils.PasswordManager.verify_password_async',
+        new_callable=AsyncMock,
+        return_value=False
+    ):
+        response = client.get('/secrets/key', params={'passphrase': 'bad'})
+
+    assert response.status_code == 403
+    secret_db.mark_secret_read.assert_not_awaited()
+
+
+def test_callback_url_needs_read_receipts(client):
+    response = client.post('/generate', json={
+        'secret': 'text',
+        'passphrase': 'pass',
+        'callback_url': 'https://example.com/read'
+    })
+
+    assert response.status_code == 422
+
+
+def test_generate_rejects_secret_larger_than_readable(client):
+    with patch('app.schemas.SECRET_MAX_DECOMPRESSED_SIZE', 4):
+        response = client.post('/generate', json={
+            'secret': 'ünic',
+            'passphrase': 'pass'
+        })
+
+    assert response.status_code == 422
+
+
+def test_callback_url_to_private_address_is_refused(client):
+    with patch('app.schemas.READ_RECEIPTS_ENABLED', True):
+        response = client.post('/generate', json={
+            'secret': 'text',
+            'passphrase': 'pass',
+            'callback_url': 'http://169.254.169.254/latest/meta-data'
+        })
+
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_read_secret_status_outlives_the_reaper():
+    storage = MemoryStorage()
+    await storage.create(models.Secret(
+        id='id',
+        secret_key='key',
+        secret_data=b'data',
+        passphrase_hash='hash',
+        expires_at=None
+    ))
+    await storage.consume('key')
+    await storage.mark_read('key')
+
+    transport = httpx.ASGITransport(app=app)
+    with patch('app.repositories.secret_repository.storage', storage), patch(
+        'app.main.READ_RECEIPTS_ENABLED', True
+    ):
+        assert await reaper.reap_once(consumed_grace=0) == 0
+        async with httpx.AsyncClient(
+            transport=transport, base_url='http://test'
+        ) as client:
+            response = await client.get('/secrets/key/status')
+
+    assert response.status_code == 200
+    assert response.json()['status'] == 'read'
+    assert (await storage.get('key')).secret_data == b''
@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta, UTC
+
+import pytest
+
+from app import models
+from app.repositories.memory_storage import MemoryStorage, TimerWheel
+
+
+async def _gen(items):
+    for item in items:
+        yield item
+
+
+def _secret(key, expires_at=None):
+    return models.Secret(
+        id=f'id-{key}',
+        secret_key=key,
+        secret_data=b'data',
+        passphrase_hash='hash',
+        expires_at=expires_at
+    )
+
+
+def test_timer_wheel_pops_only_due_keys():
+    wheel = TimerWheel(1)
+    wheel.add('a', 10.2)
+    wheel.add('b', 20)
+
+    assert wheel.pop(10.5) is None
+    assert wheel.pop(11) == 'a'
+    assert wheel.pop(11) is None
+    assert wheel.pop(20) == 'b'
+
+
+@pytest.mark.asyncio
+async def test_consume_once():
+    storage = MemoryStorage(shards=4)
+    await storage.create(_secret('key'))
+
+    claimed = await storage.consume('key')
+
+    assert claimed.secret_data == b'data'
+    assert await storage.consume('key') is None
+    assert (await storage.get('key')).consumed is True
+    assert await storage.stats() == {'live': 0, 'consumed': 1}
+
+
+@pytest.mark.asyncio
+async def test_consume_expired_and_missing():
+    storage = MemoryStorage()
+    await storage.create(_secret('key', datetime.now(UTC) - timedelta(seconds=1)))
+
+    assert await storage.consume('key') is None
+    assert await storage.consume('missing') is None
+
+
+@pytest.mark.asyncio
+async def test_release_and_failed_attempts():
+    storage = MemoryStorage()
+    await storage.create(_secret('key'))
+
+    await storage.consume('key')
+    await storage.release('key', failed=True, max_failed_attempts=2)
+    assert (await storage.get('key')).consumed is False
+
+    await storage.consume('key')
+    await storage.release('key', failed=True, max_failed_attempts=2)
+    record = await storage.get('key')
+    assert record.consumed is True
+    assert record.failed_attempts == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_expired():
+    storage = MemoryStorage(wheel_resolution=0.001)
+    past = datetime.now(UTC) - timedelta(seconds=1)
+    future = datetime.now(UTC) + timedelta(hours=1)
+    await storage.create_many([
+        _secret('expired', past),
+        _secret('live', future),
+        _secret('consumed'),
+        _secret('fresh')
+    ])
+    await storage.consume('consumed')
+    storage._shard('consumed')['consumed'].consumed_at = past
+    storage._consumed.add('consumed', past.timestamp())
+    await storage.consume('fresh')
+
+    deleted = await storage.delete_expired(10, timedelta(seconds=0.5))
+
+    assert deleted == 2
+    assert await storage.get('expired') is None
+    assert await storage.get('consumed') is None
+    assert await storage.get('live') is not None
+    assert await storage.get('fresh') is not None
+
+
+@pytest.mark.asyncio
+async def test_read_secret_is_kept_for_read_retention():
+    storage = MemoryStorage(wheel_resolution=0.001)
+    await storage.create(_secret('key'))
+    await storage.consume('key')
+    await storage.mark_read('key')
+    record = storage._shard('key')['key']
+    hour = timedelta(hours=1)
+
+    assert await storage.delete_expired(10, timedelta(0), hour) == 0
+    assert record.secret_data == b''
+
+    record.read_at -= hour
+    storage._consumed.add('key', 0)
+    assert await storage.delete_expired(10, timedelta(0), hour) == 1
+    assert await storage.get('key') is None
+
+
+@pytest.mark.asyncio
+async def test_delete_expired_respects_batch_size():
+    storage = MemoryStorage(wheel_resolution=0.001)
+    past = datetime.now(UTC) - timedelta(seconds=1)
+    await storage.create_many([_secret(str(i), past) for i in range(5)])
+
+    assert await storage.delete_expired(3, timedelta(0)) == 3
+    assert await storage.delete_expired(3, timedelta(0)) == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_chunks():
+    storage = MemoryStorage()
+    await storage.create_stream(_secret('key'), _gen([b'a', b'b']))
+
+    claimed = await storage.consume('key')
+
+    assert claimed.is_stream is True
+    chunks = storage.iter_chunks('key', claimed.id)
+    assert [data async for data in chunks] == [b'a', b'b']
+
+
+@pytest.mark.asyncio
+async def test_read_receipts():
+    storage = MemoryStorage(shards=4)
+    notified = []
+    assert await storage.listen_receipts(notified.append) is True
+    secret = _secret('key')
+    secret.callback_url = 'https://example.com/read'
+    await storage.create(secret)
+    lease = timedelta(seconds=60)
+
+    # nothing until the claim has been delivered
+    await storage.consume('key')
+    await storage.release('key')
+    assert notified == []
+    assert await storage.next_receipt_at() is None
+
+    await storage.consume('key')
+    await storage.mark_read('key')
+    await storage.mark_read('key')
+    assert notified == ['key']
+    assert (await storage.get('key')).read_at is not None
+    await storage.finish_receipts(
+        [], {'key': datetime.now(UTC) - timedelta(seconds=1)}
+    )
+    [receipt] = await storage.claim_receipts(10, lease)
+    assert (receipt.callback_url, receipt.attempts) == (secret.callback_url, 1)
+    assert await storage.claim_receipts(10, lease) == []
+    await storage.finish_receipts(['key'], {})
+    assert await storage.next_receipt_at() is None
+
+
+@pytest.mark.asyncio
+async def test_keys_are_normalized():
+    key = '0190b6b4-7c3e-7aa1-8a2b-3c4d5e6f7a8b'
+    storage = MemoryStorage()
+    await storage.create(_secret(key))
+
+    assert await storage.get(key.upper()) is not None
+    assert await storage.consume(key.replace('-', '')) is not None
+    await storage.release(f'{{{key}}}')
+    assert (await storage.get(key)).consumed is False
@@ -0,0 +1,49 @@
+from app.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    requests = registry.register(Counter('requests_total', 'Requests'))
+    pool = registry.register(Gauge('pool_size', 'Pool size'))
+    requests.inc(status=200)
+    requests.inc(2, status=200)
+    requests.inc(status=404)
+    pool.set_function(lambda: 5)
+
+    text = registry.render()
+
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{status="200"} 3' in text
+    assert 'requests_total{status="404"} 1' in text
+    assert '# TYPE pool_size gauge' in text
+    assert 'pool_size 5' in text
+    assert requests.get(status=200) == 3
+
+
+def test_duplicate_metric_name():
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests'))
+    try:
+        registry.register(Gauge('requests_total', 'Requests'))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('duplicate metric was registered')
+
+
+def test_render_histogram():
+    registry = Registry()
+    latency = registry.register(
+        Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    )
+    latency.observe(0.05, stage='db')
+    latency.observe(0.5, stage='db')
+    latency.observe(5, stage='db')
+
+    text = registry.render()
+
+    assert 'latency_seconds_bucket{stage="db",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{stage="db",le="1"} 2' in text
+    assert 'latency_seconds_bucket{stage="db",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{stage="db"} 3' in text
+    assert 'latency_seconds_sum{stage="db"} 5.55' in text
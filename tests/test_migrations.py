@@ -0,0 +1,84 @@
+import uuid
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import text
+
+from app import migrations
+from app.config import DatabaseSettings
+from app.database import build_engine
+from app.repositories.sql_storage import SqlStorage
+
+# secrets as created before any migration existed
+OLD_SECRETS = '''
+CREATE TABLE secrets (
+    id VARCHAR NOT NULL PRIMARY KEY,
+    secret_key VARCHAR NOT NULL UNIQUE,
+    secret_data VARCHAR NOT NULL,
+    passphrase_hash VARCHAR NOT NULL,
+    consumed BOOLEAN,
+    expires_at DATETIME,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+
+@pytest_asyncio.fixture
+async def engine(tmp_path):
+    engine = build_engine(
+        DatabaseSettings(url=f'sqlite+aiosqlite:///{tmp_path}/secrets.db')
+    )
+    yield engine
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_fresh_database_is_stamped(engine):
+    applied = await migrations.upgrade(engine)
+
+    assert applied == [version for version, _ in migrations.MIGRATIONS]
+    assert await migrations.current_version(engine) == migrations.HEAD
+    await migrations.verify(engine)
+    assert await migrations.upgrade(engine) == []
+
+
+@pytest.mark.asyncio
+async def test_verify_fails_before_upgrade(engine):
+    with pytest.raises(migrations.SchemaVersionError):
+        await migrations.verify(engine)
+
+    async with engine.begin() as conn:
+        await conn.execute(text(OLD_SECRETS))
+    await migrations.upgrade(engine)
+    async with engine.begin() as conn:
+        await conn.execute(
+            text('DELETE FROM schema_version WHERE version = :version'),
+            {'version': migrations.HEAD}
+        )
+
+    with pytest.raises(migrations.SchemaVersionError):
+        await SqlStorage(engine).start()
+
+
+@pytest.mark.asyncio
+async def test_upgrade_of_unversioned_database(engine):
+    key = uuid.uuid4()
+    async with engine.begin() as conn:
+        await conn.execute(text(OLD_SECRETS))
+        await conn.execute(
+            text(
+                "INSERT INTO secrets (id, secret_key, secret_data, "
+                "passphrase_hash, consumed) VALUES (:id, :key, 'data', "
+                "'hash', 0)"
+            ),
+            {'id': str(uuid.uuid4()), 'key': str(key)}
+        )
+
+    assert await migrations.current_version(engine) is None
+    await migrations.upgrade(engine)
+
+    storage = SqlStorage(engine)
+    await storage.start()
+    secret = await storage.consume(str(key))
+    assert secret is not None
+    assert secret.is_stream is False
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+from app.negative_cache import CONSUMED, MISSING, NegativeCache
+
+
+def test_get_returns_cached_state():
+    cache = NegativeCache(max_entries=10, ttl=60, missing_ttl=5)
+    cache.add('key', CONSUMED)
+
+    assert cache.get('key') == CONSUMED
+    assert cache.get('other') is None
+
+
+def test_entries_expire():
+    cache = NegativeCache(max_entries=10, ttl=60, missing_ttl=5)
+    with patch('app.negative_cache.time.monotonic', return_value=100):
+        cache.add('consumed', CONSUMED)
+        cache.add('missing', MISSING)
+    with patch('app.negative_cache.time.monotonic', return_value=110):
+        assert cache.get('consumed') == CONSUMED
+        assert cache.get('missing') is None
+    assert len(cache) == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = NegativeCache(max_entries=2, ttl=60, missing_ttl=5)
+    cache.add('first', CONSUMED)
+    cache.add('second', CONSUMED)
+    cache.get('first')
+    cache.add('third', CONSUMED)
+
+    assert cache.get('second') is None
+    assert cache.get('first') == CONSUMED
+    assert cache.get('third') == CONSUMED
+
+
+def test_disabled_cache():
+    cache = NegativeCache(max_entries=0, ttl=60, missing_ttl=5)
+    cache.add('key', CONSUMED)
+
+    assert cache.get('key') is None
+    assert len(cache) == 0
@@ -0,0 +1,124 @@
+import uuid
+from datetime import date, datetime, timedelta, UTC
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app import models, partitions
+
+
+def test_uuid7_carries_creation_time():
+    before = datetime.now(UTC) - timedelta(milliseconds=1)
+    key = partitions.uuid7()
+    after = datetime.now(UTC)
+
+    assert key.version == 7
+    assert key.variant == uuid.RFC_4122
+    assert before <= partitions.key_created_at(str(key)) <= after
+
+
+def test_key_created_at_of_other_keys():
+    assert partitions.key_created_at(str(uuid.uuid4())) is None
+    assert partitions.key_created_at('not a uuid') is None
+
+
+def test_partition_names():
+    name = partitions.partition_name('secrets', date(2026, 1, 2))
+
+    assert name == 'secrets_p20260102'
+    assert partitions.partition_day(name, 'secrets') == date(2026, 1, 2)
+    assert partitions.partition_day(name, 'secret_chunks') is None
+    assert partitions.partition_day('secrets_default', 'secrets') is None
+
+
+def test_create_partition_sql():
+    sql = partitions.create_partition_sql('secrets', date(2026, 1, 2))
+
+    assert sql == (
+        'CREATE TABLE IF NOT EXISTS secrets_p20260102 PARTITION OF secrets '
+        "FOR VALUES FROM ('2026-01-02T00:00:00+00:00') "
+        "TO ('2026-01-03T00:00:00+00:00')"
+    )
+
+
+def test_retirable():
+    now = datetime(2026, 1, 10, 12, tzinfo=UTC)
+
+    assert partitions.retirable(date(2026, 1, 2), now, timedelta(days=7))
+    assert not partitions.retirable(date(2026, 1, 3), now, timedelta(days=7))
+
+
+@pytest.mark.parametrize('table', [models.Secret, models.SecretChunk])
+def test_partitioned_ddl_has_every_column(table):
+    ddl = {
+        'secrets': partitions.CREATE_SECRETS,
+        'secret_chunks': partitions.CREATE_CHUNKS,
+    }[table.__tablename__]
+
+    for column in table.__table__.columns:
+        assert f'\n        {column.name} ' in ddl
+
+
+@pytest.mark.asyncio
+async def test_maintain_creates_and_retires():
+    conn = AsyncMock()
+    conn.execute.return_value = MagicMock(scalars=MagicMock(return_value=[
+        'secrets_p20260101', 'secrets_p20260110'
+    ]))
+    engine = MagicMock()
+    engine.begin.return_value.__aenter__.return_value = conn
+
+    created, retired = await partitions.maintain(
+        engine,
+        premake_days=1,
+        retention=timedelta(days=7),
+        now=datetime(2026, 1, 10, 12, tzinfo=UTC)
+    )
+
+    assert (created, retired) == (1, 1)
+    statements = [str(call.args[0]) for call in conn.execute.await_args_list]
+    assert statements[1:] == [
+        partitions.create_partition_sql('secrets', date(2026, 1, 11)),
+        partitions.create_partition_sql('secret_chunks', date(2026, 1, 11)),
+        'ALTER TABLE secret_chunks DETACH PARTITION secret_chunks_p20260101',
+        'DROP TABLE secret_chunks_p20260101',
+        'ALTER TABLE secrets DETACH PARTITION secrets_p20260101',
+        'DROP TABLE secrets_p20260101',
+    ]
+
+
+def test_retire_partition_sql_detaches_chunks_from_secrets():
+    day = date(2026, 1, 1)
+
+    statements = [
+        statement
+        for table in reversed(partitions.TABLES)
+        for statement in partitions.retire_partition_sql(table, day, 'detach')
+    ]
+
+    assert statements == [
+        'ALTER TABLE secret_chunks DETACH PARTITION secret_chunks_p20260101',
+        'ALTER TABLE secret_chunks_p20260101 DROP CONSTRAINT IF EXISTS '
+        'secret_chunks_secret_id_created_at_fkey',
+        'ALTER TABLE secrets DETACH PARTITION secrets_p20260101',
+    ]
+    assert 'CONSTRAINT secret_chunks_secret_id_created_at_fkey FOREIGN KEY' \
+        in partitions.CREATE_CHUNKS
+
+
+@pytest.mark.asyncio
+async def test_maintain_skips_while_locked_elsewhere():
+    conn = AsyncMock()
+    conn.execute.return_value = MagicMock(scalar=MagicMock(return_value=False))
+    engine = MagicMock()
+    engine.begin.return_value.__aenter__.return_value = conn
+
+    created, retired = await partitions.maintain(
+        engine,
+        premake_days=1,
+        retention=timedelta(days=7),
+        lock_key=1
+    )
+
+    assert (created, retired) == (0, 0)
+    conn.execute.assert_awaited_once_with(partitions.TRY_LOCK, {'key': 1})
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import profiling
+from app.instrumentation import InstrumentationMiddleware, timed
+from app.main import app
+from app.profiling import SamplingProfiler, SlowRequestLog
+
+
+def _wait_until(stop):
+    stop.wait()
+
+
+@pytest.mark.asyncio
+async def test_profiler_collapses_stacks_of_other_threads():
+    stop = threading.Event()
+    busy = threading.Thread(target=_wait_until, args=(stop,), name='busy')
+    busy.start()
+    profiler = SamplingProfiler(interval=0.005)
+    try:
+        stacks = await profiler.profile(0.1)
+    finally:
+        stop.set()
+        busy.join()
+
+    lines = profiling.collapsed(stacks).splitlines()
+    assert any(
+        line.startswith('busy;')
+        and 'test_profiling.py:_wait_until;threading.py:' in line
+        for line in lines
+    )
+    assert not any(line.startswith('profiler;') for line in lines)
+    assert profiler.running is False
+
+
+@pytest.mark.asyncio
+async def test_one_profile_at_a_time():
+    profiler = SamplingProfiler()
+    first = asyncio.create_task(profiler.profile(0.05))
+    await asyncio.sleep(0)
+
+    with pytest.raises(profiling.ProfilerBusyError):
+        await profiler.profile(0.05)
+    await first
+
+
+async def _stuck_in_verify():
+    with timed('verify'):
+        await asyncio.sleep(0.1)
+
+
+@pytest.mark.asyncio
+async def test_slow_request_is_recorded_with_stages_and_stack():
+    log = SlowRequestLog(threshold=0.05, size=2)
+
+    async def app(scope, receive, send):
+        if scope['path'] == '/slow':
+            await _stuck_in_verify()
+        await send({'type': 'http.response.start', 'status': 200})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send(message):
+        pass
+
+    middleware = InstrumentationMiddleware(app, slow_requests=log)
+    for path in ('/fast', '/slow', '/slow', '/slow'):
+        await middleware(
+            {'type': 'http', 'method': 'GET', 'path': path},
+            None,
+            send
+        )
+
+    entries = log.entries()
+    assert len(entries) == 2
+    entry = entries[0]
+    assert entry['method'] == 'GET'
+    assert entry['route'] == 'unmatched'
+    assert entry['seconds'] >= 0.05
+    assert set(entry['stages']) == {'verify'}
+    assert any('_stuck_in_verify' in frame for frame in entry['stack'])
+
+
+def test_admin_endpoints_need_the_token():
+    client = TestClient(app)
+
+    with patch('app.main.ADMIN_TOKEN', ''):
+        assert client.get('/admin/slow-requests').status_code == 404
+    with patch('app.main.ADMIN_TOKEN', 'token'):
+        response = client.get(
+            '/admin/slow-requests',
+            headers={'Authorization': 'Bearer wrong'}
+        )
+        assert response.status_code == 401
+        response = client.post(
+            '/admin/profile',
+            params={'seconds': 0.05},
+            headers={'Authorization': 'Bearer token'}
+        )
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/plain')
+        assert response.text.endswith('\n')
+        response = client.get(
+            '/admin/slow-requests',
+            headers={'Authorization': 'Bearer token'}
+        )
+        assert response.json()['requests'] == []
@@ -0,0 +1,32 @@
+from unittest.mock import patch, AsyncMock
+
+import pytest
+
+from app import reaper
+
+
+@pytest.mark.asyncio
+async def test_reap_once_stops_on_short_batch():
+    with patch(
+        'app.reaper.secret_db.delete_expired_secrets',
+        new_callable=AsyncMock,
+        side_effect=[10, 10, 3]
+    ) as mock_delete:
+        total = await reaper.reap_once(batch_size=10, max_batches=5)
+
+    assert total == 23
+    assert mock_delete.await_count == 3
+    assert reaper.reaped_last_cycle.get() == 23
+
+
+@pytest.mark.asyncio
+async def test_reap_once_respects_max_batches():
+    with patch(
+        'app.reaper.secret_db.delete_expired_secrets',
+        new_callable=AsyncMock,
+        return_value=10
+    ) as mock_delete:
+        total = await reaper.reap_once(batch_size=10, max_batches=2)
+
+    assert total == 20
+    assert mock_delete.await_count == 2
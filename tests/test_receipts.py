@@ -0,0 +1,183 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import httpx
+import pytest
+
+from app import receipts
+from app.receipts import ReceiptDispatcher
+
+
+def _receipt(name, attempts=0):
+    return SimpleNamespace(
+        secret_key=name,
+        callback_url=f'https://example.com/{name}',
+        read_at=datetime(2026, 1, 1, tzinfo=UTC),
+        attempts=attempts
+    )
+
+
+@pytest.fixture
+def secret_db():
+    with patch('app.receipts.secret_db') as mock_secret_db:
+        mock_secret_db.claim_receipts = AsyncMock()
+        mock_secret_db.finish_receipts = AsyncMock()
+        mock_secret_db.get_secret = AsyncMock()
+        yield mock_secret_db
+
+
+def _client(statuses):
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(statuses[request.url.path.strip('/')])
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), sent
+
+
+@pytest.fixture
+def public_dns():
+    with patch(
+        'app.receipts.public_address',
+        new_callable=AsyncMock,
+        return_value='93.184.215.14'
+    ) as public_address:
+        yield public_address
+
+
+@pytest.mark.asyncio
+async def test_dispatch_delivers_retries_and_drops(secret_db, public_dns):
+    secret_db.claim_receipts.return_value = [
+        _receipt('ok'),
+        _receipt('down'),
+        _receipt('gone', attempts=2)
+    ]
+    client, sent = _client({'ok': 204, 'down': 503, 'gone': 500})
+
+    async with client:
+        dispatched = await ReceiptDispatcher(max_attempts=3).dispatch_once(
+            client
+        )
+
+    assert dispatched == 3
+    assert len(sent) == 3
+    assert sent[0].read().startswith(b'{"secret_key":"ok"')
+    done, retries = secret_db.finish_receipts.await_args.args
+    assert done == ['ok', 'gone']
+    assert list(retries) == ['down']
+    assert retries['down'] > datetime.now(UTC)
+
+
+@pytest.mark.asyncio
+async def test_delivery_is_pinned_to_the_checked_address(
+        secret_db, public_dns
+):
+    secret_db.claim_receipts.return_value = [_receipt('ok')]
+    client, sent = _client({'ok': 204})
+
+    async with client:
+        await ReceiptDispatcher().dispatch_once(client)
+
+    [request] = sent
+    assert request.url.host == '93.184.215.14'
+    assert request.headers['Host'] == 'example.com'
+    assert request.extensions['sni_hostname'] == 'example.com'
+    public_dns.assert_awaited_once_with('example.com', 443)
+
+
+@pytest.mark.asyncio
+async def test_callback_to_private_address_is_not_sent(secret_db):
+    receipt = _receipt('internal')
+    receipt.callback_url = 'http://127.0.0.1:8080/internal'
+    secret_db.claim_receipts.return_value = [receipt]
+    client, sent = _client({'internal': 204})
+
+    async with client:
+        await ReceiptDispatcher().dispatch_once(client)
+
+    assert sent == []
+    done, retries = secret_db.finish_receipts.await_args.args
+    assert list(retries) == ['internal']
+
+
+@pytest.mark.asyncio
+async def test_public_address_refuses_non_public_addresses():
+    for host in ('127.0.0.1', '10.1.2.3', '169.254.169.254', '::1'):
+        with pytest.raises(receipts.CallbackRefusedError):
+            await receipts.public_address(host, 80)
+    assert await receipts.public_address('93.184.215.14', 80) == (
+        '93.184.215.14'
+    )
+
+
+def test_retries_back_off_up_to_the_maximum():
+    now = datetime.now(UTC)
+
+    assert receipts.retry_at(0, now) < receipts.retry_at(1, now)
+    assert receipts.retry_at(100, now) == now + timedelta(
+        seconds=receipts.RECEIPT_RETRY_MAX
+    )
+
+
+@pytest.mark.asyncio
+async def test_notification_wakes_the_dispatcher(secret_db):
+    secret_db.claim_receipts.return_value = []
+    secret_db.next_receipt_at = AsyncMock(return_value=None)
+    dispatcher = ReceiptDispatcher()
+
+    async with httpx.AsyncClient() as client:
+        task = asyncio.create_task(dispatcher.run(client, listening=True))
+        await asyncio.sleep(0.01)
+        assert secret_db.claim_receipts.await_count == 1
+        dispatcher.wake()
+        await asyncio.sleep(0.01)
+        assert secret_db.claim_receipts.await_count == 2
+        task.cancel()
+
+
+def _row(consumed=False, read_at=None, expires_at=None, failed=0):
+    return SimpleNamespace(
+        consumed=consumed,
+        read_at=read_at,
+        expires_at=expires_at,
+        failed_attempts=failed
+    )
+
+
+@pytest.mark.asyncio
+async def test_status_of_read_and_expired_secrets(secret_db):
+    long_ago = datetime.now(UTC) - timedelta(hours=1)
+
+    secret_db.get_secret.return_value = _row(True, long_ago)
+    assert await receipts.secret_status('key') == {
+        'status': 'read', 'read_at': long_ago
+    }
+    secret_db.get_secret.return_value = _row(expires_at=long_ago)
+    assert (await receipts.secret_status('key'))['status'] == 'expired'
+    secret_db.get_secret.return_value = None
+    assert await receipts.secret_status('key') is None
+
+
+@pytest.mark.asyncio
+async def test_status_waits_for_the_read(secret_db):
+    rows = [_row(), _row(True, datetime.now(UTC))]
+    secret_db.get_secret.side_effect = rows
+
+    status = asyncio.create_task(receipts.secret_status('key', wait=5))
+    await asyncio.sleep(0.01)
+    assert not status.done()
+    receipts.waiters.notify('key')
+
+    assert (await asyncio.wait_for(status, 1))['status'] == 'read'
+
+
+@pytest.mark.asyncio
+async def test_undelivered_claim_is_unread(secret_db):
+    secret_db.get_secret.return_value = _row(True)
+
+    status = await receipts.secret_status('key', wait=0)
+
+    assert status == {'status': 'unread', 'read_at': None}
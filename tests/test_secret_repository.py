@@ -12,13 +12,17 @@ from app.schemas import SecretCreate
 from app.repositories.secret_repository import (
     SecretFactory,
     create_secret,
+    create_secrets,
     get_secret,
-    make_consume_mark
+    consume_secret,
+    release_secret
 )
 
+MOCK_SECRET_KEY = '3f2b8e0a-6f1c-4c1e-9d5a-2a7b9c0d1e2f'
 
-class TestSecretFactory(unittest.TestCase):
-    def test_create_success_with_ttl(self):
+
+class TestSecretFactory(unittest.IsolatedAsyncioTestCase):
+    async def test_create_success_with_ttl(self):
         with patch(
             'app.repositories.secret_repository.utils.PasswordManager'
             ) as mock_password_manager_cls, \
@@ -42,12 +46,16 @@ class TestSecretFactory(unittest.TestCase):
             )
 
             mock_password_manager = mock_password_manager_cls.return_value
-            mock_password_manager.get_password_hash.return_value = 'hashed_passphrase'
+            mock_password_manager.get_password_hash_async = AsyncMock(
+                return_value='hashed_passphrase'
+            )
 
             mock_secret_manager = mock_secret_manager_cls.return_value
-            mock_secret_manager.encrypt_secret.return_value = 'encrypted_secret'
+            mock_secret_manager.encrypt_secret_async = AsyncMock(
+                return_value='encrypted_secret'
+            )
 
-            result = SecretFactory.create(secret)
+            result = await SecretFactory.create(secret)
 
             # Подтверждаем корректность данных вызова models.Secret
             self.assertIsInstance(result, models.Secret)
@@ -58,10 +66,10 @@ class TestSecretFactory(unittest.TestCase):
             self.assertEqual(result.expires_at, mock_datetime.now() + timedelta(seconds=3600))
 
             # Подтверждаем корректность вызовов методов классов SecretManager, PasswordManager
-            mock_password_manager.get_password_hash.assert_called_once_with('test_passphrase')
-            mock_secret_manager.encrypt_secret.assert_called_once_with('test_secret')
+            mock_password_manager.get_password_hash_async.assert_awaited_once_with('test_passphrase', 3600)
+            mock_secret_manager.encrypt_secret_async.assert_awaited_once_with('test_secret')
     
-    def test_create_secret_success_without_ttl(self):
+    async def test_create_secret_success_without_ttl(self):
         with patch(
             'app.repositories.secret_repository.utils.PasswordManager'
             ) as mock_password_manager_cls, \
@@ -84,12 +92,16 @@ class TestSecretFactory(unittest.TestCase):
             )
 
             mock_password_manager = mock_password_manager_cls.return_value
-            mock_password_manager.get_password_hash.return_value = 'hashed_passphrase'
+            mock_password_manager.get_password_hash_async = AsyncMock(
+                return_value='hashed_passphrase'
+            )
 
             mock_secret_manager = mock_secret_manager_cls.return_value
-            mock_secret_manager.encrypt_secret.return_value = 'encrypted_secret'
+            mock_secret_manager.encrypt_secret_async = AsyncMock(
+                return_value='encrypted_secret'
+            )
 
-            result = SecretFactory.create(secret)
+            result = await SecretFactory.create(secret)
 
             # Подтверждаем корректность данных вызова models.Secret
             self.assertIsInstance(result, models.Secret)
@@ -100,8 +112,8 @@ class TestSecretFactory(unittest.TestCase):
             self.assertEqual(result.expires_at, None)
 
             # Подтверждаем корректность вызовов методов классов SecretManager, PasswordManager
-            mock_password_manager.get_password_hash.assert_called_once_with('test_passphrase')
-            mock_secret_manager.encrypt_secret.assert_called_once_with('test_secret')
+            mock_password_manager.get_password_hash_async.assert_awaited_once_with('test_passphrase', None)
+            mock_secret_manager.encrypt_secret_async.assert_awaited_once_with('test_secret')
 
 
 @asynccontextmanager
@@ -115,7 +127,7 @@ async def test_cretate_secret_with_ttl():
         expires_at=datetime.now(UTC) + timedelta(seconds=3600)
     )) as mock_create, \
     patch(
-        'app.repositories.secret_repository.db.async_session',
+        'app.repositories.sql_storage.db.async_session',
         new_callable=AsyncMock
     ) as mock_session:
 
@@ -158,7 +170,7 @@ async def test_cretate_secret_without_ttl():
         expires_at=datetime.now(UTC) + timedelta(seconds=3600)
     )) as mock_create, \
     patch(
-        'app.repositories.secret_repository.db.async_session',
+        'app.repositories.sql_storage.db.async_session',
         new_callable=AsyncMock
     ) as mock_session:
 
@@ -204,7 +216,7 @@ async def test_get_secret_success():
         expires_at=None
     )
     async with patch(
-        'app.repositories.secret_repository.db.async_session',
+        'app.repositories.sql_storage.db.async_session',
         new_callable=AsyncMock
     ) as mock_session:
         # Мокирование переменных и внешних вызовов
@@ -231,7 +243,7 @@ async def test_get_secret_success():
 @pytest.mark.asyncio
 async def test_get_secret_not_found():
     async with patch(
-        'app.repositories.secret_repository.db.async_session',
+        'app.repositories.sql_storage.db.async_session',
         new_callable=AsyncMock
     ) as mock_session:
         mock_session_instance = mock_session.return_value.__aenter__.return_value
@@ -251,26 +263,153 @@ async def test_get_secret_not_found():
         assert result is None
 
 
-@asynccontextmanager
+def _mock_session(mock_async_session):
+    session = AsyncMock()
+    mock_async_session.return_value.__aenter__.return_value = session
+    return session
+
+
 @pytest.mark.asyncio
-async def test_make_consume_mark_success():
-    mock_secret = models.Secret(
-        id="mock_id",
-        secret_key="mock_secret_key",
-        secret_data="mock_secret_data",
-        passphrase_hash="mock_passphrase_hash",
-        expires_at=None
-    )
-    async with patch(
-        'app.repositories.secret_repository.db.async_session',
-        new_callable=AsyncMock
-    ) as mock_session:
-        # Мокирование сессии
-        mock_session_instance = mock_session.return_value.__aenter__.return_value
+async def test_consume_secret_claims_row():
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+        claimed = MagicMock()
+        session.execute.return_value.first = MagicMock(return_value=claimed)
 
-        # Вызов кода
-        await make_consume_mark(mock_secret)
-        
-        # Проверка
-        assert mock_secret.consumed is True
-        mock_session_instance.commit.assert_called_once()
+        result = await consume_secret(MOCK_SECRET_KEY)
+
+        assert result is claimed
+        session.execute.assert_awaited_once()
+        session.commit.assert_awaited_once()
+        statement = str(session.execute.call_args[0][0])
+        assert statement.startswith('UPDATE secrets SET consumed')
+        assert 'RETURNING' in statement
+
+
+@pytest.mark.asyncio
+async def test_consume_secret_nothing_to_claim():
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+        session.execute.return_value.first = MagicMock(return_value=None)
+
+        assert await consume_secret(MOCK_SECRET_KEY) is None
+
+
+@pytest.mark.asyncio
+async def test_consume_secret_invalid_key_skips_database():
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        assert await consume_secret('not-a-uuid') is None
+
+        mock_async_session.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_consume_secret_uuid7_key_prunes_by_created_at():
+    from app.partitions import key_created_at, uuid7
+
+    secret_key = str(uuid7())
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+
+        await consume_secret(secret_key)
+
+        params = session.execute.call_args[0][1]
+        assert params['key_created_at'] == key_created_at(secret_key)
+        assert 'secrets.created_at' in str(session.execute.call_args[0][0])
+
+
+@pytest.mark.asyncio
+async def test_release_secret():
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+
+        await release_secret(MOCK_SECRET_KEY)
+
+        session.execute.assert_awaited_once()
+        session.commit.assert_awaited_once()
+        statement = session.execute.call_args[0][0]
+        assert statement.compile().params['consumed'] is False
+
+
+@pytest.mark.asyncio
+async def test_create_secrets_single_insert():
+    created = [
+        models.Secret(
+            id='id-0',
+            secret_key='key-0',
+            secret_data='data-0',
+            passphrase_hash='hash-0',
+            expires_at=None
+        ),
+        RuntimeError('hashing failed'),
+        models.Secret(
+            id='id-2',
+            secret_key='key-2',
+            secret_data='data-2',
+            passphrase_hash='hash-2',
+            expires_at=None
+        )
+    ]
+    with patch.object(
+        SecretFactory,
+        'create_many',
+        new_callable=AsyncMock,
+        return_value=created
+    ), patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+
+        result = await create_secrets([MagicMock()] * 3)
+
+        assert result[0] == 'key-0'
+        assert isinstance(result[1], RuntimeError)
+        assert result[2] == 'key-2'
+        session.execute.assert_awaited_once()
+        rows = session.execute.call_args[0][1]
+        assert [row['secret_key'] for row in rows] == ['key-0', 'key-2']
+        assert all(row['consumed'] is False for row in rows)
+        session.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_create_many_returns_errors_per_item():
+    secrets = [
+        SecretCreate(passphrase='p0', secret='s0'),
+        SecretCreate(passphrase='p1', secret='s1')
+    ]
+    failure = RuntimeError('hashing failed')
+    with patch.object(
+        SecretFactory,
+        'create',
+        new_callable=AsyncMock,
+        side_effect=['secret-0', failure]
+    ):
+        result = await SecretFactory.create_many(secrets)
+
+    assert result == ['secret-0', failure]
+
+
+@pytest.mark.asyncio
+async def test_release_secret_counts_failed_attempt():
+    with patch(
+        'app.repositories.sql_storage.db.async_session'
+    ) as mock_async_session:
+        session = _mock_session(mock_async_session)
+
+        await release_secret(MOCK_SECRET_KEY, failed=True, max_failed_attempts=3)
+
+        statement = session.execute.call_args[0][0]
+        sql = str(statement.compile())
+        assert 'failed_attempts=(secrets.failed_attempts +' in sql
+        assert 'CASE WHEN' in sql
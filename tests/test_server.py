@@ -0,0 +1,122 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from unittest.mock import MagicMock
+
+import httpx
+
+from app import config, server
+from app.config import DatabaseSettings
+from app.server import Master, _configure
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_connection_budget_is_split_between_workers(monkeypatch):
+    monkeypatch.setattr(config, 'WEB_WORKERS', 4)
+    monkeypatch.setattr(config, 'DB_CONNECTION_BUDGET', 30)
+
+    settings = DatabaseSettings.from_env()
+
+    assert settings.pool_size == 7
+    assert settings.max_overflow == 0
+
+
+def test_configure_sets_workers_before_config_is_read(monkeypatch):
+    monkeypatch.setenv('CRYPTO_MAX_WORKERS', '3')
+    monkeypatch.setenv('WEB_WORKERS', '1')
+
+    assert _configure(2) == 2
+    assert os.environ['WEB_WORKERS'] == '2'
+    assert os.environ['CRYPTO_MAX_WORKERS'] == '3'
+
+
+def test_workers_serve_and_stop_on_sigterm(tmp_path):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        DB_URL=f'sqlite+aiosqlite:///{tmp_path}/secrets.db',
+        AUTO_MIGRATE='true',
+        REAPER_ENABLED='false',
+        HASH_BCRYPT_ROUNDS='4',
+        CIPHER_KDF='hkdf'
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'app.server', '--workers', '2',
+         '--host', '127.0.0.1', '--port', str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                response = httpx.post(
+                    f'{url}/generate',
+                    json={'secret': 'text', 'passphrase': 'pass'}
+                )
+                break
+            except httpx.TransportError:
+                assert time.monotonic() < deadline
+                time.sleep(0.1)
+        assert response.status_code == 200
+        key = response.json()['secret_key']
+        response = httpx.get(
+            f'{url}/secrets/{key}',
+            params={'passphrase': 'pass'}
+        )
+        assert response.json() == {'secret': 'text'}
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=20) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+
+
+def test_respawn_backs_off_up_to_the_maximum():
+    assert [server._respawn_delay(recent) for recent in range(7)] == [
+        1, 2, 4, 8, 16, 30, 30
+    ]
+
+
+def test_master_gives_up_on_workers_that_keep_dying(monkeypatch):
+    monkeypatch.setattr(server, 'RESPAWN_DELAY', 0.01)
+    monkeypatch.setattr(server, 'RESPAWN_LIMIT', 3)
+    handlers = {
+        signum: signal.getsignal(signum)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    master = Master(None, MagicMock(), workers=1)
+    spawned = []
+
+    def crash(index):
+        # the fork exits at once with status 1
+        raise RuntimeError('worker failed to start')
+
+    spawn = master.spawn
+
+    def record(index):
+        spawned.append(index)
+        spawn(index)
+
+    monkeypatch.setattr(master, '_serve', crash)
+    monkeypatch.setattr(master, 'spawn', record)
+    try:
+        assert master.run(graceful_timeout=0) == 1
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert spawned == [0] * 4
+    assert not master.children
@@ -0,0 +1,192 @@
+from datetime import timedelta
+import uuid
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import insert, update
+
+from app import models
+from app.config import DatabaseSettings
+from app.database import build_engine
+from app.repositories.sharded_storage import HashRing, ShardedStorage
+from app.repositories.sql_storage import secret_table
+
+
+async def _gen(items):
+    for item in items:
+        yield item
+
+
+def _secret(index):
+    return models.Secret(
+        id=str(uuid.uuid4()),
+        secret_key=str(uuid.uuid4()),
+        secret_data=f'data-{index}'.encode(),
+        passphrase_hash='hash'
+    )
+
+
+@pytest_asyncio.fixture
+async def engines(tmp_path):
+    engines = {
+        name: build_engine(
+            DatabaseSettings(url=f'sqlite+aiosqlite:///{tmp_path}/{name}.db')
+        )
+        for name in ('a', 'b', 'c')
+    }
+    yield engines
+    for engine in engines.values():
+        await engine.dispose()
+
+
+async def _storage(engines, ring, previous=None):
+    storage = ShardedStorage(engines, ring, previous, auto_migrate=True)
+    await storage.start()
+    return storage
+
+
+async def _counts(storage):
+    return {
+        name: (await shard.stats())['live']
+        for name, shard in storage.shards.items()
+    }
+
+
+def test_ring_moves_only_the_new_shard_share():
+    keys = [str(uuid.uuid4()) for _ in range(3000)]
+    before = HashRing(['a', 'b'])
+    after = HashRing(['a', 'b', 'c'])
+
+    moved = [key for key in keys if before.shard(key) != after.shard(key)]
+
+    assert {after.shard(key) for key in moved} == {'c'}
+    assert 0.2 < len(moved) / len(keys) < 0.45
+    assert before.shard(keys[0].upper()) == before.shard(keys[0])
+
+
+def test_ring_needs_known_shards(engines):
+    with pytest.raises(ValueError):
+        ShardedStorage(engines, ['a', 'missing'])
+
+
+@pytest.mark.asyncio
+async def test_secrets_are_spread_and_routed(engines):
+    storage = await _storage(engines, ['a', 'b', 'c'])
+    secrets = [_secret(index) for index in range(60)]
+    keys = [secret.secret_key for secret in secrets]
+    await storage.create(secrets[0])
+    await storage.create_many(secrets[1:])
+
+    counts = await _counts(storage)
+    assert sum(counts.values()) == 60
+    assert all(counts.values())
+
+    claimed = await storage.consume(keys[5])
+    assert claimed.secret_data == b'data-5'
+    assert await storage.consume(keys[5]) is None
+    await storage.release(keys[5], failed=True)
+    assert (await storage.get(keys[5])).consumed is False
+    assert await storage.stats() == {'live': 60, 'consumed': 0}
+
+
+@pytest.mark.asyncio
+async def test_rebalance_after_adding_a_shard(engines):
+    old = await _storage(engines, ['a', 'b'])
+    secrets = [_secret(index) for index in range(40)]
+    await old.create_many(secrets)
+    stream = _secret('stream')
+    await old.create_stream(stream, _gen([b'x', b'y']))
+    consumed = secrets[0].secret_key
+    await old.consume(consumed)
+
+    storage = await _storage(engines, ['a', 'b', 'c'], ['a', 'b'])
+    # found on their old shards before the rebalance
+    assert await storage.get(secrets[1].secret_key) is not None
+
+    moved = await storage.rebalance(batch_size=7)
+
+    assert moved > 0
+    assert (await _counts(storage))['c'] == moved
+    for secret in secrets[1:]:
+        assert storage.ring.shard(secret.secret_key) in {
+            name for name, shard in storage.shards.items()
+            if await shard.get(secret.secret_key) is not None
+        }
+    assert await storage.rebalance() == 0
+    assert await storage.consume(consumed) is None
+
+    claimed = await storage.consume(stream.secret_key)
+    chunks = storage.iter_chunks(stream.secret_key, claimed.id)
+    assert [data async for data in chunks] == [b'x', b'y']
+
+
+@pytest.mark.asyncio
+async def test_drain_a_shard(engines):
+    old = await _storage(engines, ['a', 'b', 'c'])
+    secrets = [_secret(index) for index in range(30)]
+    await old.create_many(secrets)
+
+    storage = await _storage(engines, ['a', 'b'], ['a', 'b', 'c'])
+    await storage.rebalance()
+
+    assert (await _counts(storage))['c'] == 0
+    for secret in secrets:
+        assert await storage.consume(secret.secret_key) is not None
+    assert await storage.delete_expired(100, timedelta(0)) == 30
+
+
+async def _hide(engine, secret, copy=False):
+    async with engine.begin() as conn:
+        if copy:
+            await conn.execute(insert(secret_table), [{
+                'id': secret.id,
+                'secret_key': secret.secret_key,
+                'secret_data': secret.secret_data,
+                'passphrase_hash': secret.passphrase_hash,
+                'consumed': True
+            }])
+        else:
+            await conn.execute(
+                update(secret_table).
+                where(secret_table.c.id == secret.id).
+                values(consumed=True, consumed_at=None)
+            )
+
+
+@pytest.mark.asyncio
+async def test_rebalance_finishes_a_committed_move(engines):
+    old = await _storage(engines, ['a'])
+    secret = _secret(0)
+    await old.create(secret)
+    # the original was hidden, then the move stopped before its copy
+    # was shown
+    await _hide(engines['b'], secret, copy=True)
+    await _hide(engines['a'], secret)
+    storage = await _storage(engines, ['b'], ['a'])
+
+    hidden = await storage.get(secret.secret_key)
+    assert hidden.consumed is True and hidden.read_at is None
+    assert await storage.consume(secret.secret_key) is None
+
+    assert await storage.rebalance() == 0
+    assert await _counts(storage) == {'a': 0, 'b': 1, 'c': 0}
+    assert await storage.shards['a'].get(secret.secret_key) is None
+    assert await storage.consume(secret.secret_key) is not None
+
+
+@pytest.mark.asyncio
+async def test_rebalance_undoes_an_uncommitted_move(engines):
+    old = await _storage(engines, ['a'])
+    secrets = [_secret(index) for index in range(2)]
+    await old.create_many(secrets)
+    await old.consume(secrets[1].secret_key)
+    # copies made, originals never hidden; one was claimed since
+    for secret in secrets:
+        await _hide(engines['b'], secret, copy=True)
+    storage = await _storage(engines, ['b'], ['a'])
+
+    assert await storage.rebalance() == 1
+
+    assert await storage.consume(secrets[0].secret_key) is not None
+    assert await storage.shards['b'].get(secrets[1].secret_key) is None
+    assert (await storage.shards['a'].get(secrets[1].secret_key)).consumed
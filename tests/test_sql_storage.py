@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+from unittest.mock import AsyncMock, patch
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from app import models
+from app.config import DatabaseSettings
+from app.database import build_engine
+from app.repositories import sql_storage
+from app.repositories.sql_storage import SqlStorage
+
+
+async def _gen(items):
+    for item in items:
+        yield item
+
+
+def _key(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, name))
+
+
+def _secret(name, expires_at=None):
+    return models.Secret(
+        id=_key(f'id-{name}'),
+        secret_key=_key(name),
+        secret_data=b'data',
+        passphrase_hash='hash',
+        expires_at=expires_at
+    )
+
+
+@pytest_asyncio.fixture
+async def storage(tmp_path):
+    engine = build_engine(
+        DatabaseSettings(url=f'sqlite+aiosqlite:///{tmp_path}/secrets.db')
+    )
+    storage = SqlStorage(engine, auto_migrate=True)
+    await storage.start()
+    yield storage
+    await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_uses_wal(storage):
+    async with storage.engine.connect() as conn:
+        mode = await conn.exec_driver_sql('PRAGMA journal_mode')
+        assert mode.scalar() == 'wal'
+
+
+@pytest.mark.asyncio
+async def test_consume_release_and_stats(storage):
+    await storage.create(_secret('key'))
+
+    claimed = await storage.consume(_key('key'))
+    assert claimed.secret_data == b'data'
+    assert await storage.consume(_key('key')) is None
+    assert await storage.stats() == {'live': 0, 'consumed': 1}
+
+    await storage.release(_key('key'), failed=True, max_failed_attempts=1)
+    assert await storage.consume(_key('key')) is None
+    assert (await storage.get(_key('key'))).consumed is True
+
+
+@pytest.mark.asyncio
+async def test_delete_expired_cascades_to_chunks(storage):
+    past = datetime.now(UTC) - timedelta(seconds=1)
+    await storage.create_many([_secret('expired', past), _secret('live')])
+    await storage.create_stream(_secret('stream'), _gen([b'a', b'b']))
+    await storage.consume(_key('stream'))
+
+    assert await storage.delete_expired(10, timedelta(0)) == 2
+
+    assert await storage.get(_key('expired')) is None
+    assert await storage.get(_key('live')) is not None
+    chunks = storage.iter_chunks(_key('stream'), _key('id-stream'))
+    assert [data async for data in chunks] == []
+
+
+@pytest.mark.asyncio
+async def test_create_stream_holds_no_connection_while_uploading(storage):
+    pool = storage.engine.sync_engine.pool
+    checked_out = []
+
+    async def upload():
+        for data in (b'a', b'b'):
+            checked_out.append(pool.checkedout())
+            yield data
+
+    await storage.create_stream(_secret('stream'), upload())
+
+    assert checked_out == [0, 0]
+    claimed = await storage.consume(_key('stream'))
+    chunks = storage.iter_chunks(_key('stream'), claimed.id)
+    assert [data async for data in chunks] == [b'a', b'b']
+
+
+@pytest.mark.asyncio
+async def test_read_secret_is_kept_for_read_retention(storage):
+    await storage.create_stream(_secret('stream'), _gen([b'a', b'b']))
+    await storage.consume(_key('stream'))
+    await storage.mark_read(_key('stream'))
+
+    assert await storage.delete_expired(
+        10, timedelta(0), timedelta(hours=1)
+    ) == 0
+    read = await storage.get(_key('stream'))
+    assert read.read_at is not None
+    chunks = storage.iter_chunks(_key('stream'), _key('id-stream'))
+    assert [data async for data in chunks] == []
+
+    assert await storage.delete_expired(10, timedelta(0)) == 1
+    assert await storage.get(_key('stream')) is None
+
+
+@pytest.mark.asyncio
+async def test_invalid_key_is_missing(storage):
+    assert await storage.get('not a uuid') is None
+    assert await storage.consume('not a uuid') is None
+    await storage.release('not a uuid')
+
+
+@pytest.mark.asyncio
+async def test_read_receipt_outbox(storage):
+    secret = _secret('receipt')
+    secret.callback_url = 'https://example.com/read'
+    await storage.create(secret)
+    await storage.create(_secret('plain'))
+    lease = timedelta(seconds=60)
+
+    # written only once the claim has been delivered
+    await storage.consume(_key('receipt'))
+    await storage.release(_key('receipt'))
+    assert await storage.next_receipt_at() is None
+
+    await storage.consume(_key('plain'))
+    await storage.mark_read(_key('plain'))
+    assert (await storage.get(_key('plain'))).read_at is not None
+    await storage.consume(_key('receipt'))
+    await storage.mark_read(_key('receipt'))
+    # SQLite drops the zone of the stored UTC time
+    next_at = await storage.next_receipt_at()
+    assert next_at.replace(tzinfo=UTC) <= datetime.now(UTC)
+
+    retry = datetime.now(UTC) - timedelta(seconds=1)
+    await storage.finish_receipts([], {_key('receipt'): retry})
+    [receipt] = await storage.claim_receipts(10, lease)
+    assert receipt.secret_key == _key('receipt')
+    assert receipt.callback_url == 'https://example.com/read'
+    assert receipt.attempts == 1
+    # leased to this dispatcher
+    assert await storage.claim_receipts(10, lease) == []
+
+    await storage.finish_receipts([_key('receipt')], {})
+    assert await storage.next_receipt_at() is None
+
+
+@pytest.mark.asyncio
+async def test_receipt_listener_reconnects():
+    class Connection:
+        def __init__(self, alive):
+            self.alive = alive
+            self.terminated = False
+
+        async def add_listener(self, channel, listener):
+            listener(self, 1, channel, 'key')
+
+        async def execute(self, query):
+            if not self.alive:
+                raise ConnectionResetError()
+
+        def terminate(self):
+            self.terminated = True
+
+    dropped, alive = Connection(False), Connection(True)
+    connect = AsyncMock(side_effect=[OSError(), dropped, alive])
+    notified = []
+    storage = SqlStorage(build_engine(
+        DatabaseSettings(url='postgresql+asyncpg://u:p@localhost/db')
+    ))
+    with patch('asyncpg.connect', connect), \
+            patch.object(sql_storage, 'LISTEN_CHECK_INTERVAL', 0.01), \
+            patch.object(sql_storage, 'LISTEN_RETRY_BASE', 0.01):
+        assert await storage.listen_receipts(notified.append) is True
+        for _ in range(100):
+            if connect.await_count == 3:
+                break
+            await asyncio.sleep(0.01)
+        await storage.close()
+
+    assert connect.await_count == 3
+    assert notified == ['key', 'key']
+    assert dropped.terminated and alive.terminated
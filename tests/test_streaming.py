@@ -0,0 +1,55 @@
+import pytest
+
+from app.streaming import SecretTooLargeError, read_frames, with_last
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def _collect(iterator):
+    return [item async for item in iterator]
+
+
+@pytest.mark.asyncio
+async def test_read_frames_regroups_input():
+    frames = await _collect(read_frames(
+        _iterate([b'abc', b'defgh', b'ij']), frame_size=4, max_size=100
+    ))
+
+    assert frames == [(b'abcd', False), (b'efgh', False), (b'ij', True)]
+
+
+@pytest.mark.asyncio
+async def test_read_frames_exact_multiple():
+    frames = await _collect(read_frames(
+        _iterate([b'abcd', b'efgh']), frame_size=4, max_size=100
+    ))
+
+    assert frames == [(b'abcd', False), (b'efgh', True)]
+
+
+@pytest.mark.asyncio
+async def test_read_frames_empty_input():
+    frames = await _collect(read_frames(
+        _iterate([]), frame_size=4, max_size=100
+    ))
+
+    assert frames == [(b'', True)]
+
+
+@pytest.mark.asyncio
+async def test_read_frames_size_limit():
+    with pytest.raises(SecretTooLargeError):
+        await _collect(read_frames(
+            _iterate([b'abcd', b'efgh']), frame_size=4, max_size=6
+        ))
+
+
+@pytest.mark.asyncio
+async def test_with_last():
+    assert await _collect(with_last(_iterate([1, 2, 3]))) == [
+        (1, False), (2, False), (3, True)
+    ]
+    assert await _collect(with_last(_iterate([]))) == []
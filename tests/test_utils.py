@@ -1,5 +1,9 @@
 from unittest.mock import patch
 
+import pytest
+from cryptography.fernet import Fernet
+
+from app.cipher import DecryptionError
 from app.utils import SecretManager, PasswordManager
 
 
@@ -49,31 +53,46 @@ def test_verify_password_false():
 
 
 # Tests for SecretManager
-def test_encrypt_secret():
-    passphrase = 'test_passphrase'
-    secret = 'test_secret'
-    secret_mgr = SecretManager(passphrase)
-    key = secret_mgr.key
+@pytest.mark.parametrize('algorithm', ['aesgcm', 'chacha20', 'fernet'])
+def test_encrypt_decrypt_secret(algorithm):
+    secret_mgr = SecretManager('test_passphrase', algorithm, 'hkdf')
+
+    encrypted = secret_mgr.encrypt_secret('test_secret')
+
+    assert encrypted != secret_mgr.encrypt_secret('test_secret')
+    assert SecretManager('test_passphrase').decrypt_secret(encrypted) == (
+        'test_secret'
+    )
 
-    with patch('app.utils.Fernet') as MockFernet:
-        instance = MockFernet.return_value
-        instance.encrypt.return_value = b'encrypted_secret'
-        result = secret_mgr.encrypt_secret(secret)
-        MockFernet.assert_called_once_with(key)
-        instance.encrypt.assert_called_once_with(secret.encode())
-        assert result == 'encrypted_secret'
 
+def test_encrypt_secret_with_scrypt():
+    secret_mgr = SecretManager('test_passphrase', 'aesgcm', 'scrypt')
 
-def test_decrypt_secret():
+    encrypted = secret_mgr.encrypt_secret('test_secret')
+
+    assert secret_mgr.decrypt_secret(encrypted) == 'test_secret'
+
+
+def test_decrypt_legacy_fernet_token():
     passphrase = 'test_passphrase'
-    encrypted_secret = 'encrypted_secret'
-    secret_mgr = SecretManager(passphrase)
-    key = secret_mgr.key
-
-    with patch('app.utils.Fernet') as MockFernet:
-        instance = MockFernet.return_value
-        instance.decrypt.return_value = b'decrypted_secret'
-        result = secret_mgr.decrypt_secret(encrypted_secret)
-        MockFernet.assert_called_once_with(key)
-        instance.decrypt.assert_called_once_with(encrypted_secret.encode())
-        assert result == 'decrypted_secret'
+    legacy_key = SecretManager._get_key(passphrase)
+    token = Fernet(legacy_key).encrypt(b'test_secret')
+
+    assert SecretManager(passphrase).decrypt_secret(token) == 'test_secret'
+
+
+def test_decrypt_secret_wrong_passphrase():
+    encrypted = SecretManager('test_passphrase').encrypt_secret('test_secret')
+
+    with pytest.raises(DecryptionError):
+        SecretManager('wrong_passphrase').decrypt_secret(encrypted)
+
+
+def test_encrypt_bytes_is_not_base64_encoded():
+    secret_mgr = SecretManager('test_passphrase', 'aesgcm', 'hkdf')
+    data = bytes(range(256)) * 4
+
+    encrypted = secret_mgr.encrypt_bytes(data)
+
+    assert len(encrypted) < len(data) + 64
+    assert secret_mgr.decrypt_bytes(encrypted) == data